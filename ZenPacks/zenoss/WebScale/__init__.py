@@ -178,6 +178,11 @@ class ZenPack(ZenPackBase):
             time.sleep(4) # Wait for it to shut down
             log.info("Configuring zenwebserver")
             subprocess.call([zenPath('bin', 'zenwebserver'), 'configure'])
+
+        # A running nginx moves to the new binary without dropping connections
+        if os.path.exists(zenPath('var', 'nginx.pid')):
+            log.info("Upgrading the running load balancer")
+            subprocess.call([zenPath('bin', 'zenwebserver'), 'upgrade'])
         log.info("Installed successfully. Run 'zenwebserver start' to start the UI server.")
 
 
@@ -194,7 +199,10 @@ class ZenPack(ZenPackBase):
             use_zopectl()
             log.info("Uninstalling zenwebserver and nginx")
             remove_files = ('bin/zenwebserver', 'bin/nginx', 'etc/mime.types', 'html/zenwebserver_50x.html',
-                            'etc/nginx.conf', 'etc/nginx-zope.conf')
+                            'etc/nginx.conf', 'etc/nginx-zope.conf', 'etc/nginx-cache-version.conf',
+                            'etc/nginx-dc-routes.conf', 'etc/nginx-remote-upstreams.conf',
+                            'etc/nginx-zope.conf.lock', 'etc/nginx-affinity.conf',
+                            'etc/nginx-render-cache-collector.conf', 'etc/nginx-render-cache-hub.conf')
             self._remove_zenhome_files(*remove_files)
 
             remove_dirs = ['etc/zope', 'var/nginx', 'var/nginx_temp', 'var/nginx-cache']
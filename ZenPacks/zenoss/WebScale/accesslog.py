@@ -0,0 +1,391 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Streaming analyzer for the zenwebserver access log.
+
+Reads nginx access logs written with the 'zenwebserver' log_format (see
+nginx.conf.template) and reports latency percentiles per Zope backend, per
+URL class and per minute. Logs are read line by line, so rotated and gzipped
+logs of any size can be analyzed; latencies are kept in fixed-precision
+histograms rather than as raw samples.
+
+Usage: zenwebserver analyze [options] [logfile ...]
+"""
+
+import os
+import re
+import sys
+import gzip
+import math
+from optparse import OptionParser
+
+zenhome = os.getenv('ZENHOME', '')
+
+DEFAULT_ACCESS_LOG = os.path.join(zenhome, 'log', 'nginx', 'access.log')
+
+# Combined log format followed by the timing fields added by the
+# 'zenwebserver' log_format.
+_LINE_PATTERN = re.compile(
+    r'(?P<remote_addr>\S+) \S+ (?P<remote_user>\S+) '
+    r'\[(?P<time_local>[^\]]+)\] '
+    r'"(?P<request>[^"]*)" (?P<status>\d{3}) (?P<bytes>\S+) '
+    r'"[^"]*" "[^"]*"'
+    r'(?P<extra>.*)$')
+
+_EXTRA_PATTERN = re.compile(r'(?P<key>\w+)=(?:"(?P<quoted>[^"]*)"|(?P<bare>\S+))')
+
+_STATIC_PATTERN = re.compile(
+    r'\.(jpg|png|gif|jpeg|css|js|mp3|wav|swf|mov|doc|pdf|xls|ppt|docx|pptx|xlsx|ico)$',
+    re.IGNORECASE)
+
+# Separators nginx uses in $upstream_addr/$upstream_response_time when a
+# request was retried on another server (', ') or internally redirected (' : ')
+_UPSTREAM_SEPARATOR = re.compile(r'\s*[,:]\s+')
+
+URL_CLASSES = ('router', 'static', 'remote-collector', 'remote-hub', 'status', 'other')
+
+
+def classify_url(path):
+    """
+    Returns the URL class of a request path.
+    """
+    if path.startswith('/remote-collector/'):
+        return 'remote-collector'
+    if path.startswith('/remote-hub/'):
+        return 'remote-hub'
+    if path.startswith('/nginx_status'):
+        return 'status'
+    if path.endswith('_router'):
+        return 'router'
+    if _STATIC_PATTERN.search(path):
+        return 'static'
+    return 'other'
+
+
+class LatencyHistogram(object):
+    """
+    Log-linear histogram of latencies (in seconds). Values are grouped into
+    buckets whose width is a fixed fraction of their value, so quantiles are
+    accurate to within that relative error and memory use only depends on
+    the range of latencies seen, never on the number of samples.
+    """
+
+    MIN_VALUE = 0.0005
+    RELATIVE_ERROR = 0.02
+
+    _LOG_BASE = math.log(1 + RELATIVE_ERROR)
+
+    def __init__(self):
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        if value <= self.MIN_VALUE:
+            return 0
+        return int(math.log(value / self.MIN_VALUE) / self._LOG_BASE) + 1
+
+    def _value(self, index):
+        if index == 0:
+            return self.MIN_VALUE
+        # Midpoint of the bucket
+        low = self.MIN_VALUE * math.exp((index - 1) * self._LOG_BASE)
+        return low * (1 + self.RELATIVE_ERROR / 2)
+
+    def add(self, value):
+        index = self._index(value)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other._buckets.iteritems():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """
+        Returns the approximate value below which the fraction q of the
+        samples fall.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(self._value(index), self.max)
+        return self.max
+
+
+class LogRecord(object):
+    """
+    One parsed access log line.
+    """
+    __slots__ = ('minute', 'method', 'path', 'status', 'request_time', 'upstreams', 'uri')
+
+    def __init__(self, minute, method, path, status, request_time, upstreams, uri=None):
+        self.minute = minute
+        self.method = method
+        self.path = path
+        self.uri = uri if uri is not None else path
+        self.status = status
+        self.request_time = request_time
+        self.upstreams = upstreams
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_upstreams(addrs, times):
+    """
+    Pairs the entries of $upstream_addr with those of $upstream_response_time.
+    Returns a list of (address, seconds) tuples; entries without a timing
+    (requests that never reached a backend) are dropped.
+    """
+    if not addrs or addrs == '-':
+        return []
+    addr_list = _UPSTREAM_SEPARATOR.split(addrs.strip())
+    time_list = _UPSTREAM_SEPARATOR.split((times or '').strip())
+    result = []
+    for i, addr in enumerate(addr_list):
+        seconds = _parse_float(time_list[i]) if i < len(time_list) else None
+        if seconds is not None:
+            result.append((addr, seconds))
+    return result
+
+
+def parse_line(line):
+    """
+    Parses one access log line. Returns a LogRecord, or None if the line is
+    not in a recognized format.
+    """
+    m = _LINE_PATTERN.match(line.rstrip('\r\n'))
+    if not m:
+        return None
+    extra = {}
+    for em in _EXTRA_PATTERN.finditer(m.group('extra')):
+        extra[em.group('key')] = em.group('quoted') if em.group('quoted') is not None else em.group('bare')
+
+    request = m.group('request').split()
+    if len(request) >= 2:
+        method, path = request[0], request[1]
+    else:
+        method, path = '-', '-'
+    uri = path
+    path = path.split('?', 1)[0]
+
+    # [18/Oct/2013:11:41:07 +0000] -> 18/Oct/2013:11:41
+    minute = m.group('time_local')[:17]
+    return LogRecord(minute, method, path, int(m.group('status')),
+                     _parse_float(extra.get('rt')),
+                     parse_upstreams(extra.get('ua'), extra.get('urt')), uri)
+
+
+def open_log(path):
+    """
+    Opens a plain or gzipped log file; '-' is standard input.
+    """
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'r')
+
+
+class LogTailer(object):
+    """
+    Follows a growing access log, like 'tail -F'. The first call to
+    read_lines() only positions the tailer at the end of the file; later
+    calls return the complete lines written since. Rotation is detected by
+    a change of inode or a shrinking file, and the new file is read from its
+    beginning.
+    """
+
+    def __init__(self, path=DEFAULT_ACCESS_LOG):
+        self.path = path
+        self._file = None
+        self._inode = None
+        self._partial = ''
+
+    def _open(self, from_start):
+        self.close()
+        try:
+            self._file = open(self.path, 'r')
+        except IOError:
+            return False
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        if not from_start:
+            self._file.seek(0, os.SEEK_END)
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._partial = ''
+
+    def _rotated(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_ino != self._inode or st.st_size < self._file.tell()
+
+    def read_lines(self):
+        if self._file is None:
+            first = self._inode is None
+            self._open(from_start=not first)
+            return []
+        lines = []
+        if self._rotated():
+            # Drain what was left in the old file before switching
+            lines.extend(self._read_available())
+            self._open(from_start=True)
+        lines.extend(self._read_available())
+        return lines
+
+    def _read_available(self):
+        if self._file is None:
+            return []
+        data = self._partial + self._file.read()
+        lines = data.split('\n')
+        self._partial = lines.pop()
+        return lines
+
+
+class AccessLogAnalyzer(object):
+    """
+    Accumulates latency histograms per backend, URL class and minute.
+    """
+
+    def __init__(self, per_minute=True):
+        self.per_minute = per_minute
+        self.backends = {}
+        self.classes = {}
+        self.minutes = {}
+        self.lines = 0
+        self.skipped = 0
+        self.untimed = 0
+
+    def _histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = LatencyHistogram()
+        return histogram
+
+    def add(self, record):
+        for addr, seconds in record.upstreams:
+            self._histogram(self.backends, addr).add(seconds)
+        if record.request_time is None:
+            self.untimed += 1
+            return
+        self._histogram(self.classes, classify_url(record.path)).add(record.request_time)
+        if self.per_minute:
+            self._histogram(self.minutes, record.minute).add(record.request_time)
+
+    def feed(self, lines):
+        for line in lines:
+            self.lines += 1
+            record = parse_line(line)
+            if record is None:
+                self.skipped += 1
+            else:
+                self.add(record)
+
+    def analyze_file(self, path):
+        f = open_log(path)
+        try:
+            self.feed(f)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+_HEADER = '%-28s %9s %9s %9s %9s %9s %9s'
+_ROW = '%-28s %9d %9.3f %9.3f %9.3f %9.3f %9.3f'
+
+
+def _print_table(title, table, keys, out):
+    print >> out, title
+    print >> out, _HEADER % ('', 'requests', 'mean', 'p50', 'p95', 'p99', 'max')
+    for key in keys:
+        h = table[key]
+        print >> out, _ROW % (key, h.count, h.mean, h.quantile(0.50),
+                              h.quantile(0.95), h.quantile(0.99), h.max)
+    print >> out
+
+
+def _minute_key(minute):
+    # Sort 18/Oct/2013:11:41 chronologically without depending on locale
+    from time import strptime
+    try:
+        return strptime(minute, '%d/%b/%Y:%H:%M')
+    except ValueError:
+        return minute
+
+
+def print_report(analyzer, out=sys.stdout):
+    print >> out, "Parsed %d lines (%d unrecognized, %d without $request_time)" % (
+        analyzer.lines, analyzer.skipped, analyzer.untimed)
+    print >> out, "Latencies in seconds"
+    print >> out
+    if analyzer.backends:
+        _print_table("Upstream response time per backend", analyzer.backends,
+                     sorted(analyzer.backends), out)
+    elif analyzer.lines:
+        print >> out, "No upstream timings found; is the 'zenwebserver' log_format in use?"
+        print >> out
+    if analyzer.classes:
+        keys = [c for c in URL_CLASSES if c in analyzer.classes]
+        _print_table("Request time per URL class", analyzer.classes, keys, out)
+    if analyzer.minutes:
+        _print_table("Request time per minute", analyzer.minutes,
+                     sorted(analyzer.minutes, key=_minute_key), out)
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] [logfile ...]",
+                          description="Reports p50/p95/p99 latencies from zenwebserver "
+                                      "access logs. Gzipped logs are read transparently; "
+                                      "'-' reads standard input. Defaults to %s." % DEFAULT_ACCESS_LOG)
+    parser.add_option('--no-minutes', dest='per_minute', action='store_false', default=True,
+                      help="Do not report latencies per minute")
+    options, args = parser.parse_args(argv)
+
+    paths = args or [DEFAULT_ACCESS_LOG]
+    analyzer = AccessLogAnalyzer(per_minute=options.per_minute)
+    for path in paths:
+        try:
+            analyzer.analyze_file(path)
+        except IOError as e:
+            print >> sys.stderr, "Unable to read %s: %s" % (path, e)
+            return 1
+    print_report(analyzer)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Session affinity for the default Zope pool.
+
+Every Zope keeps its own ZODB object cache, so the requests of one session
+are best answered by the same Zope, which already has its objects loaded.
+nginx hashes the session cookie into one of BUCKETS buckets (split_clients),
+and every bucket has a home Zope chosen on a consistent hash ring of the
+servers of the zopectls upstream. Adding or removing a server only moves
+the buckets next to its points on the ring; the other sessions keep their
+home.
+
+Each home Zope gets an upstream of its own listing it first and the other
+servers after it, balanced by "fair no_rr": requests go to the home Zope
+while it has fewer requests in progress than its threads, and to the least
+busy of the others beyond that. Requests without the cookie, such as the
+login page, go to zopectls.
+
+nginx-affinity.conf is written by "zenwebserver configure" when affinity is
+enabled and, while it exists, rewritten by every change of nginx-zope.conf
+made through upstream.edit(), so a detached server is never a home.
+
+Usage: affinity.py [--conf PATH] {show|write}
+"""
+
+import os
+import re
+import sys
+import bisect
+import hashlib
+import tempfile
+from optparse import OptionParser
+
+from upstream import UpstreamConf, NGINX_ZOPE_CONF, DEFAULT_UPSTREAM
+from webserverconf import load_settings
+
+AFFINITY_CONF_NAME = 'nginx-affinity.conf'
+
+# Share of the sessions that moves together, 1% each
+BUCKETS = 100
+# Points of a server of weight 1 on the ring
+REPLICAS = 64
+HOME_PREFIX = 'zopectls_home_'
+
+DEFAULT_COOKIE = '_ZopeId'
+DEFAULT_THREADS = 4
+
+AFFINITY_HEADER = """# GENERATED FILE, DO NOT MODIFY. Written by "zenwebserver configure" and
+# every change of nginx-zope.conf while affinity is enabled in
+# zenwebserver.conf.
+"""
+
+
+def affinity_conf_path(zope_conf_path=NGINX_ZOPE_CONF):
+    return os.path.join(os.path.dirname(os.path.abspath(zope_conf_path)), AFFINITY_CONF_NAME)
+
+
+def ring_point(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of addresses, each with REPLICAS points per unit of
+    weight.
+    """
+
+    def __init__(self, weights, replicas=REPLICAS):
+        self.points = []
+        for address, weight in weights.items():
+            for i in range(replicas * max(weight, 1)):
+                self.points.append((ring_point('%s#%d' % (address, i)), address))
+        self.points.sort()
+        self._keys = [point for point, address in self.points]
+
+    def lookup(self, key):
+        """
+        Returns the address owning key, or None for an empty ring.
+        """
+        if not self.points:
+            return None
+        i = bisect.bisect(self._keys, ring_point(key)) % len(self.points)
+        return self.points[i][1]
+
+
+def home_upstream(server):
+    return '%s%d' % (HOME_PREFIX, server.port)
+
+
+def home_keepalive(keepalive, homes):
+    """
+    Returns the idle connections kept for each of homes home upstreams, so
+    that together they keep about as many as the default upstream does.
+    """
+    if not keepalive or not homes:
+        return 0
+    return max(keepalive // homes, 1)
+
+
+def bucket_homes(servers, buckets=BUCKETS):
+    """
+    Returns the home server of every bucket.
+    """
+    byAddress = dict((server.address, server) for server in servers)
+    ring = HashRing(dict((server.address, server.weight) for server in servers))
+    return [byAddress[ring.lookup('bucket%d' % i)] for i in range(buckets)]
+
+
+def render_affinity_conf(conf, cookie=DEFAULT_COOKIE, threads=DEFAULT_THREADS):
+    """
+    Returns the text of nginx-affinity.conf for the servers of the default
+    upstream of conf. It defines $zenoss_zope_upstream, the upstream of a
+    request to the default pool.
+    """
+    if not re.match(r'^\w+$', cookie):
+        raise ValueError("Invalid affinity cookie name %r" % cookie)
+    pool = conf.upstream(DEFAULT_UPSTREAM)
+    servers = [s for s in pool.servers if s.get('down') is None] if pool else []
+    lines = [AFFINITY_HEADER]
+    if not servers:
+        lines.append('map $host $zenoss_zope_upstream {\n    default %s;\n}\n' % DEFAULT_UPSTREAM)
+        return ''.join(lines)
+
+    lines.append('split_clients "${cookie_%s}" $zenoss_affinity_bucket {\n' % cookie)
+    share = 100.0 / BUCKETS
+    for i in range(BUCKETS - 1):
+        lines.append('    %g%% b%d;\n' % (share, i))
+    lines.append('    * b%d;\n}\n\n' % (BUCKETS - 1))
+
+    lines.append('map $zenoss_affinity_bucket $zenoss_affinity_home {\n')
+    lines.append('    default %s;\n' % DEFAULT_UPSTREAM)
+    for i, server in enumerate(bucket_homes(servers)):
+        lines.append('    b%d %s;\n' % (i, home_upstream(server)))
+    lines.append('}\n\n')
+
+    lines.append('map $cookie_%s $zenoss_zope_upstream {\n' % cookie)
+    lines.append('    default $zenoss_affinity_home;\n')
+    lines.append('    "" %s;\n}\n' % DEFAULT_UPSTREAM)
+
+    # Every home upstream has a pool of idle connections of its own
+    keepalive = home_keepalive(pool.keepalive, len(servers))
+    for i, home in enumerate(servers):
+        lines.append('\nupstream %s {\n' % home_upstream(home))
+        # The home first, then the others from the next one on, so the
+        # overflow of different homes does not all go to the same server
+        for server in servers[i:] + servers[:i]:
+            params = ['weight=%d' % (threads * server.weight)]
+            for name in ('max_fails', 'fail_timeout'):
+                if server.get(name) is not None:
+                    params.append('%s=%s' % (name, server.get(name)))
+            lines.append('    server %s %s;\n' % (server.address, ' '.join(params)))
+        lines.append('    fair no_rr weight_mode=idle;\n')
+        if keepalive:
+            lines.append('    keepalive %d;\n' % keepalive)
+        lines.append('}\n')
+    return ''.join(lines)
+
+
+def write_affinity_conf(conf, cookie=DEFAULT_COOKIE, threads=DEFAULT_THREADS, path=None):
+    """
+    Writes nginx-affinity.conf for conf. Returns True if the file changed.
+    """
+    path = path or affinity_conf_path(conf.path)
+    content = render_affinity_conf(conf, cookie, threads)
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.nginx-affinity')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def affinity_settings(config):
+    return config['affinity_cookie'] or DEFAULT_COOKIE, max(config['affinity_threads'], 1)
+
+
+def sync_affinity_conf(conf):
+    """
+    Rewrites nginx-affinity.conf for conf if affinity is in use, that is if
+    the file exists. Returns True if it changed.
+    """
+    path = affinity_conf_path(conf.path)
+    if not os.path.exists(path):
+        return False
+    cookie, threads = affinity_settings(load_settings())
+    return write_affinity_conf(conf, cookie, threads, path)
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [--conf PATH] {show|write}",
+                          description="Shows the home Zope of the session buckets, or writes "
+                                      "nginx-affinity.conf; write exits with 2 if it changed.")
+    parser.add_option('--conf', default=NGINX_ZOPE_CONF,
+                      help="nginx-zope.conf to read [default: %default]")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or args[0] not in ('show', 'write'):
+        parser.error("expected show or write")
+
+    conf = UpstreamConf.load(options.conf)
+    cookie, threads = affinity_settings(load_settings())
+    if args[0] == 'write':
+        try:
+            return 2 if write_affinity_conf(conf, cookie, threads) else 0
+        except (IOError, OSError, ValueError) as e:
+            print >> sys.stderr, "Unable to write %s: %s" % (affinity_conf_path(options.conf), e)
+            return 1
+
+    pool = conf.upstream(DEFAULT_UPSTREAM)
+    servers = [s for s in pool.servers if s.get('down') is None] if pool else []
+    if not servers:
+        print "No servers in %s" % DEFAULT_UPSTREAM
+        return 0
+    counts = {}
+    for server in bucket_homes(servers):
+        counts[server.address] = counts.get(server.address, 0) + 1
+    for server in servers:
+        print "%-20s %3d%% of sessions" % (server.address, counts.get(server.address, 0) * 100 // BUCKETS)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
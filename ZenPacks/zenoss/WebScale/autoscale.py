@@ -0,0 +1,317 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Load-driven autoscaling controller for the Zope server pool.
+
+Samples the Zope pool (the upstream response times of its requests in the
+access log) and the host (CPU and available memory) at a fixed interval
+and grows or shrinks the pool one server at a time with
+'zenwebserver deploy +1' / 'zenwebserver deploy -1'; a shrink detaches and
+drains the server before stopping it. Separate thresholds for growing and
+shrinking, a number of consecutive samples required before acting and a
+cooldown after every change keep the pool size from flapping.
+
+The requests in flight per Zope are the upstream response times of the
+Zope requests logged during the interval, summed and divided by its length
+and the pool size (Little's law). Static files, cached responses and remote
+collector routes do not count, as no Zope answers them.
+
+Usage: zenwebserver autoscale {run|start|stop|status} [options]
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import subprocess
+from optparse import OptionParser
+
+from accesslog import LogTailer, LatencyHistogram, parse_line, classify_url
+from pool import instances
+from procutil import CpuSampler, meminfo, mem_available_kb, pid_rss_kb
+from stubstatus import fetch_stub_status
+from webserverconf import load_settings, local_url
+
+log = logging.getLogger('zen.webscale.autoscale')
+
+zenhome = os.getenv('ZENHOME', '')
+
+ZENWEBSERVER = os.path.join(zenhome, 'bin', 'zenwebserver')
+
+# Assumed size of a Zope when none is running to measure
+DEFAULT_ZOPE_RSS_KB = 1024 * 1024
+
+# URL classes that are not served by the Zope pool
+_NON_ZOPE_CLASSES = ('remote-collector', 'remote-hub', 'status')
+
+
+def mean_zope_rss_kb():
+    """
+    Returns the average resident size of the running Zopes in kB.
+    """
+    sizes = []
+    for instance in instances():
+        pid = instance.pid
+        rss = pid_rss_kb(pid) if pid else None
+        if rss:
+            sizes.append(rss)
+    return sum(sizes) / len(sizes) if sizes else DEFAULT_ZOPE_RSS_KB
+
+
+class LoadSample(object):
+    """
+    Load measured over one sampling interval.
+    """
+
+    def __init__(self, pool_size, latency_p95, busy, cpu, mem_available_kb, zope_rss_kb):
+        self.pool_size = pool_size
+        # 95th percentile upstream response time of Zope requests, or None
+        # if no request was answered during the interval
+        self.latency_p95 = latency_p95
+        # Average requests in flight per Zope
+        self.busy = busy
+        self.cpu = cpu
+        self.mem_available_kb = mem_available_kb
+        self.zope_rss_kb = zope_rss_kb
+
+    def __str__(self):
+        latency = '-' if self.latency_p95 is None else '%.3fs' % self.latency_p95
+        return "servers=%d p95=%s busy=%.2f cpu=%.0f%% mem_available=%dMB" % (
+            self.pool_size, latency, self.busy, self.cpu, self.mem_available_kb / 1024)
+
+
+class AutoscalePolicy(object):
+    """
+    Decides when to grow or shrink the pool. The pool grows once it has been
+    overloaded for up_samples consecutive samples and shrinks once it has
+    been idle for down_samples consecutive samples; nothing changes within
+    cooldown seconds of the previous change.
+    """
+
+    def __init__(self, min_servers=2, max_servers=8, up_latency=2.0, down_latency=0.5,
+                 up_busy=2.0, down_busy=0.25, up_samples=2, down_samples=10,
+                 cooldown=300, max_cpu=85.0, mem_reserve_kb=512 * 1024):
+        self.min_servers = min_servers
+        self.max_servers = max(max_servers, min_servers)
+        self.up_latency = up_latency
+        self.down_latency = down_latency
+        self.up_busy = up_busy
+        self.down_busy = down_busy
+        self.up_samples = up_samples
+        self.down_samples = down_samples
+        self.cooldown = cooldown
+        self.max_cpu = max_cpu
+        self.mem_reserve_kb = mem_reserve_kb
+        self._hot = 0
+        self._cold = 0
+        self._last_change = None
+
+    def _overloaded(self, sample):
+        return ((sample.latency_p95 is not None and sample.latency_p95 >= self.up_latency)
+                or sample.busy >= self.up_busy)
+
+    def _idle(self, sample):
+        return ((sample.latency_p95 is None or sample.latency_p95 <= self.down_latency)
+                and sample.busy <= self.down_busy)
+
+    def _can_grow(self, sample):
+        if sample.cpu >= self.max_cpu:
+            return False, "host CPU at %.0f%%" % sample.cpu
+        needed = sample.zope_rss_kb + self.mem_reserve_kb
+        if sample.mem_available_kb < needed:
+            return False, "%dMB available, %dMB needed" % (
+                sample.mem_available_kb / 1024, needed / 1024)
+        return True, None
+
+    def changed(self, now):
+        self._hot = self._cold = 0
+        self._last_change = now
+
+    def decide(self, sample, now):
+        """
+        Returns (delta, reason) where delta is +1, -1 or 0.
+        """
+        self._hot = self._hot + 1 if self._overloaded(sample) else 0
+        self._cold = self._cold + 1 if self._idle(sample) else 0
+
+        # Also after a failed change, so a failing deploy is not retried
+        # every interval
+        if self._last_change is not None and now - self._last_change < self.cooldown:
+            return 0, "cooling down"
+        if sample.pool_size < self.min_servers:
+            return 1, "below minimum of %d servers" % self.min_servers
+        if sample.pool_size > self.max_servers:
+            return -1, "above maximum of %d servers" % self.max_servers
+        if self._hot >= self.up_samples:
+            if sample.pool_size >= self.max_servers:
+                return 0, "overloaded, but at maximum of %d servers" % self.max_servers
+            can_grow, reason = self._can_grow(sample)
+            if not can_grow:
+                return 0, "overloaded, but not growing: %s" % reason
+            return 1, "overloaded for %d samples" % self._hot
+        if self._cold >= self.down_samples and sample.pool_size > self.min_servers:
+            return -1, "idle for %d samples" % self._cold
+        return 0, None
+
+
+def policy_from_config(config, max_pool_size=None):
+    max_servers = config['autoscale_max_servers']
+    if max_pool_size:
+        max_servers = min(max_servers, max_pool_size)
+    return AutoscalePolicy(
+        min_servers=config['autoscale_min_servers'],
+        max_servers=max_servers,
+        up_latency=config['autoscale_up_latency'],
+        down_latency=config['autoscale_down_latency'],
+        up_busy=config['autoscale_up_busy'],
+        down_busy=config['autoscale_down_busy'],
+        up_samples=config['autoscale_up_samples'],
+        down_samples=config['autoscale_down_samples'],
+        cooldown=config['autoscale_cooldown'],
+        max_cpu=config['autoscale_max_cpu'],
+        mem_reserve_kb=config['autoscale_mem_reserve'] * 1024)
+
+
+class AutoscaleController(object):
+    """
+    Samples the load every interval seconds and applies the policy.
+    """
+
+    def __init__(self, policy, status_url, interval=15, dry_run=False):
+        self.policy = policy
+        self.status_url = status_url
+        self.interval = interval
+        self.dry_run = dry_run
+        self._tailer = LogTailer()
+        self._cpu = CpuSampler()
+        self._last_sample = None
+        self._running = False
+
+    def _zope_timings(self, servers):
+        """
+        Returns (95th percentile, sum) of the upstream response times of the
+        requests the servers answered since the last call.
+        """
+        histogram = LatencyHistogram()
+        total = 0.0
+        for line in self._tailer.read_lines():
+            record = parse_line(line)
+            if record is None or classify_url(record.path) in _NON_ZOPE_CLASSES:
+                continue
+            for addr, seconds in record.upstreams:
+                if addr in servers:
+                    histogram.add(seconds)
+                    total += seconds
+        return (histogram.quantile(0.95) if histogram.count else None), total
+
+    def sample(self):
+        """
+        Returns a LoadSample, or None if the load balancer is not running.
+        """
+        now = time.time()
+        elapsed = now - self._last_sample if self._last_sample else self.interval
+        self._last_sample = now
+        status = fetch_stub_status(self.status_url)
+        pool = instances()
+        latency, busy_seconds = self._zope_timings(set(instance.address for instance in pool))
+        cpu = self._cpu.sample()
+        if status is None:
+            return None
+        pool_size = len(pool)
+        in_flight = busy_seconds / max(elapsed, 1.0)
+        busy = in_flight / pool_size if pool_size else in_flight
+        return LoadSample(pool_size, latency, busy, cpu,
+                          mem_available_kb(meminfo()), mean_zope_rss_kb())
+
+    def scale(self, delta):
+        arg = '+%d' % delta if delta > 0 else str(delta)
+        if self.dry_run:
+            log.info("Dry run: would run zenwebserver deploy %s", arg)
+            return True
+        log.info("Running zenwebserver deploy %s", arg)
+        with open(os.devnull, 'r') as devnull:
+            process = subprocess.Popen([ZENWEBSERVER, 'deploy', arg], stdin=devnull,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+        log.debug("zenwebserver deploy %s:\n%s", arg, output.strip())
+        if process.returncode:
+            # Such as a server that could not be detached, and was kept
+            log.error("zenwebserver deploy %s exited with %d:\n%s", arg, process.returncode, output.strip())
+        return process.returncode == 0
+
+    def step(self):
+        sample = self.sample()
+        if sample is None:
+            log.debug("Load balancer not running; not sampling")
+            return
+        log.debug("Sample: %s", sample)
+        now = time.time()
+        delta, reason = self.policy.decide(sample, now)
+        if delta:
+            log.info("%s; %s (%s)", "Growing pool" if delta > 0 else "Shrinking pool", reason, sample)
+            # Cool down after failures too, rather than retrying every sample
+            self.scale(delta)
+            self.policy.changed(now)
+        elif reason and reason != "cooling down":
+            log.debug(reason)
+
+    def stop(self, *args):
+        self._running = False
+
+    def run(self):
+        self._running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log.info("Autoscaling between %d and %d servers every %ds",
+                 self.policy.min_servers, self.policy.max_servers, self.interval)
+        # Position the log tailer and prime the CPU sampler
+        self._tailer.read_lines()
+        self._last_sample = time.time()
+        while self._running:
+            deadline = time.time() + self.interval
+            while self._running and time.time() < deadline:
+                time.sleep(min(1, deadline - time.time()))
+            if self._running:
+                try:
+                    self.step()
+                except Exception:
+                    log.exception("Autoscaling step failed")
+        self._tailer.close()
+        log.info("Autoscaling stopped")
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Grows and shrinks the Zope server pool based on load. "
+                                      "Settings are read from the autoscale_* options in "
+                                      "zenwebserver.conf.")
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help="Log scaling decisions without changing the pool")
+    parser.add_option('--max-pool-size', type='int', default=None,
+                      help="Hard upper bound for the pool size")
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help="Log every sample")
+    options, args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    config = load_settings()
+    policy = policy_from_config(config, options.max_pool_size)
+    controller = AutoscaleController(policy, local_url(config, '/nginx_status'),
+                                     interval=config['autoscale_interval'],
+                                     dry_run=options.dry_run)
+    controller.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,645 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Offline benchmark of the load balancer configuration.
+
+Starts local HTTP servers standing in for the Zopes, with configurable
+latency distributions, slow requests and injected failures, each counting
+the TCP connections and requests it receives. For every scenario, a
+combination of balancer (fair, round robin, least_conn, ...), upstream
+keepalive and micro-cache setting, nginx.conf is generated from
+nginx.conf.template by zenwebserverconfig under a temporary directory,
+together with an nginx-zope.conf pointing at the stand-ins, and the
+zenwebserver nginx binary is run with it while load is driven through it.
+The workload is a built-in mix of UI requests, or the GET requests of a
+captured access.log replayed in order.
+
+Each scenario is reported with its request rate, latency percentiles,
+errors and the number of connections nginx opened to the backends. Only
+local ports are used, so it runs on a single box without network access.
+
+With --herd N, the thundering herd protection of the static file cache is
+measured instead: N clients request the same static file at once while it
+is not cached, after it expired, and after it expired while every stand-in
+fails, with the cache lock and stale serving off and on. Each phase is
+reported with the number of requests that reached the stand-ins.
+
+Usage: benchmark.py [options]
+"""
+
+import os
+import sys
+import math
+import time
+import random
+import signal
+import shutil
+import socket
+import httplib
+import tempfile
+import threading
+import subprocess
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+
+from accesslog import LatencyHistogram, open_log, parse_line
+from cache import VERSION_CONF_TMPL
+from webserverconf import Settings
+from zenwebserverconfig import renderConfig, readTemplate, templatePath
+
+zenhome = os.getenv('ZENHOME', '')
+
+DEFAULT_NGINX = os.path.join(zenhome, 'bin', 'nginx')
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Balancer directives by the names used on the command line
+BALANCERS = {
+    'fair': 'fair',
+    'roundrobin': '',
+    'least_conn': 'least_conn',
+    'ip_hash': 'ip_hash',
+}
+
+ROUTER_BODY = ('{"action":"DeviceRouter","method":"getTree",'
+               '"data":[{"id":"/zport/dmd/Devices"}],"type":"rpc","tid":%d}')
+
+# (method, path, body) of the built-in workload: pages, static files and
+# the router calls polled by the UI
+DEFAULT_WORKLOAD = (
+    ('GET', '/zport/dmd/Dashboard', None),
+    ('GET', '/zport/dmd/Devices/devicegrid', None),
+    ('GET', '/++resource++zenui/js/zenoss/zenoss-all.js', None),
+    ('GET', '/++resource++zenui/css/zenoss.css', None),
+    ('POST', '/zport/dmd/device_router', ROUTER_BODY),
+    ('POST', '/zport/dmd/device_router', ROUTER_BODY),
+)
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def parse_distribution(spec):
+    """
+    Returns a function drawing a latency in seconds from spec:
+    "fixed:S", "uniform:MIN,MAX", "exp:MEAN" or "lognormal:MEDIAN,SIGMA".
+    """
+    name, _, args = spec.partition(':')
+    try:
+        values = [float(v) for v in args.split(',')] if args else []
+    except ValueError:
+        raise ValueError("invalid latency distribution %r" % spec)
+    if name == 'fixed' and len(values) == 1:
+        return lambda: values[0]
+    if name == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if name == 'exp' and len(values) == 1:
+        return lambda: random.expovariate(1.0 / values[0]) if values[0] > 0 else 0.0
+    if name == 'lognormal' and len(values) == 2:
+        mu = math.log(values[0]) if values[0] > 0 else 0.0
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError("invalid latency distribution %r" % spec)
+
+
+class BackendProfile(object):
+    """
+    How a stand-in Zope behaves: its latency distribution, the share of
+    requests that are slow, and the shares that fail with HTTP 500 or a
+    dropped connection.
+    """
+
+    def __init__(self, latency=None, slow_ratio=0.0, slow_delay=1.0,
+                 error_ratio=0.0, drop_ratio=0.0, factor=1.0):
+        self.latency = latency or (lambda: 0.0)
+        self.slow_ratio = slow_ratio
+        self.slow_delay = slow_delay
+        self.error_ratio = error_ratio
+        self.drop_ratio = drop_ratio
+        self.factor = factor
+
+    def delay(self):
+        delay = self.latency()
+        if self.slow_ratio and random.random() < self.slow_ratio:
+            delay += self.slow_delay
+        return delay * self.factor
+
+    def outcome(self):
+        """
+        Returns 'drop', 'error' or 'ok' for one request.
+        """
+        draw = random.random()
+        if draw < self.drop_ratio:
+            return 'drop'
+        if draw < self.drop_ratio + self.error_ratio:
+            return 'error'
+        return 'ok'
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one segment, as Zope does
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count_connection()
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.count_request(self.path)
+        profile = self.server.profile
+        delay = profile.delay()
+        if delay > 0:
+            time.sleep(delay)
+        outcome = profile.outcome()
+        if outcome == 'drop':
+            self.close_connection = 1
+            return
+        body = self.server.body
+        self.send_response(500 if outcome == 'error' else 200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInBackend(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP/1.1 server standing in for a Zope, answering requests as its
+    BackendProfile describes and counting the connections and requests it
+    receives.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, profile=None, body_size=2048):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _StandInHandler)
+        self.port = self.server_address[1]
+        self.profile = profile or BackendProfile()
+        self.body = 'x' * body_size
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.paths = {}
+        self._thread = None
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def count_request(self, path):
+        with self._lock:
+            self.requests += 1
+            self.paths[path] = self.paths.get(path, 0) + 1
+
+    def reset_counts(self):
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+            self.paths = {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def render_zope_conf(backends, balancer='fair', keepalive=0):
+    """
+    Returns an nginx-zope.conf in the form zenwebserver maintains, with the
+    stand-ins as the servers of the default pool.
+    """
+    lines = ['upstream zopectls {\n']
+    if balancer:
+        lines.append('    %s;\n' % balancer)
+    for backend in backends:
+        lines.append('    server 127.0.0.1:%d;\n' % backend.port)
+    if keepalive:
+        lines.append('    keepalive %d;\n' % keepalive)
+    lines.append('}\n')
+    return ''.join(lines)
+
+
+class NginxInstance(object):
+    """
+    Runs nginx in the foreground with nginx.conf generated from the template
+    for the given settings, in a temporary directory laid out like $ZENHOME.
+    """
+
+    def __init__(self, nginx, template, backends, settings=None, balancer='fair', keepalive=0):
+        self.nginx = nginx
+        self.home = tempfile.mkdtemp(prefix='zenwebserver-benchmark-')
+        self.port = free_port()
+        for d in ('etc', 'html', 'log/nginx', 'var/nginx/tmp'):
+            os.makedirs(os.path.join(self.home, d))
+        shutil.copy(os.path.join(_HERE, 'mime.types'), os.path.join(self.home, 'etc'))
+        shutil.copy(os.path.join(_HERE, 'zenwebserver_50x.html'), os.path.join(self.home, 'html'))
+        etc = os.path.join(self.home, 'etc')
+        var = os.path.join(self.home, 'var', 'nginx')
+        raw = dict(settings or {})
+        raw.update({'httpPort': str(self.port),
+                    'useSSL': 'False',
+                    'proxy_cache_path': os.path.join(var, 'cache'),
+                    'proxy_temp_path': os.path.join(var, 'tmp', 'proxy'),
+                    'client_body_temp_path': os.path.join(var, 'tmp', 'client_body'),
+                    'microcache_path': os.path.join(var, 'cache-micro'),
+                    'dc_render_cache_path': os.path.join(var, 'cache-render'),
+                    'customHttpInclude': os.path.join(etc, 'nginx-custom-http-*.conf'),
+                    'customServerInclude': os.path.join(etc, 'nginx-custom-server-*.conf')})
+        content, notes = renderConfig(Settings(raw).as_dict(), template, ('zopectls',), self.home)
+        self.conf = os.path.join(etc, 'nginx.conf')
+        self._write('etc/nginx.conf', content)
+        self._write('etc/nginx-zope.conf', render_zope_conf(backends, balancer, keepalive))
+        self._write('etc/nginx-cache-version.conf', VERSION_CONF_TMPL % 'benchmark')
+        self._process = None
+
+    def _write(self, name, content):
+        with open(os.path.join(self.home, name), 'w') as f:
+            f.write(content)
+
+    def start(self):
+        self._process = subprocess.Popen([self.nginx, '-c', self.conf, '-g', 'daemon off;'],
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if not wait_for_port(self.port):
+            output = self._process.poll() is not None and self._process.stdout.read() or ''
+            self.stop()
+            raise RuntimeError("nginx did not start: %s" % output.strip())
+
+    def stop(self):
+        if self._process and self._process.poll() is None:
+            self._process.send_signal(signal.SIGQUIT)
+            deadline = time.time() + 10
+            while self._process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self._process.poll() is None:
+                self._process.kill()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+class LoadResult(object):
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.errors = 0
+        self.elapsed = 0.0
+        self.backend_connections = 0
+        self.backend_requests = 0
+        self.backend_spread = ()
+
+    @property
+    def rps(self):
+        return self.histogram.count / self.elapsed if self.elapsed else 0.0
+
+
+def drive_load(port, workload, concurrency, requests):
+    """
+    Sends requests requests of the (method, path, body) workload, in turn, to
+    the local port from concurrency clients. Each client keeps its
+    connection open and its own session cookie, as browsers do.
+    """
+    result = LoadResult()
+    lock = threading.Lock()
+    counter = [0]
+
+    def client(session):
+        headers = {'Cookie': '__ac=benchmark%d' % session}
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+        while True:
+            with lock:
+                if counter[0] >= requests:
+                    break
+                method, path, body = workload[counter[0] % len(workload)]
+                counter[0] += 1
+            if body and '%d' in body:
+                body = body % counter[0]
+            started = time.time()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 500
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+                ok = False
+            with lock:
+                if ok:
+                    result.histogram.add(time.time() - started)
+                else:
+                    result.errors += 1
+        conn.close()
+
+    started = time.time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    result.elapsed = time.time() - started
+    return result
+
+
+def replay_workload(path, limit=None):
+    """
+    Returns the GET requests of an access log as a workload, in log order.
+    """
+    workload = []
+    f = open_log(path)
+    try:
+        for line in f:
+            record = parse_line(line)
+            if record is not None and record.method == 'GET':
+                workload.append(('GET', record.uri, None))
+                if limit and len(workload) >= limit:
+                    break
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return workload
+
+
+class Scenario(object):
+
+    def __init__(self, balancer='fair', keepalive=0, microcache=False):
+        self.balancer = balancer
+        self.keepalive = keepalive
+        self.microcache = microcache
+
+    @property
+    def name(self):
+        return '%s ka=%d mc=%s' % (self.balancer, self.keepalive, 'on' if self.microcache else 'off')
+
+    def settings(self):
+        return {'microcache': str(self.microcache)}
+
+
+def run_scenario(scenario, nginx, template, backends, workload, concurrency, requests):
+    for backend in backends:
+        backend.reset_counts()
+    instance = NginxInstance(nginx, template, backends, scenario.settings(),
+                             BALANCERS[scenario.balancer], scenario.keepalive)
+    instance.start()
+    try:
+        result = drive_load(instance.port, workload, concurrency, requests)
+    finally:
+        instance.stop()
+    result.backend_connections = sum(b.connections for b in backends)
+    result.backend_requests = sum(b.requests for b in backends)
+    result.backend_spread = [b.requests for b in backends]
+    return result
+
+
+def print_report(results, out=sys.stdout):
+    print >> out, '%-28s %8s %7s %8s %8s %8s %8s %9s %8s  %s' % (
+        'Scenario', 'Requests', 'Errors', 'RPS', 'p50 ms', 'p95 ms', 'p99 ms',
+        'Upstream', 'Conn/req', 'Requests per backend')
+    for scenario, result in results:
+        h = result.histogram
+        print >> out, '%-28s %8d %7d %8.0f %8.1f %8.1f %8.1f %9d %8.2f  %s' % (
+            scenario.name, h.count, result.errors, result.rps,
+            h.quantile(0.50) * 1000, h.quantile(0.95) * 1000, h.quantile(0.99) * 1000,
+            result.backend_connections,
+            float(result.backend_connections) / result.backend_requests if result.backend_requests else 0.0,
+            ' '.join(str(n) for n in result.backend_spread))
+
+
+# The static file requested by the herd, and how long it stays cached
+HERD_PATH = '/++resource++zenui/js/zenoss/zenoss-all.js'
+HERD_TTL = 2
+
+
+class HerdScenario(object):
+
+    def __init__(self, protected):
+        self.protected = protected
+
+    @property
+    def name(self):
+        return 'lock+stale' if self.protected else 'unprotected'
+
+    def settings(self):
+        settings = {'static_cache_valid': '%ds' % HERD_TTL}
+        if not self.protected:
+            settings.update({'static_cache_lock': 'False', 'static_cache_use_stale': 'off'})
+        return settings
+
+
+def herd_requests(port, path, clients):
+    """
+    Sends one GET of path from each of clients clients at the same moment.
+    Returns the number answered without and with a server error.
+    """
+    start = threading.Event()
+    lock = threading.Lock()
+    counts = {'ok': 0, 'errors': 0}
+
+    def client():
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+        start.wait()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 500
+        except (socket.error, httplib.HTTPException):
+            ok = False
+        conn.close()
+        with lock:
+            counts['ok' if ok else 'errors'] += 1
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    start.set()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    return counts['ok'], counts['errors']
+
+
+def run_herd(scenario, nginx, template, backends, clients, delay):
+    """
+    Returns (phase, upstream requests, ok, errors) of the cold, expired and
+    failing phases of a herd of clients.
+    """
+    profiles = [backend.profile for backend in backends]
+    phases = []
+    instance = NginxInstance(nginx, template, backends, scenario.settings())
+    instance.start()
+    try:
+        for phase, error_ratio in (('cold', 0.0), ('expired', 0.0), ('failing', 1.0)):
+            for backend in backends:
+                backend.profile = BackendProfile(lambda: delay, error_ratio=error_ratio)
+                backend.reset_counts()
+            if phase != 'cold':
+                time.sleep(HERD_TTL + 1)
+            ok, errors = herd_requests(instance.port, HERD_PATH, clients)
+            phases.append((phase, sum(b.requests for b in backends), ok, errors))
+    finally:
+        instance.stop()
+        for backend, profile in zip(backends, profiles):
+            backend.profile = profile
+    return phases
+
+
+def print_herd_report(results, clients, out=sys.stdout):
+    print >> out, '%-14s %-9s %8s %9s %7s %7s' % ('Scenario', 'Phase', 'Clients', 'Upstream', 'OK', 'Errors')
+    for scenario, phases in results:
+        for phase, upstream, ok, errors in phases:
+            print >> out, '%-14s %-9s %8d %9d %7d %7d' % (scenario.name, phase, clients, upstream, ok, errors)
+
+
+def _list(value, convert=str):
+    return [convert(v.strip()) for v in value.split(',') if v.strip()]
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Benchmarks the generated nginx configuration against "
+                                      "local stand-in Zopes.")
+    parser.add_option('--nginx', default=DEFAULT_NGINX,
+                      help="nginx binary (default %default)")
+    parser.add_option('--template', default=None,
+                      help="nginx.conf template (default: %s, else the one of this ZenPack)" % templatePath)
+    parser.add_option('--backends', type='int', default=4,
+                      help="Number of stand-in Zopes (default %default)")
+    parser.add_option('--latency', default='exp:0.01',
+                      help="Latency distribution of the stand-ins: fixed:S, uniform:MIN,MAX, "
+                           "exp:MEAN or lognormal:MEDIAN,SIGMA (default %default)")
+    parser.add_option('--slow-ratio', type='float', default=0.0,
+                      help="Share of requests taking --slow-delay longer (default %default)")
+    parser.add_option('--slow-delay', type='float', default=1.0,
+                      help="Extra seconds of slow requests (default %default)")
+    parser.add_option('--degraded', type='int', default=0,
+                      help="Number of stand-ins --degraded-factor times slower than the others (default %default)")
+    parser.add_option('--degraded-factor', type='float', default=10.0,
+                      help="Slowdown of degraded stand-ins (default %default)")
+    parser.add_option('--error-ratio', type='float', default=0.0,
+                      help="Share of requests answered with HTTP 500 (default %default)")
+    parser.add_option('--drop-ratio', type='float', default=0.0,
+                      help="Share of requests whose connection is closed without an answer (default %default)")
+    parser.add_option('--balancers', default='fair,roundrobin',
+                      help="Balancers to compare, of %s (default %%default)" % ', '.join(sorted(BALANCERS)))
+    parser.add_option('--keepalive', default='0,8',
+                      help="Upstream keepalive settings to compare (default %default)")
+    parser.add_option('--microcache', default='off',
+                      help="Micro-cache settings to compare: off, on or off,on (default %default)")
+    parser.add_option('--herd', type='int', default=0,
+                      help="Measure the static cache against a herd of this many clients instead")
+    parser.add_option('--herd-delay', type='float', default=0.5,
+                      help="Seconds the stand-ins take to answer the herd (default %default)")
+    parser.add_option('--replay', default=None,
+                      help="Access log whose GET requests are replayed instead of the built-in workload")
+    parser.add_option('-c', '--concurrency', type='int', default=32,
+                      help="Concurrent clients (default %default)")
+    parser.add_option('-n', '--requests', type='int', default=5000,
+                      help="Requests per scenario (default %default)")
+    options, args = parser.parse_args(argv)
+
+    if not os.access(options.nginx, os.X_OK):
+        print "nginx not found at %s; use --nginx" % options.nginx
+        return 1
+    try:
+        latency = parse_distribution(options.latency)
+        balancers = _list(options.balancers)
+        unknown = [b for b in balancers if b not in BALANCERS]
+        if unknown:
+            raise ValueError("unknown balancer %s" % ', '.join(unknown))
+        keepalives = _list(options.keepalive, int)
+        microcaches = [v == 'on' for v in _list(options.microcache)]
+    except ValueError as e:
+        parser.error(str(e))
+
+    template_file = options.template
+    if template_file is None:
+        template_file = templatePath if os.path.isfile(templatePath) else os.path.join(_HERE, 'nginx.conf.template')
+    template = readTemplate(template_file)
+
+    if options.replay:
+        workload = replay_workload(options.replay, options.requests)
+        if not workload:
+            print "No GET requests found in %s" % options.replay
+            return 1
+    else:
+        workload = list(DEFAULT_WORKLOAD)
+
+    if options.herd > 0:
+        backends = [StandInBackend() for i in range(options.backends)]
+        for backend in backends:
+            backend.start()
+        try:
+            results = [(scenario, run_herd(scenario, options.nginx, template, backends,
+                                           options.herd, options.herd_delay))
+                       for scenario in (HerdScenario(False), HerdScenario(True))]
+        finally:
+            for backend in backends:
+                backend.stop()
+        print_herd_report(results, options.herd)
+        return 0
+
+    backends = []
+    for i in range(options.backends):
+        profile = BackendProfile(latency, options.slow_ratio, options.slow_delay,
+                                 options.error_ratio, options.drop_ratio,
+                                 options.degraded_factor if i < options.degraded else 1.0)
+        backends.append(StandInBackend(profile=profile))
+    for backend in backends:
+        backend.start()
+    results = []
+    try:
+        for balancer in balancers:
+            for keepalive in keepalives:
+                for microcache in microcaches:
+                    scenario = Scenario(balancer, keepalive, microcache)
+                    results.append((scenario, run_scenario(scenario, options.nginx, template, backends,
+                                                           workload, options.concurrency, options.requests)))
+    finally:
+        for backend in backends:
+            backend.stop()
+    print_report(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
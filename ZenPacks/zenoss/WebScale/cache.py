@@ -0,0 +1,424 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Maintains the nginx static file cache.
+
+The cache is kept across restarts. Its keys start with a version token
+derived from the installed ZenPacks and the Zenoss version, written to
+nginx-cache-version.conf; installing or upgrading a ZenPack changes the
+token, so entries cached for the previous code are no longer used and
+expire from the cache on their own.
+
+  warm     Collects the cacheable URLs (the JS, CSS, image and document files
+           matched by the cached location in nginx.conf) either from a
+           manifest listing one URL per line or from the most requested ones
+           in the access log, and requests them through nginx so the first
+           users after a start or restart are served from the cache instead
+           of by cold Zopes.
+  version  Prints the current version token; --write updates
+           nginx-cache-version.conf.
+  purge    Removes the entries whose stored key matches a pattern, or with
+           --stale those cached under another version token.
+
+Usage: cache.py {warm|version|purge} [options]
+"""
+
+import os
+import sys
+import time
+import glob
+import hashlib
+import fnmatch
+import tempfile
+import threading
+import urllib2
+import httplib
+import socket
+from Queue import Queue, Empty
+from optparse import OptionParser
+
+from accesslog import DEFAULT_ACCESS_LOG, classify_url, parse_line
+from webserverconf import load_settings, local_url, open_local_url
+
+zenhome = os.getenv('ZENHOME', '')
+
+DEFAULT_CACHE_DIR = os.path.join(zenhome, 'var', 'nginx', 'cache')
+VERSION_CONF = os.path.join(zenhome, 'etc', 'nginx-cache-version.conf')
+
+VERSION_CONF_TMPL = """# GENERATED FILE, DO NOT MODIFY. Written by "zenwebserver configure",
+# start, restart and reload; set cache_version in zenwebserver.conf to
+# override the token.
+map $host $zenoss_cache_version {
+    default "%s";
+}
+"""
+
+# Only the end of a large access log is read
+LOG_TAIL_BYTES = 50 * 1024 * 1024
+
+# Cache files start with a binary header followed by "\nKEY: <key>\n"
+KEY_MARKER = '\nKEY: '
+KEY_READ_BYTES = 4096
+
+
+def read_manifest(path):
+    """
+    Reads a warm-up manifest: one URL path per line, '#' starts a comment.
+    """
+    urls = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                urls.append(line)
+    return urls
+
+
+def urls_from_log(path=DEFAULT_ACCESS_LOG, top=500, tail_bytes=LOG_TAIL_BYTES):
+    """
+    Returns the top most requested cacheable URLs in the access log, most
+    requested first.
+    """
+    counts = {}
+    with open(path, 'r') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size > tail_bytes:
+            f.seek(size - tail_bytes)
+            # Skip the partial first line
+            f.readline()
+        else:
+            f.seek(0)
+        for line in f:
+            record = parse_line(line)
+            if record is None or record.method != 'GET' or record.status not in (200, 304):
+                continue
+            if classify_url(record.path) == 'static':
+                counts[record.uri] = counts.get(record.uri, 0) + 1
+    ranked = sorted(counts, key=lambda uri: (-counts[uri], uri))
+    return ranked[:top]
+
+
+def compute_version():
+    """
+    Returns a token that changes whenever a ZenPack is installed, upgraded or
+    removed, or Zenoss itself is upgraded.
+    """
+    digest = hashlib.md5()
+    for entry in sorted(glob.glob(os.path.join(zenhome, 'ZenPacks', '*'))):
+        digest.update(os.path.basename(entry))
+        try:
+            digest.update(str(int(os.stat(entry).st_mtime)))
+        except OSError:
+            pass
+    try:
+        with open(os.path.join(zenhome, 'Products', 'ZenModel', 'ZVersion.py'), 'r') as f:
+            digest.update(f.read())
+    except IOError:
+        pass
+    return digest.hexdigest()[:12]
+
+
+def cache_version(config):
+    return config.get('cache_version') or compute_version()
+
+
+def write_version_conf(version, path=VERSION_CONF):
+    """
+    Writes the nginx map defining $zenoss_cache_version. Returns True if the
+    file changed.
+    """
+    content = VERSION_CONF_TMPL % version
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.nginx-cache-version')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def cache_dir(config):
+    return config.get('proxy_cache_path') or DEFAULT_CACHE_DIR
+
+
+def read_cache_key(path):
+    """
+    Returns the key stored in an nginx cache file, or None if the file has
+    none (e.g. it is still being written) or cannot be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(KEY_READ_BYTES)
+    except IOError:
+        return None
+    start = head.find(KEY_MARKER)
+    if start < 0:
+        return None
+    start += len(KEY_MARKER)
+    end = head.find('\n', start)
+    if end < 0:
+        return None
+    return head[start:end]
+
+
+def iter_cache_entries(root):
+    """
+    Yields (path, key) for every file of the levels=1:2 cache tree at root.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            key = read_cache_key(path)
+            if key is not None:
+                yield path, key
+
+
+def key_uri(key):
+    """
+    Returns the request URI part of a "$zenoss_cache_version$scheme$proxy_host$request_uri"
+    key; the parts before it never contain a slash.
+    """
+    index = key.find('/')
+    return key[index:] if index >= 0 else ''
+
+
+def purge(root, pattern=None, current_version=None):
+    """
+    Removes the cache entries whose request URI (for patterns starting with
+    '/') or whole key matches the fnmatch pattern, or, given current_version,
+    those whose key does not start with it. Returns (removed, examined).
+    """
+    removed = examined = 0
+    for path, key in iter_cache_entries(root):
+        examined += 1
+        if current_version is not None:
+            match = not key.startswith(current_version)
+        elif pattern.startswith('/'):
+            match = fnmatch.fnmatchcase(key_uri(key), pattern)
+        else:
+            match = fnmatch.fnmatchcase(key, pattern)
+        if match:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                # Removed by the nginx cache manager in the meantime
+                pass
+    return removed, examined
+
+
+class WarmResult(object):
+
+    def __init__(self, total):
+        self.total = total
+        self.fetched = 0
+        self.failed = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+        self.errors = []
+
+    @property
+    def done(self):
+        return self.fetched + self.failed
+
+
+class CacheWarmer(object):
+    """
+    Requests URLs through nginx with at most concurrency requests in flight,
+    stopping once budget seconds have passed.
+    """
+
+    def __init__(self, config, concurrency=4, budget=60.0, timeout=30.0):
+        self.config = config
+        self.concurrency = concurrency
+        self.budget = budget
+        self.timeout = timeout
+
+    def fetch(self, uri, timeout):
+        response = open_local_url(local_url(self.config, uri), timeout=timeout)
+        try:
+            # nginx only stores responses that were read completely
+            while response.read(65536):
+                pass
+        finally:
+            response.close()
+
+    def warm(self, urls, progress=None, progress_interval=5.0):
+        result = WarmResult(len(urls))
+        queue = Queue()
+        for uri in urls:
+            queue.put(uri)
+        lock = threading.Lock()
+        started = time.time()
+        deadline = started + self.budget
+
+        def worker():
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    uri = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    self.fetch(uri, max(min(self.timeout, remaining), 1))
+                except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+                    with lock:
+                        result.failed += 1
+                        result.errors.append((uri, str(e)))
+                else:
+                    with lock:
+                        result.fetched += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, min(self.concurrency, len(urls))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        last_progress = started
+        for thread in threads:
+            # join() with a timeout keeps the main thread responsive to ^C
+            while thread.is_alive():
+                thread.join(1)
+                if progress and time.time() - last_progress >= progress_interval:
+                    last_progress = time.time()
+                    progress(result)
+        result.elapsed = time.time() - started
+        result.skipped = result.total - result.done
+        return result
+
+
+def print_progress(result, out=sys.stdout):
+    print >> out, "Warmed %d of %d URLs (%d failed)" % (result.done, result.total, result.failed)
+    out.flush()
+
+
+def warm_main(argv):
+    parser = OptionParser(usage="%prog warm [options]",
+                          description="Requests the most used static files through nginx "
+                                      "to fill its cache.")
+    parser.add_option('--manifest', default=None,
+                      help="File listing the URLs to warm, one per line "
+                           "(default: cache_warm_manifest, else the access log)")
+    parser.add_option('--log', default=DEFAULT_ACCESS_LOG,
+                      help="Access log to take the most requested URLs from (default %default)")
+    parser.add_option('--top', type='int', default=None,
+                      help="Number of URLs taken from the access log (overrides cache_warm_top)")
+    parser.add_option('-j', '--parallel', dest='concurrency', type='int', default=None,
+                      help="Maximum number of requests in flight (overrides cache_warm_concurrency)")
+    parser.add_option('--budget', type='float', default=None,
+                      help="Seconds after which warming stops (overrides cache_warm_budget)")
+    parser.add_option('--if-enabled', action='store_true', default=False,
+                      help="Do nothing unless cache_warm is enabled in zenwebserver.conf")
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help="List the URLs that could not be fetched")
+    options, args = parser.parse_args(argv)
+
+    config = load_settings()
+    if options.if_enabled and not config['cache_warm']:
+        return 0
+
+    manifest = options.manifest or config['cache_warm_manifest']
+    try:
+        if manifest and os.path.isfile(manifest):
+            urls = read_manifest(manifest)
+        elif not os.path.isfile(options.log):
+            # Nothing requested since installation
+            urls = []
+        else:
+            top = options.top if options.top is not None else config['cache_warm_top']
+            urls = urls_from_log(options.log, top)
+    except IOError as e:
+        print "Unable to collect URLs to warm: %s" % e
+        return 1
+    if not urls:
+        print "No URLs to warm"
+        return 0
+
+    concurrency = options.concurrency or config['cache_warm_concurrency']
+    budget = options.budget if options.budget is not None else config['cache_warm_budget']
+    warmer = CacheWarmer(config, concurrency=concurrency, budget=budget)
+    result = warmer.warm(urls, progress=print_progress)
+    print "Warmed %d of %d URLs in %.1fs: %d failed, %d not requested within the %ds budget" % (
+        result.fetched, result.total, result.elapsed, result.failed, result.skipped, budget)
+    if options.verbose:
+        for uri, error in result.errors:
+            print "    %s: %s" % (uri, error)
+    return 0
+
+
+def version_main(argv):
+    parser = OptionParser(usage="%prog version [--write]",
+                          description="Prints the version token starting the static cache keys.")
+    parser.add_option('--write', action='store_true', default=False,
+                      help="Update %s; exits with 2 if it changed" % VERSION_CONF)
+    options, args = parser.parse_args(argv)
+    version = cache_version(load_settings())
+    print version
+    if options.write:
+        try:
+            if write_version_conf(version):
+                return 2
+        except (IOError, OSError) as e:
+            print >> sys.stderr, "Unable to write %s: %s" % (VERSION_CONF, e)
+            return 1
+    return 0
+
+
+def purge_main(argv):
+    parser = OptionParser(usage="%prog purge [--stale] [pattern]",
+                          description="Removes static cache entries. Patterns starting with '/' "
+                                      "are matched against the request URI, e.g. '/zport/dmd/*.js', "
+                                      "others against the whole cache key.")
+    parser.add_option('--stale', action='store_true', default=False,
+                      help="Remove the entries cached under another version token")
+    options, args = parser.parse_args(argv)
+    if options.stale == bool(args):
+        parser.error("give either a pattern or --stale")
+
+    config = load_settings()
+    root = cache_dir(config)
+    if options.stale:
+        removed, examined = purge(root, current_version=cache_version(config))
+    else:
+        removed, examined = purge(root, args[0])
+    print "Removed %d of %d cache entries" % (removed, examined)
+    return 0
+
+
+COMMANDS = {
+    'warm': warm_main,
+    'version': version_main,
+    'purge': purge_main,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in COMMANDS:
+        print >> sys.stderr, "Usage: cache.py {%s} [options]" % '|'.join(sorted(COMMANDS))
+        return 1
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
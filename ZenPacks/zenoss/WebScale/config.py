@@ -10,10 +10,9 @@
 
 import Globals
 import os
-import re
 from App.config import getConfiguration
 from Products.ZenUtils.Utils import zenPath
-from tempfile import NamedTemporaryFile
+from ZenPacks.zenoss.WebScale.upstream import UpstreamConf, UpstreamError, edit
 
 import logging
 log = logging.getLogger('zen.webscale.config')
@@ -103,35 +102,25 @@ class NginxConfig(object):
     Configuration class representing various parts of configuration of Nginx.
     Currently, there is only handling for the nginx-zope.conf configuration
     file (retrieiving the configured Zope instances and also removing port
-    numbers from nginx-zope.conf).
+    numbers from nginx-zope.conf), done through the model in upstream.py.
     """
 
-    _ZOPE_SERVER_PATTERN = re.compile(r'\s*server\s+(?P<server>[^\s;]+)\s*;')
-
     def __init__(self, nginx_zope_config=NGINX_ZOPE_CONFIG):
         self._nginx_zope_config = nginx_zope_config
         self._zope_servers = self._parse_nginx_zope_conf()
 
-    def _parse_server(self, line):
-        m = re.match(NginxConfig._ZOPE_SERVER_PATTERN, line)
-        if m:
-            server_parts = m.groupdict()['server'].rsplit(':', 1)
-            if len(server_parts) == 2:
-                try:
-                    return ZopeServerAddress(server_parts[0], int(server_parts[1]))
-                except ValueError:
-                    log.warning('Invalid port number: %s', server_parts[1])
-            else:
-                log.warning('Unknown server definition: %s', line)
-
     def _parse_nginx_zope_conf(self):
         servers = []
-        if os.path.isfile(self._nginx_zope_config):
-            with open(self._nginx_zope_config, 'r') as f:
-                for line in f.readlines():
-                    server = self._parse_server(line)
-                    if server:
-                        servers.append(server)
+        try:
+            conf = UpstreamConf.load(self._nginx_zope_config)
+        except UpstreamError as e:
+            log.warning('Unable to parse %s: %s', self._nginx_zope_config, e)
+            return servers
+        for name, server in conf.servers():
+            if server.port is None:
+                log.warning('Unknown server definition: %s', server.address)
+            else:
+                servers.append(ZopeServerAddress(server.address.rsplit(':', 1)[0], server.port))
         return servers
 
     def remove_zope_server_by_port(self, port):
@@ -141,24 +130,12 @@ class NginxConfig(object):
         """
         if not os.path.isfile(self._nginx_zope_config):
             return
-        etc_dir = os.path.dirname(self._nginx_zope_config)
-        dest = NamedTemporaryFile(dir=etc_dir, delete=False)
-        try:
-            with open(self._nginx_zope_config, 'r') as src:
-                modified = False
-                for line in src.readlines():
-                    server = self._parse_server(line)
-                    if server and server.port == int(port):
-                        log.info("Removing server with port: %s", port)
-                        modified = True
-                    else:
-                        dest.write(line)
-                dest.close()
-                if modified:
-                    os.rename(dest.name, self._nginx_zope_config)
-        finally:
-            if os.path.exists(dest.name):
-                os.remove(dest.name)
+        with edit(self._nginx_zope_config) as conf:
+            for name, server in conf.servers():
+                if server.port == int(port):
+                    log.info("Removing server with port: %s", port)
+                    conf.remove_server(server.address)
+        self._zope_servers = self._parse_nginx_zope_conf()
 
     @property
     def zope_servers(self):
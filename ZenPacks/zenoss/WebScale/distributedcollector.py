@@ -9,13 +9,21 @@
 
 
 import os
-from subprocess import check_output, CalledProcessError
+import re
+import glob
+import time
+import tempfile
+import threading
+import transaction
+from subprocess import check_output, CalledProcessError, STDOUT
+from AccessControl import getSecurityManager
 from zope.interface import implements
 from zope.component import adapts
 from Products.ZenUtils.Utils import zenPath
 from ZenPacks.zenoss.DistributedCollector.DCUtils import CollectorConfFactory, HubConfFactory
 from ZenPacks.zenoss.DistributedCollector.interfaces import IRemoteRenderUrlProvider
-from Products.ZenWidgets.messaging import IMessageSender, WARNING
+from Products.ZenWidgets.messaging import IMessageSender, INFO, WARNING
+from ZenPacks.zenoss.WebScale.webserverconf import load_settings
 
 import logging
 log = logging.getLogger("zen.webscale_dc")
@@ -48,94 +56,302 @@ class WebScaleHubRenderUrlProvider(object):
 
 
 def onCollectorInstalled(ob, event):
-    errorMsg = _reconfigureNginx(ob.id, ob.hostname, _COLLECTOR_TYPE)
+    errorMsg = _reconfigureNginx(ob, _COLLECTOR_TYPE)
     if errorMsg:
         IMessageSender(ob).sendToBrowser('Error', errorMsg, WARNING)
 
 def onCollectorDeleted(ob, event):
-    filePath = _dcNginxConfPath(ob.id, _COLLECTOR_TYPE)
-    try:
-        os.remove(filePath)
-    except Exception:
-        pass
+    _removeDcConf(ob, _COLLECTOR_TYPE)
 
 def onCollectorUpdated(ob, event):
     changes = event.propertyChanges
     if changes.has_key('hostname') or changes.has_key('renderurl') :
-        errorMsg = _reconfigureNginx(ob.id, ob.hostname, _COLLECTOR_TYPE)
+        errorMsg = _reconfigureNginx(ob, _COLLECTOR_TYPE)
         if errorMsg:
             IMessageSender(ob).sendToBrowser('Error', errorMsg, WARNING)
 
 def onHubInstalled(ob, event):
-    errorMsg = _reconfigureNginx(ob.id, ob.hostname, _HUB_TYPE)
+    errorMsg = _reconfigureNginx(ob, _HUB_TYPE)
     if errorMsg:
         IMessageSender(ob).sendToBrowser('Error', errorMsg, WARNING)
 
 def onHubDeleted(ob, event):
-    filePath = _dcNginxConfPath(ob.id, _HUB_TYPE)
-    try:
-        os.remove(filePath)
-    except Exception:
-        pass
+    _removeDcConf(ob, _HUB_TYPE)
 
 def onHubUpdated(ob, event):
     changes = event.propertyChanges
     if changes.has_key('hostname') or changes.has_key('renderurl') :
-        errorMsg = _reconfigureNginx(ob.id, ob.hostname, _HUB_TYPE)
+        errorMsg = _reconfigureNginx(ob, _HUB_TYPE)
         if errorMsg:
             IMessageSender(ob).sendToBrowser('Error', errorMsg, WARNING)
 
 
 
-def _reconfigureNginx(id, host, dctype):
+def _reconfigureNginx(ob, dctype):
     errorMsg = None
     try:
-        #overwrite nginx conf for this collector
-        _writeDcConf(id, host, dctype)
+        #rebuild the routing table with this collector's current host
+        routes = _dcInventory(ob.getDmd())
+        routes[(dctype, ob.id)] = ob.hostname
+        _writeDcRoutes(routes)
     except Exception as e:
-        errorMsg = "Could not write Nginx configuration for collector %s: %s" % (id , e)
+        errorMsg = "Could not write Nginx configuration for collector %s: %s" % (ob.id , e)
         log.warn(errorMsg)
     else:
-        #reload nginx config
-        try:
-            _reloadNginxConf()
-        except CalledProcessError as cpe:
-            errorMsg = cpe.output
-        except Exception as e:
-            errorMsg = "Could not reload Nginx configuration: %s" % str(e)
-            log.warn(errorMsg)
+        #reload nginx config in the background, together with other changes
+        _reloadQueue.request(ob, '%s %s' % (dctype, ob.id))
     return errorMsg
 
-_NGINX_CONF_TMPL = """
-location ^~ /remote-{collectorType}/{collectorId}/ {{
-    rewrite ^/remote-{collectorType}/{collectorId}/(.*)$ /$1 break;
-    proxy_pass http://{collectorHost}:{collectorPort};
+def _removeDcConf(ob, dctype):
+    try:
+        #the object may still be found in its container
+        routes = _dcInventory(ob.getDmd())
+        routes.pop((dctype, ob.id), None)
+        _writeDcRoutes(routes)
+    except Exception as e:
+        log.warn("Could not remove %s %s from the Nginx configuration: %s", dctype, ob.id, e)
+    else:
+        _reloadQueue.request(ob, '%s %s' % (dctype, ob.id))
+
+def rebuildRemoteRoutes(dmd):
+    """
+    Writes the routing table for all remote collectors and hubs.
+    """
+    _writeDcRoutes(_dcInventory(dmd))
+
+
+class _NginxReloadQueue(object):
+    """
+    Coalesces the nginx reloads requested by collector and hub changes.
+
+    Requests are collected until none has arrived for dc_reload_window
+    seconds (zenwebserver.conf, at most maxDelay seconds after the first),
+    then a background thread runs one verified "zenwebserver reload" for
+    all of them and reports the outcome to the users who made the changes,
+    so bulk changes cost a single reload and never hold up a request.
+    """
+
+    def __init__(self, maxDelay=60.0):
+        self.maxDelay = maxDelay
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = []
+        self._firstRequest = None
+        self._lastRequest = None
+        self._thread = None
+
+    def request(self, ob, description):
+        try:
+            db = ob.getDmd()._p_jar.db()
+        except Exception:
+            db = None
+        username = getSecurityManager().getUser().getId()
+        with self._lock:
+            now = time.time()
+            if not self._pending:
+                self._firstRequest = now
+            self._lastRequest = now
+            self._pending.append((db, username, description))
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(target=self._run, name='zenwebserver-reload')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def _window(self):
+        return max(load_settings()['dc_reload_window'], 0.0)
+
+    def _next(self):
+        """
+        Waits for a batch of requests that is due for a reload.
+        """
+        window = self._window()
+        with self._lock:
+            while True:
+                if self._pending:
+                    due = min(self._lastRequest + window, self._firstRequest + self.maxDelay)
+                    now = time.time()
+                    if now >= due:
+                        break
+                    self._wakeup.wait(due - now)
+                else:
+                    self._wakeup.wait()
+            batch, self._pending = self._pending, []
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next()
+            try:
+                _reloadNginxConf()
+            except CalledProcessError as cpe:
+                errorMsg = cpe.output or str(cpe)
+            except Exception as e:
+                errorMsg = "Could not reload Nginx configuration: %s" % str(e)
+            else:
+                errorMsg = None
+            changes = ', '.join(sorted(set(description for db, username, description in batch)))
+            if errorMsg:
+                log.warn("Nginx reload for %s failed: %s", changes, errorMsg)
+            else:
+                log.info("Nginx reloaded for %s", changes)
+            try:
+                self._report(batch, errorMsg)
+            except Exception:
+                log.exception("Unable to report the Nginx reload result")
+
+    def _report(self, batch, errorMsg):
+        users = {}
+        for db, username, description in batch:
+            if db is not None and username:
+                users.setdefault((db, username), set()).add(description)
+        for (db, username), descriptions in users.items():
+            changes = ', '.join(sorted(descriptions))
+            if errorMsg:
+                title, body, priority = 'Error', 'Could not reload Nginx configuration for %s: %s' % (changes, errorMsg), WARNING
+            else:
+                title, body, priority = 'Nginx reloaded', 'Remote graph routes updated for %s' % changes, INFO
+            # The requests that queued the reload are long finished, so use
+            # a connection of our own
+            conn = db.open()
+            try:
+                dmd = conn.root()['Application'].zport.dmd
+                IMessageSender(dmd).sendToUser(title, body, priority, user=username)
+                transaction.commit()
+            except Exception:
+                transaction.abort()
+                raise
+            finally:
+                conn.close()
+
+_reloadQueue = _NginxReloadQueue()
 
-    proxy_read_timeout 600s;
-    client_max_body_size 500m;
-    proxy_set_header        Host    $host;
-    proxy_set_header        X-Real-IP $remote_addr;
-    proxy_set_header        X-Forwarded-For $proxy_add_x_forwarded_for;
+# Remote collectors and hubs are reached through one location looking up
+# their upstream in a map, rather than through a location per collector.
+# The map and the upstreams, which keep idle connections to the collectors
+# open, are included at http level; the locations, one per type so that
+# collectors and hubs can cache renders differently, at server level.
+_DC_ROUTES_CONF = 'nginx-dc-routes.conf'
+_DC_UPSTREAMS_CONF = 'nginx-remote-upstreams.conf'
+_DC_LEGACY_CONFS = ('nginx-dc-collector-*.conf', 'nginx-dc-hub-*.conf')
+
+_DC_GENERATED = """# GENERATED FILE, DO NOT MODIFY. Rebuilt from the remote collectors and hubs
+# whenever one of them is installed, updated or deleted.
+"""
+
+_DC_ROUTES_TMPL = _DC_GENERATED + """
+location ^~ /remote- {{
+{locations}}}
+"""
+
+# The render cache settings of a type are written by "zenwebserver
+# configure"; the wildcard lets nginx start before they exist.
+_DC_ROUTE_TMPL = """
+    location ~ ^/remote-(?<zenoss_dc_route>{dctype}/[^/]+)/ {{
+        if ($zenoss_dc_upstream = "") {{
+            return 404;
+        }}
+        rewrite ^/remote-[^/]+/[^/]+/(.*)$ /$1 break;
+        proxy_pass http://$zenoss_dc_upstream;
+
+        proxy_http_version 1.1;
+        proxy_set_header        Connection "";
+        proxy_read_timeout 600s;
+        client_max_body_size 500m;
+        proxy_set_header        Host    $host;
+        proxy_set_header        X-Real-IP $remote_addr;
+        proxy_set_header        X-Forwarded-For $proxy_add_x_forwarded_for;
+
+        include {renderCacheConf};
     }}
 """
 
-def _writeDcConf(id, host, dctype):
-    port =_ZENRENDER_PORT
-    if dctype == _HUB_TYPE:
-        port = _HUBZENRENDER_PORT
-    confValues = {'collectorType': dctype,
-                  'collectorId': id,
-                  'collectorHost': host,
-                  'collectorPort': port}
-    conf = _NGINX_CONF_TMPL.format(**confValues)
-    filePath = _dcNginxConfPath(id, dctype)
-    with open(filePath, 'w') as confFile:
-        confFile.write(conf)
-
-def _dcNginxConfPath(id, dctype):
-    confName = 'nginx-dc-{dctype}-{collectorId}.conf'.format(dctype=dctype, collectorId=id)
-    filePath = zenPath('etc', confName)
-    return filePath
+_DC_MAP_TMPL = """
+map_hash_max_size {hashMaxSize};
+map_hash_bucket_size {hashBucketSize};
+
+map $zenoss_dc_route $zenoss_dc_upstream {{
+    default "";
+{entries}}}
+"""
+
+_DC_UPSTREAM_TMPL = """
+upstream {upstream} {{
+    server {collectorHost}:{collectorPort};
+    keepalive {keepalive};
+}}
+"""
+
+def _dcInventory(dmd):
+    """
+    Returns {(type, id): hostname} for the remote collectors and hubs.
+    """
+    routes = {}
+    for dctype, containerId in ((_COLLECTOR_TYPE, 'Performance'), (_HUB_TYPE, 'Hub')):
+        container = getattr(dmd.Monitors, containerId, None)
+        if container is None:
+            continue
+        for conf in container.objectValues():
+            hostname = getattr(conf, 'hostname', None)
+            # The local collector and hub are not reached through nginx
+            if hostname and conf.id != 'localhost':
+                routes[(dctype, conf.id)] = hostname
+    return routes
+
+def _dcUpstreamName(dctype, id, used):
+    name = 'zenoss_dc_%s_%s' % (dctype, re.sub(r'[^A-Za-z0-9_.-]', '_', id))
+    unique, count = name, 1
+    while unique in used:
+        count += 1
+        unique = '%s_%d' % (name, count)
+    used.add(unique)
+    return unique
+
+def _renderDcUpstreams(routes, keepalive):
+    used = set()
+    entries = []
+    upstreams = []
+    for dctype, id in sorted(routes):
+        port = _ZENRENDER_PORT
+        if dctype == _HUB_TYPE:
+            port = _HUBZENRENDER_PORT
+        upstream = _dcUpstreamName(dctype, id, used)
+        entries.append('    "%s/%s" %s;\n' % (dctype, id.replace('"', '\\"'), upstream))
+        upstreams.append(_DC_UPSTREAM_TMPL.format(upstream=upstream,
+                                                  collectorHost=routes[(dctype, id)],
+                                                  collectorPort=port,
+                                                  keepalive=keepalive))
+    longest = max([len('%s/%s' % key) for key in routes] or [0])
+    hashBucketSize = 64
+    while hashBucketSize < longest + 16:
+        hashBucketSize *= 2
+    return _DC_GENERATED + _DC_MAP_TMPL.format(hashMaxSize=max(2048, 4 * len(routes)),
+                                               hashBucketSize=hashBucketSize,
+                                               entries=''.join(entries)) + ''.join(upstreams)
+
+def _atomicWrite(filePath, content):
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(filePath), prefix='.' + os.path.basename(filePath))
+    try:
+        with os.fdopen(fd, 'w') as confFile:
+            confFile.write(content)
+        os.chmod(tmpPath, 0644)
+        os.rename(tmpPath, filePath)
+    except:
+        os.remove(tmpPath)
+        raise
+
+def _writeDcRoutes(routes):
+    keepalive = load_settings()['dc_keepalive']
+    # The upstreams first, as the routes refer to them
+    _atomicWrite(zenPath('etc', _DC_UPSTREAMS_CONF), _renderDcUpstreams(routes, keepalive))
+    locations = ''.join(_DC_ROUTE_TMPL.format(dctype=dctype,
+                                              renderCacheConf=zenPath('etc', 'nginx-render-cache-%s*.conf' % dctype))
+                        for dctype in (_COLLECTOR_TYPE, _HUB_TYPE))
+    _atomicWrite(zenPath('etc', _DC_ROUTES_CONF), _DC_ROUTES_TMPL.format(locations=locations))
+    for pattern in _DC_LEGACY_CONFS:
+        for filePath in glob.glob(zenPath('etc', pattern)):
+            os.remove(filePath)
 
 def _reloadNginxConf():
-    return check_output([zenPath('bin','zenwebserver'), ' reload'])
+    # reload checks the configuration with nginx -t first
+    return check_output([zenPath('bin','zenwebserver'), 'reload'], stderr=STDOUT)
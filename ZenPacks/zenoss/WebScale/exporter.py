@@ -0,0 +1,453 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Metrics exporter for the load balancer and the Zope server pool.
+
+Polls the nginx stub_status page and tails the access log every interval,
+and serves the results at http://<exporter_address>:<exporter_port>/metrics
+in the Prometheus text exposition format:
+
+ - the stub_status connection and request counters
+ - request counts by status class and latency histograms per upstream
+   Zope, per URL class and per remote collector or hub listed in
+   nginx-remote-upstreams.conf
+ - resident memory and CPU time of every Zope, read via its Z2.pid file
+ - the number of configured and running Zopes and the average requests in
+   flight per running Zope, a measure of pool saturation: the upstream
+   response times of its requests per second of the interval (Little's law)
+
+Counters start at zero when the exporter starts and only grow, as
+Prometheus expects; rotated access logs are followed.
+
+Usage: zenwebserver exporter {run|start|stop|status} [options]
+"""
+
+import os
+import re
+import sys
+import time
+import signal
+import logging
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+
+from accesslog import LogTailer, parse_line, classify_url
+from pool import instances
+from procutil import pid_alive, pid_rss_kb, pid_cpu_seconds
+from stubstatus import fetch_stub_status
+from webserverconf import load_settings, local_url
+
+log = logging.getLogger('zen.webscale.exporter')
+
+zenhome = os.getenv('ZENHOME', '')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Written by the DistributedCollector integration; its map lists the routes
+REMOTE_UPSTREAMS_CONF = os.path.join(zenhome, 'etc', 'nginx-remote-upstreams.conf')
+
+_ROUTE_PATTERN = re.compile(r'^/remote-(collector|hub)/([^/]+)/')
+_ROUTE_ENTRY = re.compile(r'^\s*"(collector|hub)/((?:[^"\\]|\\.)*)"\s+\S+;')
+
+
+class KnownRoutes(object):
+    """
+    The (type, id) routes of the remote collectors and hubs, read from
+    nginx-remote-upstreams.conf again whenever it changes. Only these are
+    counted, as the id of any other request path comes from the client and
+    would add a label value per path.
+    """
+
+    def __init__(self, path=REMOTE_UPSTREAMS_CONF):
+        self.path = path
+        self._stamp = None
+        self._routes = frozenset()
+
+    def routes(self):
+        try:
+            st = os.stat(self.path)
+            stamp = st.st_ino, st.st_mtime, st.st_size
+        except OSError:
+            stamp = None
+        if stamp != self._stamp:
+            routes = set()
+            if stamp is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        for line in f:
+                            m = _ROUTE_ENTRY.match(line)
+                            if m:
+                                routes.add((m.group(1), m.group(2).replace('\\"', '"')))
+                except IOError:
+                    pass
+            self._stamp = stamp
+            self._routes = frozenset(routes)
+        return self._routes
+
+    def __contains__(self, route):
+        return route in self.routes()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Histogram(object):
+    """
+    Cumulative latency histogram with the fixed BUCKETS bounds.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """
+        Yields the (name, labels, value) samples of the histogram.
+        """
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', _number(bound)),), cumulative
+        yield name + '_bucket', labels + (('le', '+Inf'),), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class MetricFamily(object):
+    """
+    Samples of one metric name, rendered with their HELP and TYPE lines.
+    """
+
+    def __init__(self, name, type, help):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.samples = []
+
+    def add(self, labels, value, name=None):
+        self.samples.append((name or self.name, tuple(labels), value))
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labels, value in self.samples:
+            lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class AccessLogMetrics(object):
+    """
+    Request counters and latency histograms accumulated from access log
+    records, per upstream server, URL class and known remote route.
+    """
+
+    def __init__(self, known_routes=None):
+        self.known_routes = known_routes if known_routes is not None else KnownRoutes()
+        self.upstream_requests = {}
+        self.upstream_latency = {}
+        self.class_requests = {}
+        self.class_latency = {}
+        self.route_requests = {}
+        self.route_latency = {}
+        self.lines = 0
+        self.skipped = 0
+
+    @staticmethod
+    def _count(table, key):
+        table[key] = table.get(key, 0) + 1
+
+    @staticmethod
+    def _observe(table, key, value):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram()
+        histogram.observe(value)
+
+    def add(self, record):
+        status = '%dxx' % (record.status // 100)
+        for addr, seconds in record.upstreams:
+            self._count(self.upstream_requests, (addr, status))
+            self._observe(self.upstream_latency, addr, seconds)
+        url_class = classify_url(record.path)
+        self._count(self.class_requests, (url_class, status))
+        if record.request_time is not None:
+            self._observe(self.class_latency, url_class, record.request_time)
+        m = _ROUTE_PATTERN.match(record.path)
+        if m and (m.group(1), m.group(2)) in self.known_routes:
+            route = m.group(1), m.group(2)
+            self._count(self.route_requests, route + (status,))
+            if record.request_time is not None:
+                self._observe(self.route_latency, route, record.request_time)
+
+    def feed(self, lines):
+        for line in lines:
+            if not line:
+                continue
+            self.lines += 1
+            record = parse_line(line)
+            if record is None:
+                self.skipped += 1
+            else:
+                self.add(record)
+
+    def upstream_seconds(self, addresses):
+        """
+        Returns the total upstream response time of the addresses so far.
+        """
+        return sum(h.sum for addr, h in self.upstream_latency.items() if addr in addresses)
+
+    def families(self):
+        requests = MetricFamily('zenwebserver_upstream_requests_total', 'counter',
+                                'Requests passed to an upstream server, by response status class.')
+        for (addr, status), count in sorted(self.upstream_requests.items()):
+            requests.add((('upstream', addr), ('status', status)), count)
+        latency = MetricFamily('zenwebserver_upstream_response_seconds', 'histogram',
+                               'Upstream response time per upstream server.')
+        for addr, histogram in sorted(self.upstream_latency.items()):
+            for sample in histogram.samples(latency.name, (('upstream', addr),)):
+                latency.add(sample[1], sample[2], sample[0])
+
+        class_requests = MetricFamily('zenwebserver_requests_total', 'counter',
+                                      'Requests by URL class and response status class.')
+        for (url_class, status), count in sorted(self.class_requests.items()):
+            class_requests.add((('class', url_class), ('status', status)), count)
+        class_latency = MetricFamily('zenwebserver_request_seconds', 'histogram',
+                                     'Request time per URL class.')
+        for url_class, histogram in sorted(self.class_latency.items()):
+            for sample in histogram.samples(class_latency.name, (('class', url_class),)):
+                class_latency.add(sample[1], sample[2], sample[0])
+
+        route_requests = MetricFamily('zenwebserver_remote_requests_total', 'counter',
+                                      'Requests to remote collectors and hubs, by response status class.')
+        for (type, id, status), count in sorted(self.route_requests.items()):
+            route_requests.add((('type', type), ('id', id), ('status', status)), count)
+        route_latency = MetricFamily('zenwebserver_remote_request_seconds', 'histogram',
+                                     'Request time per remote collector or hub.')
+        for (type, id), histogram in sorted(self.route_latency.items()):
+            for sample in histogram.samples(route_latency.name, (('type', type), ('id', id))):
+                route_latency.add(sample[1], sample[2], sample[0])
+
+        lines = MetricFamily('zenwebserver_access_log_lines_total', 'counter',
+                             'Access log lines read, by whether they could be parsed.')
+        lines.add((('result', 'parsed'),), self.lines - self.skipped)
+        lines.add((('result', 'unrecognized'),), self.skipped)
+        return [requests, latency, class_requests, class_latency, route_requests, route_latency, lines]
+
+
+def pool_families(configured, in_flight=None):
+    """
+    Returns the metric families of the Zope pool, given its instances and
+    the average number of requests the Zopes were answering at once over
+    the last interval (None if not known yet).
+    """
+    up = MetricFamily('zenwebserver_zope_up', 'gauge', 'Whether the Zope is running.')
+    rss = MetricFamily('zenwebserver_zope_resident_memory_bytes', 'gauge', 'Resident memory of the Zope.')
+    cpu = MetricFamily('zenwebserver_zope_cpu_seconds_total', 'counter', 'User and system CPU time of the Zope.')
+    running = 0
+    for instance in configured:
+        labels = (('zope', instance.num), ('port', instance.port))
+        pid = instance.pid
+        alive = pid_alive(pid)
+        up.add(labels, 1 if alive else 0)
+        if not alive:
+            continue
+        running += 1
+        rss_kb = pid_rss_kb(pid)
+        if rss_kb is not None:
+            rss.add(labels, rss_kb * 1024)
+        seconds = pid_cpu_seconds(pid)
+        if seconds is not None:
+            cpu.add(labels, seconds)
+
+    servers = MetricFamily('zenwebserver_pool_servers', 'gauge', 'Zopes of the pool by state.')
+    servers.add((('state', 'configured'),), len(configured))
+    servers.add((('state', 'running'),), running)
+    per_server = MetricFamily('zenwebserver_pool_requests_in_flight_per_server', 'gauge',
+                              'Average requests being answered per running Zope over the last interval, '
+                              'from their upstream response times; the pool is saturated near the '
+                              'threads of a Zope.')
+    if in_flight is not None:
+        per_server.add((), in_flight / running if running else in_flight)
+    return [up, rss, cpu, servers, per_server]
+
+
+_STUB_METRICS = (
+    ('active', 'zenwebserver_nginx_connections_active', 'gauge', 'Open client connections.'),
+    ('reading', 'zenwebserver_nginx_connections_reading', 'gauge', 'Connections reading a request.'),
+    ('writing', 'zenwebserver_nginx_connections_writing', 'gauge', 'Connections writing a response.'),
+    ('waiting', 'zenwebserver_nginx_connections_waiting', 'gauge', 'Idle keepalive connections.'),
+    ('accepts', 'zenwebserver_nginx_connections_accepted_total', 'counter', 'Client connections accepted.'),
+    ('handled', 'zenwebserver_nginx_connections_handled_total', 'counter', 'Client connections handled.'),
+    ('requests', 'zenwebserver_nginx_requests_total', 'counter', 'Client requests.'),
+)
+
+
+def nginx_families(status):
+    up = MetricFamily('zenwebserver_nginx_up', 'gauge', 'Whether the nginx stub_status page could be read.')
+    up.add((), 0 if status is None else 1)
+    families = [up]
+    if status is not None:
+        for field, name, type, help in _STUB_METRICS:
+            family = MetricFamily(name, type, help)
+            family.add((), getattr(status, field))
+            families.append(family)
+    return families
+
+
+class Exporter(object):
+    """
+    Collects the metrics every interval seconds; render() returns the last
+    collected ones.
+    """
+
+    def __init__(self, status_url, interval=15, access_log=None):
+        self.status_url = status_url
+        self.interval = interval
+        self._tailer = LogTailer(access_log) if access_log else LogTailer()
+        self._log_metrics = AccessLogMetrics()
+        # Time and total Zope response time of the previous collection
+        self._last = None
+        self._lock = threading.Lock()
+        self._text = ''
+        self._running = False
+
+    def collect(self):
+        started = time.time()
+        status = fetch_stub_status(self.status_url)
+        self._log_metrics.feed(self._tailer.read_lines())
+        configured = instances()
+        busy = self._log_metrics.upstream_seconds(set(instance.address for instance in configured))
+        in_flight = None
+        if self._last is not None:
+            in_flight = max(busy - self._last[1], 0.0) / max(started - self._last[0], 1.0)
+        self._last = started, busy
+        families = nginx_families(status)
+        families.extend(self._log_metrics.families())
+        families.extend(pool_families(configured, in_flight))
+        duration = MetricFamily('zenwebserver_exporter_collect_seconds', 'gauge',
+                                'Time taken by the last collection.')
+        duration.add((), time.time() - started)
+        families.append(duration)
+        text = ''.join(family.render() for family in families)
+        with self._lock:
+            self._text = text
+
+    def render(self):
+        with self._lock:
+            return self._text
+
+    def stop(self, *args):
+        self._running = False
+
+    def run(self):
+        self._running = True
+        # Position the log tailer; only requests from now on are counted
+        self._tailer.read_lines()
+        while self._running:
+            try:
+                self.collect()
+            except Exception:
+                log.exception("Collecting metrics failed")
+            deadline = time.time() + self.interval
+            while self._running and time.time() < deadline:
+                time.sleep(min(1, deadline - time.time()))
+        self._tailer.close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.exporter.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exporter):
+        HTTPServer.__init__(self, address, _MetricsHandler)
+        self.exporter = exporter
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Serves load balancer and Zope pool metrics for Prometheus. "
+                                      "Settings are read from the exporter_* options in "
+                                      "zenwebserver.conf.")
+    parser.add_option('--access-log', default=None,
+                      help="Access log to tail")
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help="Log every scrape")
+    options, args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    config = load_settings()
+    exporter = Exporter(local_url(config, '/nginx_status'),
+                        interval=config['exporter_interval'],
+                        access_log=options.access_log)
+    address = (config['exporter_address'], config['exporter_port'])
+    server = MetricsServer(address, exporter)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    signal.signal(signal.SIGTERM, exporter.stop)
+    signal.signal(signal.SIGINT, exporter.stop)
+    log.info("Serving metrics at http://%s:%d/metrics, collected every %ds",
+             address[0], address[1], exporter.interval)
+    exporter.run()
+    server.shutdown()
+    log.info("Exporter stopped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
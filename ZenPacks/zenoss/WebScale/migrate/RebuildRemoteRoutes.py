@@ -0,0 +1,35 @@
+##############################################################################
+# 
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+# 
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+# 
+##############################################################################
+
+
+import logging
+
+log = logging.getLogger("zen.migrate")
+
+import Globals
+from Products.ZenModel.migrate.Migrate import Version
+from Products.ZenModel.ZenPack import ZenPackMigration
+
+class RebuildRemoteRoutes(ZenPackMigration):
+    """
+    Replaces the nginx-dc-<type>-<id>.conf files of earlier versions with
+    the consolidated routing table of the remote collectors and hubs.
+    """
+    version = Version(1, 2, 1)
+
+    def migrate(self, dmd):
+        try:
+            from ZenPacks.zenoss.WebScale.distributedcollector import rebuildRemoteRoutes
+        except ImportError:
+            # DistributedCollector is not installed
+            return
+        log.info("Writing the routing table of the remote collectors and hubs")
+        rebuildRemoteRoutes(dmd)
+
+RebuildRemoteRoutes()
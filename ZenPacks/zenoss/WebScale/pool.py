@@ -0,0 +1,474 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Lifecycle operations on the Zope instances of the zenwebserver pool.
+
+Starts, stops or restarts the instances configured in $ZENHOME/etc/zope
+with up to a given number of zopectl invocations running at once, and
+prints a report of the result of every instance.
+
+restart --rolling restarts the instances one at a time, each detached
+from the load balancer and drained first, see RollingRestart. retire
+stops instances leaving the pool the same way, detached and drained
+first, see retire().
+
+Usage: zenwebserver {start|stop|restart} -j N [targets]
+       zenwebserver restart --rolling [targets]
+       pool.py retire -j N [server numbers]
+"""
+
+import os
+import re
+import sys
+import time
+import glob
+import threading
+import subprocess
+from Queue import Queue, Empty
+from optparse import OptionParser
+
+from procutil import read_pidfile, pid_alive, port_connections
+from upstream import UpstreamConf, edit
+from webserverconf import load_settings
+
+zenhome = os.getenv('ZENHOME', '')
+
+ZOPECTL = os.path.join(zenhome, 'bin', 'zopectl')
+ZOPE_CONF = os.path.join(zenhome, 'etc', 'zope.conf')
+ZOPE_CONFIG_DIR = os.path.join(zenhome, 'etc', 'zope')
+
+DEFAULT_BASE_PORT = 8080
+
+_ADDRESS_PATTERN = re.compile(r'^\s*address\s+(\d+)\s*$')
+
+
+def zope_base_port(zope_conf=ZOPE_CONF):
+    """
+    Returns the HTTP port of zope.conf, on which the instance ports are based.
+    """
+    try:
+        with open(zope_conf, 'r') as f:
+            for line in f:
+                m = _ADDRESS_PATTERN.match(line)
+                if m:
+                    return int(m.group(1))
+    except IOError:
+        pass
+    return DEFAULT_BASE_PORT
+
+
+class ZopeInstance(object):
+    """
+    A Zope instance of the pool, identified by its number.
+    """
+
+    def __init__(self, num, base_port=DEFAULT_BASE_PORT):
+        self.num = int(num)
+        self.config_file = os.path.join(ZOPE_CONFIG_DIR, 'zope%d.conf' % self.num)
+        self.var_dir = os.path.join(zenhome, 'var', 'zope%d' % self.num)
+        self.pidfile = os.path.join(self.var_dir, 'Z2.pid')
+        self.port = base_port + 1000 + self.num
+
+    def __repr__(self):
+        return "ZopeInstance<num=%d,port=%d>" % (self.num, self.port)
+
+    @property
+    def address(self):
+        # As listed in nginx-zope.conf
+        return '127.0.0.1:%d' % self.port
+
+    @property
+    def pid(self):
+        return read_pidfile(self.pidfile)
+
+    def is_running(self):
+        return pid_alive(self.pid)
+
+    def zopectl(self, *args):
+        """
+        Runs zopectl for this instance. Returns (exit code, output).
+        """
+        env = dict(os.environ, CONFIG_FILE=self.config_file)
+        with open(os.devnull, 'r') as devnull:
+            proc = subprocess.Popen([ZOPECTL] + list(args), env=env, stdin=devnull,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+        return proc.returncode, output.strip()
+
+
+def instances(nums=None, base_port=None):
+    """
+    Returns the configured instances, optionally limited to the given numbers.
+    """
+    if base_port is None:
+        base_port = zope_base_port()
+    found = []
+    for path in glob.glob(os.path.join(ZOPE_CONFIG_DIR, 'zope*.conf')):
+        try:
+            found.append(int(os.path.basename(path)[4:-5]))
+        except ValueError:
+            pass
+    if nums:
+        found = [num for num in found if num in set(int(n) for n in nums)]
+    return [ZopeInstance(num, base_port) for num in sorted(found)]
+
+
+class OperationResult(object):
+    """
+    Outcome of a lifecycle operation on one instance.
+    """
+
+    def __init__(self, instance, action, status, retcode=0, output='', elapsed=0.0):
+        self.instance = instance
+        self.action = action
+        # 'OK', 'FAIL' or 'SKIPPED' (already in the requested state)
+        self.status = status
+        self.retcode = retcode
+        self.output = output
+        self.elapsed = elapsed
+
+    @property
+    def failed(self):
+        return self.status == 'FAIL'
+
+
+def start_instance(instance):
+    if instance.is_running():
+        return 'SKIPPED', 0, 'already running'
+    retcode, output = instance.zopectl('start')
+    return ('OK' if retcode == 0 else 'FAIL'), retcode, output
+
+
+def stop_instance(instance):
+    if not instance.is_running():
+        return 'SKIPPED', 0, 'already stopped'
+    retcode, output = instance.zopectl('stop')
+    return ('OK' if retcode == 0 else 'FAIL'), retcode, output
+
+
+def restart_instance(instance):
+    if instance.is_running():
+        retcode, output = instance.zopectl('stop')
+        if retcode != 0:
+            return 'FAIL', retcode, output
+    retcode, output = instance.zopectl('start')
+    return ('OK' if retcode == 0 else 'FAIL'), retcode, output
+
+
+ACTIONS = {
+    'start': start_instance,
+    'stop': stop_instance,
+    'restart': restart_instance,
+}
+
+
+def run_parallel(action, targets, concurrency):
+    """
+    Applies action to every target instance, with at most concurrency
+    operations in progress at once. Returns the OperationResults in the order
+    of targets.
+    """
+    operation = ACTIONS[action]
+    queue = Queue()
+    for index, instance in enumerate(targets):
+        queue.put((index, instance))
+    results = [None] * len(targets)
+
+    def worker():
+        while True:
+            try:
+                index, instance = queue.get_nowait()
+            except Empty:
+                return
+            started = time.time()
+            try:
+                status, retcode, output = operation(instance)
+            except Exception as e:
+                status, retcode, output = 'FAIL', -1, str(e)
+            results[index] = OperationResult(instance, action, status, retcode,
+                                             output, time.time() - started)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(concurrency, len(targets))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join() with a timeout keeps the main thread responsive to ^C
+        while thread.is_alive():
+            thread.join(1)
+    return results
+
+
+class RollingRestart(object):
+    """
+    Restarts instances one at a time without sending requests to a Zope
+    that is going down: each one is detached from its upstream in
+    nginx-zope.conf and nginx is reloaded, its in-flight requests are given
+    up to drain_timeout seconds to complete, and it is restarted, probed for
+    readiness and attached again with its previous parameters. An instance
+    is only taken out while at least min_live other instances of its
+    upstream stay attached and running. A restart that does not become
+    ready leaves its instance detached and stops the roll.
+    """
+
+    def __init__(self, min_live=1, drain_timeout=60, probe=None, out=sys.stdout):
+        self.min_live = min_live
+        self.drain_timeout = drain_timeout
+        self.probe = probe
+        self.out = out
+
+    def _say(self, message):
+        print >> self.out, message
+        self.out.flush()
+
+    def _reload(self):
+        from zenwebserverconfig import nginxRunning, reloadNginx
+        if not nginxRunning():
+            return
+        ok, output = reloadNginx()
+        if not ok:
+            raise RuntimeError("Could not reload nginx: %s" % output.strip())
+
+    def _live(self, upstream, running):
+        """
+        Returns the number of running instances attached to upstream.
+        """
+        conf = UpstreamConf.load()
+        block = conf.upstream(upstream)
+        if block is None:
+            return 0
+        ports = set(server.port for server in block.servers)
+        return len([i for i in running if i.port in ports and i.is_running()])
+
+    def detach(self, targets):
+        """
+        Detaches instances from their upstreams in one edit of
+        nginx-zope.conf and reloads nginx. An instance that is the last
+        server of its upstream stays attached, as an upstream without
+        servers fails nginx -t. Returns {instance: (upstream name, params)}
+        of the detached instances, to attach them again with. If nginx cannot
+        be reloaded, nginx-zope.conf is restored and the error raised.
+        """
+        detached = {}
+        with edit() as conf:
+            for instance in targets:
+                upstream, server = conf.find(instance.address)
+                if server is None or len(upstream.servers) == 1:
+                    continue
+                detached[instance] = (upstream.name, dict(server.params))
+                conf.remove_server(instance.address, drop_empty=False)
+        if detached:
+            try:
+                self._reload()
+            except Exception:
+                # nginx still runs with the servers attached
+                self._restore(detached)
+                raise
+        return detached
+
+    def _restore(self, detached):
+        with edit() as conf:
+            for instance, (upstream, params) in detached.items():
+                attached = conf.add_server(instance.address, upstream)
+                attached.params = []
+                for name, value in sorted(params.items()):
+                    attached.set(name, True if value is None else value)
+
+    def attach(self, instance, upstream, params):
+        """
+        Attaches an instance again with the parameters it was detached with.
+        """
+        self._restore({instance: (upstream, params)})
+        self._reload()
+
+    def drain(self, instance, deadline=None):
+        """
+        Waits until no connections to the instance are left. Returns the
+        number still open when drain_timeout passed, or at deadline.
+        """
+        if deadline is None:
+            deadline = time.time() + self.drain_timeout
+        while True:
+            remaining = port_connections(instance.port)
+            if not remaining or time.time() >= deadline:
+                return remaining
+            time.sleep(0.5)
+
+    def restart(self, instance, all_instances):
+        """
+        Restarts one instance. Returns (status, retcode, output).
+        """
+        upstream, server = UpstreamConf.load().find(instance.address)
+        if server is None:
+            # Not serving requests; nothing to drain
+            return restart_instance(instance)
+        if len(upstream.servers) == 1:
+            # An upstream without servers fails nginx -t
+            if self.min_live:
+                return 'FAIL', 1, "the only server of %s; keeping at least %d" % (upstream.name, self.min_live)
+            return restart_instance(instance)
+        upstream = upstream.name
+        live = self._live(upstream, all_instances)
+        if instance.is_running() and live - 1 < self.min_live:
+            return 'FAIL', 1, "only %d live servers in %s; keeping at least %d" % (live, upstream, self.min_live)
+
+        detached = self.detach([instance])
+        if instance not in detached:
+            # Detached or left alone in its upstream meanwhile
+            return restart_instance(instance)
+        upstream, params = detached[instance]
+        try:
+            remaining = self.drain(instance)
+            if remaining:
+                self._say("Server %d: %d connections still open after %ds; restarting anyway"
+                          % (instance.num, remaining, self.drain_timeout))
+            status, retcode, output = restart_instance(instance)
+        except Exception:
+            # Not restarted; serve requests again as before
+            self.attach(instance, upstream, params)
+            raise
+        if status == 'FAIL':
+            return status, retcode, output + "\nleft detached"
+        if self.probe is not None:
+            result = self.probe.wait(instance.port)
+            if not result.ready:
+                return 'FAIL', 1, "%s; left detached, run 'zenwebserver attach %d' once it is up" % (
+                    result.reason, instance.num)
+
+        self.attach(instance, upstream, params)
+        return 'OK', 0, ''
+
+    def run(self, targets, all_instances=None):
+        """
+        Restarts targets in turn. Returns their OperationResults.
+        """
+        all_instances = all_instances or instances()
+        results = []
+        stopped = False
+        for instance in targets:
+            if stopped:
+                results.append(OperationResult(instance, 'restart', 'SKIPPED', 0, 'roll stopped'))
+                continue
+            self._say("Server %d: restarting" % instance.num)
+            started = time.time()
+            try:
+                status, retcode, output = self.restart(instance, all_instances)
+            except Exception as e:
+                status, retcode, output = 'FAIL', -1, str(e)
+            results.append(OperationResult(instance, 'restart', status, retcode,
+                                           output, time.time() - started))
+            stopped = status == 'FAIL'
+        return results
+
+
+def retire(targets, restarter, concurrency=1, out=sys.stdout):
+    """
+    Stops instances leaving the pool without dropping the requests they are
+    answering: they are detached together with restarter, given its
+    drain_timeout to finish their requests, and stopped with up to
+    concurrency at once. Instances that may still be sent requests, because
+    they could not be detached or are the last server of their upstream, are
+    not stopped and fail. Returns the OperationResults in the order of
+    targets.
+    """
+    from zenwebserverconfig import nginxRunning
+    failures = {}
+    if nginxRunning():
+        try:
+            detached = restarter.detach(targets)
+        except Exception as e:
+            detached = {}
+            for instance in targets:
+                failures[instance] = "could not be detached: %s" % e
+        conf = UpstreamConf.load()
+        for instance in targets:
+            if instance not in detached and instance not in failures:
+                upstream, server = conf.find(instance.address)
+                if server is not None:
+                    failures[instance] = ("the last server of %s; detach it first, or deploy "
+                                          "another server to its pool" % upstream.name)
+    else:
+        # No requests to finish
+        detached = {}
+
+    deadline = time.time() + restarter.drain_timeout
+    for instance in targets:
+        if instance in detached:
+            remaining = restarter.drain(instance, deadline)
+            if remaining:
+                print >> out, "Server %d: %d connections still open after %ds; stopping anyway" % (
+                    instance.num, remaining, restarter.drain_timeout)
+                out.flush()
+
+    stopped = iter(run_parallel('stop', [i for i in targets if i not in failures], concurrency))
+    return [OperationResult(instance, 'stop', 'FAIL', 1, "still attached, not stopped: "
+                            + failures[instance]) if instance in failures else next(stopped)
+            for instance in targets]
+
+
+def rolling_restart_from_config(config):
+    from readiness import probe_from_config
+    return RollingRestart(min_live=max(config['rolling_min_live'], 0),
+                          drain_timeout=config['rolling_drain_timeout'],
+                          probe=probe_from_config(config))
+
+
+def print_report(action, results, elapsed, out=sys.stdout):
+    for result in results:
+        detail = '%.1fs' % result.elapsed
+        if result.failed:
+            detail += ' (exit code %d)' % result.retcode
+        elif result.status == 'SKIPPED':
+            detail = result.output
+        print >> out, '%-12s %-8s %-8s %s' % ('Server %d' % result.instance.num,
+                                              action, result.status, detail)
+        if result.failed and result.output:
+            for line in result.output.splitlines():
+                print >> out, '    %s' % line
+    failed = len([r for r in results if r.failed])
+    skipped = len([r for r in results if r.status == 'SKIPPED'])
+    print >> out, '%s of %d servers: %d ok, %d failed, %d skipped in %.1fs' % (
+        action.capitalize(), len(results), len(results) - failed - skipped,
+        failed, skipped, elapsed)
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog {start|stop|restart|retire} [options] [server numbers]")
+    parser.add_option('-j', '--parallel', dest='concurrency', type='int', default=4,
+                      help="Maximum number of servers acted on at once (default %default)")
+    parser.add_option('--rolling', action='store_true', default=False,
+                      help="Restart one server at a time, detached from the load balancer "
+                           "and drained first")
+    options, args = parser.parse_args(argv)
+    if not args or (args[0] not in ACTIONS and args[0] != 'retire'):
+        parser.error("an action of start, stop, restart or retire is required")
+    action, nums = args[0], args[1:]
+    if options.rolling and action != 'restart':
+        parser.error("--rolling only applies to restart")
+
+    targets = instances(nums)
+    if not targets:
+        print "No servers to %s" % action
+        return 1
+    started = time.time()
+    if options.rolling:
+        results = rolling_restart_from_config(load_settings()).run(targets)
+    elif action == 'retire':
+        results = retire(targets, rolling_restart_from_config(load_settings()), options.concurrency)
+        action = 'stop'
+    else:
+        results = run_parallel(action, targets, options.concurrency)
+    print_report(action, results, time.time() - started)
+    return 1 if any(r.failed for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
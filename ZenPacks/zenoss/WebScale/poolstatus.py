@@ -0,0 +1,210 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Status of the load balancer and the Zope servers, read from /proc.
+
+/proc is scanned once for the parent of every process and /proc/net/tcp
+once for the listening and established sockets; the listening ports of a
+process are those of the socket inodes among its open files, and
+nginx-zope.conf is parsed once to tell attached from detached servers. A
+server is up when its process listens, like the load balancer, which is up
+when its master or one of its workers listens.
+
+The output is the one of "zenwebserver status", or with --json one object
+with the load balancer and every server, their pids, listening ports,
+resident size, CPU time and open connections.
+
+Usage: zenwebserver status [-v] [--json]
+"""
+
+import os
+import sys
+import json
+from optparse import OptionParser
+
+from pool import instances
+from procutil import TcpTable, read_pidfile, pid_alive, pid_rss_kb, pid_cpu_seconds, \
+    pid_socket_inodes, process_parents
+from upstream import UpstreamConf, UpstreamError, NGINX_ZOPE_CONF
+
+zenhome = os.getenv('ZENHOME', '')
+
+NGINX_PIDFILE = os.path.join(zenhome, 'var', 'nginx.pid')
+
+_RED = '\033[31m'
+_GREEN = '\033[32m'
+_NORMAL = '\033[0m'
+
+
+class ProcessStatus(object):
+    """
+    A server process: whether it runs and listens, and what it uses.
+    """
+
+    def __init__(self, pid, tcp, pids=None):
+        self.pid = pid
+        self.running = pid_alive(pid)
+        self.ports = []
+        self.rss_kb = None
+        self.cpu_seconds = None
+        if not self.running:
+            return
+        # The processes sharing the work, such as the nginx workers
+        pids = pids or [pid]
+        inodes = set()
+        for p in pids:
+            inodes |= pid_socket_inodes(p)
+        self.ports = tcp.listening_ports(inodes)
+        sizes = [pid_rss_kb(p) for p in pids]
+        self.rss_kb = sum(size for size in sizes if size)
+        times = [pid_cpu_seconds(p) for p in pids]
+        self.cpu_seconds = sum(t for t in times if t)
+
+    @property
+    def up(self):
+        return bool(self.ports)
+
+    def describe(self):
+        if not self.running:
+            return "Not running, Not listening"
+        listening = "Listening (port %s)" % ', '.join(str(p) for p in self.ports) if self.ports \
+            else "Not listening"
+        return "Running (pid %d), %s, %dMB resident, %.0fs CPU" % (
+            self.pid, listening, self.rss_kb / 1024, self.cpu_seconds)
+
+
+class ServerStatus(ProcessStatus):
+
+    def __init__(self, instance, tcp, upstreams):
+        ProcessStatus.__init__(self, instance.pid, tcp)
+        self.num = instance.num
+        self.port = instance.port
+        self.connections = tcp.connections(instance.port)
+        # Upstream of nginx-zope.conf the server is in, or None if detached;
+        # unknown (False) without nginx
+        self.upstream = upstreams.get(instance.port) if upstreams is not None else False
+
+    def as_dict(self):
+        return {'server': self.num,
+                'port': self.port,
+                'pid': self.pid,
+                'up': self.up,
+                'running': self.running,
+                'attached': None if self.upstream is False else self.upstream is not None,
+                'upstream': self.upstream or None,
+                'rss_kb': self.rss_kb,
+                'cpu_seconds': self.cpu_seconds,
+                'connections': self.connections}
+
+
+class LoadBalancerStatus(ProcessStatus):
+
+    def __init__(self, tcp, parents, pidfile=NGINX_PIDFILE):
+        pid = read_pidfile(pidfile)
+        workers = sorted(p for p, parent in parents.items() if pid and parent == pid)
+        ProcessStatus.__init__(self, pid, tcp, [pid] + workers)
+        self.workers = len(workers)
+        self.connections = sum(tcp.connections(port) for port in self.ports)
+
+    def as_dict(self):
+        return {'pid': self.pid,
+                'up': self.up,
+                'running': self.running,
+                'ports': self.ports,
+                'workers': self.workers,
+                'rss_kb': self.rss_kb,
+                'cpu_seconds': self.cpu_seconds,
+                'connections': self.connections}
+
+
+def attached_ports(path=NGINX_ZOPE_CONF):
+    """
+    Returns the upstream of every local server port in nginx-zope.conf.
+    """
+    ports = {}
+    for name, server in UpstreamConf.load(path).servers():
+        if server.port is not None:
+            ports[server.port] = name
+    return ports
+
+
+def collect(use_nginx=True):
+    """
+    Returns (LoadBalancerStatus or None, [ServerStatus]).
+    """
+    tcp = TcpTable()
+    upstreams = None
+    if use_nginx:
+        try:
+            upstreams = attached_ports()
+        except UpstreamError:
+            # Attachment unknown, as without nginx
+            pass
+    servers = [ServerStatus(instance, tcp, upstreams) for instance in instances()]
+    nginx = LoadBalancerStatus(tcp, process_parents()) if use_nginx else None
+    return nginx, servers
+
+
+def _mark(up, color):
+    word = 'UP' if up else 'DOWN'
+    if color:
+        word = '%s%s%s' % (_GREEN if up else _RED, word, _NORMAL)
+    return '[%s]' % word
+
+
+def print_status(nginx, servers, verbose=False, out=sys.stdout):
+    """
+    Prints the status in the form of "zenwebserver status".
+    """
+    if not verbose:
+        if nginx is None or nginx.up:
+            print >> out, "program running; pid=%s" % (nginx.pid if nginx else '')
+        else:
+            print >> out, "not running"
+        return
+    color = out.isatty()
+    for server in servers:
+        print >> out, '%-50s%s' % ("Server %d status" % server.num, _mark(server.up, color))
+        print >> out, "%s, %d connections" % (server.describe(), server.connections)
+        if server.upstream is None:
+            print >> out, "* Detached from server pool"
+        print >> out
+    if nginx is not None:
+        print >> out, '%-50s%s' % ("Load balancer status", _mark(nginx.up, color))
+        print >> out, "%s, %d workers, %d connections" % (nginx.describe(), nginx.workers,
+                                                           nginx.connections)
+        print >> out
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [-v] [--json]",
+                          description="Shows the status of the load balancer and the Zope servers.")
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help="Show every server")
+    parser.add_option('--json', action='store_true', default=False,
+                      help="Print the status as JSON")
+    options, args = parser.parse_args(argv)
+
+    nginx, servers = collect(use_nginx=not os.getenv('NO_ZENOSS_NGINX'))
+    if options.json:
+        print json.dumps({'load_balancer': nginx.as_dict() if nginx else None,
+                          'servers': [server.as_dict() for server in servers]},
+                         indent=2, sort_keys=True)
+    else:
+        print_status(nginx, servers, options.verbose)
+    # Running if the load balancer and at least one server are up
+    if (nginx is None or nginx.up) and any(server.up for server in servers):
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
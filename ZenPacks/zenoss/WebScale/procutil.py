@@ -0,0 +1,199 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Host and process statistics read from /proc (Linux only).
+"""
+
+import os
+
+_PAGE_SIZE_KB = os.sysconf('SC_PAGE_SIZE') / 1024
+
+
+def read_pidfile(path):
+    """
+    Returns the pid stored in path, or None if it is missing or invalid.
+    """
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def pid_alive(pid):
+    return pid is not None and os.path.exists('/proc/%d' % pid)
+
+
+def cpu_times():
+    """
+    Returns (busy, total) jiffies for all CPUs since boot.
+    """
+    with open('/proc/stat', 'r') as f:
+        fields = [int(v) for v in f.readline().split()[1:]]
+    # user nice system idle iowait irq softirq steal ...
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    return total - idle, total
+
+
+class CpuSampler(object):
+    """
+    Reports host CPU utilization (0-100) between successive calls.
+    """
+
+    def __init__(self):
+        self._last = cpu_times()
+
+    def sample(self):
+        busy, total = cpu_times()
+        last_busy, last_total = self._last
+        self._last = busy, total
+        if total == last_total:
+            return 0.0
+        return 100.0 * (busy - last_busy) / (total - last_total)
+
+
+def meminfo():
+    """
+    Returns the fields of /proc/meminfo in kB.
+    """
+    info = {}
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            try:
+                info[key] = int(value.split()[0])
+            except (IndexError, ValueError):
+                pass
+    return info
+
+
+def mem_available_kb(info=None):
+    """
+    Returns the memory available for new processes in kB. Older kernels do
+    not report MemAvailable, so it is estimated from free memory and caches.
+    """
+    info = info or meminfo()
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    return info.get('MemFree', 0) + info.get('Buffers', 0) + info.get('Cached', 0)
+
+
+def pid_rss_kb(pid):
+    """
+    Returns the resident set size of a process in kB, or None if it is gone.
+    """
+    try:
+        with open('/proc/%d/statm' % pid, 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE_KB
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def pid_cpu_seconds(pid):
+    """
+    Returns the user plus system CPU time of a process in seconds, or None
+    if it is gone.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            # The command name may contain spaces; fields follow its ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        return float(int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+_TCP_ESTABLISHED = '01'
+_TCP_LISTEN = '0A'
+
+
+class TcpTable(object):
+    """
+    The TCP sockets of the host, read once from /proc/net/tcp and tcp6: the
+    listening ports by socket inode and the established connections by
+    local port.
+    """
+
+    def __init__(self):
+        self.listening = {}
+        self.established = {}
+        for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+            try:
+                with open(table, 'r') as f:
+                    f.readline()
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) < 10:
+                            continue
+                        port = int(fields[1].rsplit(':', 1)[1], 16)
+                        if fields[3] == _TCP_LISTEN:
+                            self.listening[fields[9]] = port
+                        elif fields[3] == _TCP_ESTABLISHED:
+                            self.established[port] = self.established.get(port, 0) + 1
+            except (IOError, ValueError, IndexError):
+                pass
+
+    def listening_ports(self, inodes):
+        """
+        Returns the ports listened on by the sockets with the given inodes.
+        """
+        return sorted(set(self.listening[inode] for inode in inodes if inode in self.listening))
+
+    def connections(self, port):
+        return self.established.get(port, 0)
+
+
+def port_connections(port):
+    """
+    Returns the number of established TCP connections to a local port.
+    """
+    return TcpTable().connections(port)
+
+
+def pid_socket_inodes(pid):
+    """
+    Returns the inodes of the sockets a process has open. Only the processes
+    of the same user can be read.
+    """
+    inodes = set()
+    fd_dir = '/proc/%d/fd' % pid
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return inodes
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(target[8:-1])
+    return inodes
+
+
+def process_parents():
+    """
+    Returns the parent pid of every process, by pid.
+    """
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name, 'r') as f:
+                parents[int(name)] = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            pass
+    return parents
@@ -0,0 +1,213 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Readiness probe for Zope instances joining the server pool.
+
+A freshly started Zope accepts connections long before it can serve pages
+at normal speed. The probe sends real HTTP requests straight to the
+instance's port until it answers readiness_successes requests in a row,
+each within readiness_budget seconds and with one of readiness_statuses
+(2xx and 3xx by default), optionally requests the paths listed in
+readiness_warmup_file to load the most used objects, and only then reports
+the instance as ready to be attached to the load balancer.
+
+Usage: readiness.py [options] server_number ...
+"""
+
+import re
+import sys
+import time
+import base64
+import socket
+import httplib
+from optparse import OptionParser
+
+from pool import instances
+from webserverconf import load_settings
+
+DEFAULT_PATH = '/zport/dmd'
+DEFAULT_STATUSES = '2xx 3xx'
+
+_STATUS_PATTERN = re.compile(r'^[1-5](\d\d|xx)$')
+
+
+def parse_statuses(spec):
+    """
+    Returns the statuses and status classes of spec, such as "2xx 3xx 404",
+    or those of DEFAULT_STATUSES if it lists none.
+    """
+    statuses = [token for token in (spec or '').split() if _STATUS_PATTERN.match(token)]
+    return statuses or DEFAULT_STATUSES.split()
+
+
+def status_accepted(status, statuses):
+    code = str(status)
+    return any(s == code or (s.endswith('xx') and s[0] == code[0]) for s in statuses)
+
+
+class ProbeResult(object):
+
+    def __init__(self, ready, attempts, elapsed, reason=None, warmup_failures=()):
+        self.ready = ready
+        self.attempts = attempts
+        self.elapsed = elapsed
+        self.reason = reason
+        self.warmup_failures = list(warmup_failures)
+
+
+def http_get(port, path, timeout, auth=None):
+    """
+    Requests path from the local port. Returns (status, seconds); raises
+    socket.error or httplib.HTTPException if no response was received.
+    """
+    headers = {}
+    if auth:
+        headers['Authorization'] = 'Basic %s' % base64.b64encode(auth)
+    started = time.time()
+    conn = httplib.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.time() - started
+    finally:
+        conn.close()
+
+
+def read_warmup_paths(path):
+    """
+    Reads the warm-up list: one path per line, '#' starts a comment.
+    """
+    paths = []
+    if not path:
+        return paths
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    paths.append(line)
+    except IOError:
+        pass
+    return paths
+
+
+class ReadinessProbe(object):
+    """
+    Waits for one Zope port to become ready.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, budget=2.0, timeout=300, interval=1.0,
+                 successes=2, warmup_paths=(), auth=None, warmup_timeout=120,
+                 statuses=None):
+        self.path = path
+        self.budget = budget
+        self.timeout = timeout
+        self.interval = interval
+        self.successes = successes
+        self.warmup_paths = list(warmup_paths)
+        self.auth = auth
+        self.warmup_timeout = warmup_timeout
+        self.statuses = parse_statuses(statuses)
+
+    def accepts(self, status):
+        """
+        Whether a status shows a Zope serving real pages. A 401 does when the
+        probe has no credentials, as the page is then answered with the
+        login challenge; with credentials it means they were refused.
+        """
+        if status == 401 and not self.auth:
+            return True
+        return status_accepted(status, self.statuses)
+
+    def wait(self, port):
+        started = time.time()
+        deadline = started + self.timeout
+        attempts = 0
+        in_a_row = 0
+        reason = "no response"
+        while True:
+            attempts += 1
+            remaining = deadline - time.time()
+            try:
+                status, seconds = http_get(port, self.path, max(min(remaining, 60), 1), self.auth)
+            except (socket.error, httplib.HTTPException) as e:
+                in_a_row = 0
+                reason = "no response (%s)" % e
+            else:
+                if not self.accepts(status):
+                    in_a_row = 0
+                    reason = "HTTP %d" % status
+                elif seconds > self.budget:
+                    in_a_row = 0
+                    reason = "answered in %.1fs, budget is %.1fs" % (seconds, self.budget)
+                else:
+                    in_a_row += 1
+                    if in_a_row >= self.successes:
+                        break
+            if time.time() + self.interval >= deadline:
+                return ProbeResult(False, attempts, time.time() - started,
+                                   "not ready after %ds: %s" % (self.timeout, reason))
+            time.sleep(self.interval)
+
+        failures = []
+        for path in self.warmup_paths:
+            try:
+                status, seconds = http_get(port, path, self.warmup_timeout, self.auth)
+                if status >= 400:
+                    failures.append("%s: HTTP %d" % (path, status))
+            except (socket.error, httplib.HTTPException) as e:
+                failures.append("%s: %s" % (path, e))
+        return ProbeResult(True, attempts, time.time() - started, warmup_failures=failures)
+
+
+def probe_from_config(config):
+    return ReadinessProbe(
+        path=config['readiness_path'] or DEFAULT_PATH,
+        budget=config['readiness_budget'],
+        timeout=config['readiness_timeout'],
+        successes=config['readiness_successes'],
+        warmup_paths=read_warmup_paths(config['readiness_warmup_file']),
+        auth=config['readiness_warmup_auth'],
+        statuses=config['readiness_statuses'])
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] server_number ...",
+                          description="Waits until the given Zope instances answer requests "
+                                      "within the readiness budget from zenwebserver.conf.")
+    parser.add_option('--timeout', type='int', default=None,
+                      help="Seconds to wait for each server (overrides readiness_timeout)")
+    options, nums = parser.parse_args(argv)
+    if not nums:
+        parser.error("no server numbers given")
+
+    probe = probe_from_config(load_settings())
+    if options.timeout is not None:
+        probe.timeout = options.timeout
+    targets = instances(nums)
+    if not targets:
+        print "No such servers: %s" % ' '.join(nums)
+        return 1
+
+    exitcode = 0
+    for instance in targets:
+        result = probe.wait(instance.port)
+        if not result.ready:
+            print "Server %d (port %d) %s" % (instance.num, instance.port, result.reason)
+            exitcode = 1
+        for failure in result.warmup_failures:
+            print "Server %d warm-up request failed: %s" % (instance.num, failure)
+    return exitcode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
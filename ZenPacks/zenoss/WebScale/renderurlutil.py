@@ -10,6 +10,7 @@
 
 from Products.ZenUtils.Utils import zenPath
 from Products.ZenModel.PerformanceConf import RenderURLUtil, ProxyConfig
+from ZenPacks.zenoss.WebScale.webserverconf import load_settings
 
 class NginxRenderURLUtil(RenderURLUtil):
 
@@ -18,19 +19,8 @@ class NginxRenderURLUtil(RenderURLUtil):
         self.context = context        
 
     def _get_reverseproxy_config(self):
-        use_ssl = False
-        http_port = 8080
-        ssl_port = 443
-        conf_path = zenPath("etc", "zenwebserver.conf")
-        with open(conf_path) as file_:
-            for line in (l.strip() for l in file_):
-                if line and not line.startswith('#'):
-                    key, val = line.split(' ', 1)
-                    if key == "useSSL":
-                        use_ssl = val.lower() == 'true'
-                    elif key == "httpPort":
-                        http_port = int(val.strip())
-                    elif key == "sslPort":
-                        ssl_port = int(val.strip())
+        # Cached; the file is only parsed again after it changed
+        settings = load_settings(zenPath("etc", "zenwebserver.conf"))
+        use_ssl = settings['useSSL']
         return ProxyConfig(useSSL=use_ssl,
-                           port= ssl_port if use_ssl else http_port) 
+                           port=settings['sslPort'] if use_ssl else settings['httpPort'])
@@ -0,0 +1,66 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Client for the nginx stub_status page served at /nginx_status.
+"""
+
+import re
+import urllib2
+
+from webserverconf import open_local_url
+
+_STATUS_PATTERN = re.compile(
+    r'Active connections:\s*(?P<active>\d+).*?'
+    r'(?P<accepts>\d+)\s+(?P<handled>\d+)\s+(?P<requests>\d+).*?'
+    r'Reading:\s*(?P<reading>\d+)\s+Writing:\s*(?P<writing>\d+)\s+Waiting:\s*(?P<waiting>\d+)',
+    re.DOTALL)
+
+
+class StubStatus(object):
+    """
+    Counters reported by stub_status. accepts, handled and requests are
+    totals since nginx started; the others are current values.
+    """
+
+    FIELDS = ('active', 'accepts', 'handled', 'requests', 'reading', 'writing', 'waiting')
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field, 0))
+
+    def __repr__(self):
+        return "StubStatus<%s>" % ','.join('%s=%s' % (f, getattr(self, f)) for f in self.FIELDS)
+
+
+def parse_stub_status(text):
+    """
+    Parses a stub_status page. Returns a StubStatus, or None if the text is
+    not a stub_status page.
+    """
+    m = _STATUS_PATTERN.search(text)
+    if not m:
+        return None
+    return StubStatus(**dict((k, int(v)) for k, v in m.groupdict().items()))
+
+
+def fetch_stub_status(url, timeout=5):
+    """
+    Fetches and parses the stub_status page at url. Returns None if nginx
+    could not be reached.
+    """
+    try:
+        response = open_local_url(url, timeout)
+        try:
+            return parse_stub_status(response.read())
+        finally:
+            response.close()
+    except (urllib2.URLError, IOError):
+        return None
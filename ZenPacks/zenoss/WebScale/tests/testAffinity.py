@@ -0,0 +1,117 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Tests of the session buckets and the nginx-affinity.conf they render.
+"""
+
+import re
+import unittest
+
+from ZenPacks.zenoss.WebScale.affinity import BUCKETS, bucket_homes, home_keepalive, \
+    render_affinity_conf
+from ZenPacks.zenoss.WebScale.upstream import UpstreamConf
+
+
+def zope_conf(*servers, **kwargs):
+    lines = ['upstream zopectls {\n', '    fair;\n']
+    lines.extend('    server %s;\n' % server for server in servers)
+    if kwargs.get('keepalive'):
+        lines.append('    keepalive %d;\n' % kwargs['keepalive'])
+    lines.append('}\n')
+    conf = UpstreamConf('nginx-zope.conf')
+    conf.parse(''.join(lines))
+    return conf
+
+
+def homes(conf):
+    return [server.address for server in bucket_homes(conf.upstream('zopectls').servers)]
+
+
+class TestBuckets(unittest.TestCase):
+
+    def testAllServersAreHomes(self):
+        result = homes(zope_conf('127.0.0.1:9081', '127.0.0.1:9082', '127.0.0.1:9083'))
+        self.assertEqual(len(result), BUCKETS)
+        self.assertEqual(set(result), set(['127.0.0.1:9081', '127.0.0.1:9082', '127.0.0.1:9083']))
+
+    def testRemovingMovesOnlyItsBuckets(self):
+        before = homes(zope_conf('127.0.0.1:9081', '127.0.0.1:9082', '127.0.0.1:9083'))
+        after = homes(zope_conf('127.0.0.1:9081', '127.0.0.1:9083'))
+        for old, new in zip(before, after):
+            if old != '127.0.0.1:9082':
+                self.assertEqual(old, new)
+        self.assertFalse('127.0.0.1:9082' in after)
+
+    def testAddingTakesOnlyBucketsForItself(self):
+        before = homes(zope_conf('127.0.0.1:9081', '127.0.0.1:9082'))
+        after = homes(zope_conf('127.0.0.1:9081', '127.0.0.1:9082', '127.0.0.1:9083'))
+        for old, new in zip(before, after):
+            self.assertTrue(new in (old, '127.0.0.1:9083'))
+
+    def testWeight(self):
+        result = homes(zope_conf('127.0.0.1:9081 weight=3', '127.0.0.1:9082'))
+        self.assertTrue(result.count('127.0.0.1:9081') > result.count('127.0.0.1:9082'))
+
+
+class TestRender(unittest.TestCase):
+
+    def testDownServersAreNotHomes(self):
+        text = render_affinity_conf(zope_conf('127.0.0.1:9081', '127.0.0.1:9082 down'))
+        self.assertEqual(set(re.findall(r'^    b\d+ (\S+);$', text, re.M)), set(['zopectls_home_9081']))
+        self.assertFalse('zopectls_home_9082' in text)
+        self.assertFalse('127.0.0.1:9082' in text)
+
+    def testEmptyPool(self):
+        for conf in (zope_conf(), zope_conf('127.0.0.1:9081 down')):
+            text = render_affinity_conf(conf)
+            self.assertTrue('map $host $zenoss_zope_upstream {\n    default zopectls;\n}\n' in text)
+            self.assertFalse('split_clients' in text)
+            self.assertFalse(re.search(r'^upstream ', text, re.M))
+
+    def testCookie(self):
+        text = render_affinity_conf(zope_conf('127.0.0.1:9081'), cookie='my_session')
+        self.assertTrue('split_clients "${cookie_my_session}" $zenoss_affinity_bucket {' in text)
+        self.assertTrue('map $cookie_my_session $zenoss_zope_upstream {' in text)
+        for cookie in ('', 'a-b', 'x;}', '$host'):
+            self.assertRaises(ValueError, render_affinity_conf, zope_conf('127.0.0.1:9081'), cookie)
+
+    def testBuckets(self):
+        text = render_affinity_conf(zope_conf('127.0.0.1:9081', '127.0.0.1:9082'))
+        shares = re.findall(r'^    (\S+) b\d+;$', text, re.M)
+        self.assertEqual(len(shares), BUCKETS)
+        self.assertEqual(shares[-1], '*')
+        self.assertEqual(len(re.findall(r'^    b\d+ zopectls_home_\d+;$', text, re.M)), BUCKETS)
+
+    def testHomeUpstreams(self):
+        text = render_affinity_conf(zope_conf('127.0.0.1:9081', '127.0.0.1:9082 weight=2',
+                                              '127.0.0.1:9083', keepalive=8), threads=4)
+        block = text[text.index('upstream zopectls_home_9082 {'):]
+        block = block[:block.index('}')]
+        # The home first, then the others, weighted by their threads
+        self.assertEqual(re.findall(r'server (\S+ weight=\d+)', block),
+                         ['127.0.0.1:9082 weight=8', '127.0.0.1:9083 weight=4', '127.0.0.1:9081 weight=4'])
+        # The homes share the keepalive of the pool
+        self.assertEqual(re.findall(r'keepalive (\d+);', text), ['2', '2', '2'])
+
+    def testHomeKeepalive(self):
+        self.assertEqual(home_keepalive(8, 2), 4)
+        self.assertEqual(home_keepalive(8, 3), 2)
+        self.assertEqual(home_keepalive(8, 20), 1)
+        self.assertEqual(home_keepalive(0, 3), 0)
+        self.assertEqual(home_keepalive(8, 0), 0)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestBuckets))
+    suite.addTest(makeSuite(TestRender))
+    return suite
@@ -0,0 +1,106 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Runs the benchmark scenarios against the zenwebserver nginx binary and
+local stand-in Zopes. Skipped where there is no nginx binary.
+"""
+
+import os
+import unittest
+
+from ZenPacks.zenoss.WebScale import benchmark
+from ZenPacks.zenoss.WebScale.zenwebserverconfig import readTemplate
+
+NGINX = benchmark.DEFAULT_NGINX
+
+# Clients of the herd, and how long the stand-ins take to answer them
+HERD_CLIENTS = 20
+HERD_DELAY = 0.5
+
+# Clients and requests of the keepalive comparison
+CONCURRENCY = 8
+REQUESTS = 400
+
+
+@unittest.skipUnless(os.access(NGINX, os.X_OK), "no nginx binary at %s" % NGINX)
+class TestKeepalive(unittest.TestCase):
+
+    def setUp(self):
+        self.template = readTemplate(os.path.join(benchmark._HERE, 'nginx.conf.template'))
+        latency = benchmark.parse_distribution('exp:0.01')
+        self.backends = [benchmark.StandInBackend(profile=benchmark.BackendProfile(latency))
+                         for i in range(2)]
+        for backend in self.backends:
+            backend.start()
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.stop()
+
+    def run_keepalive(self, keepalive):
+        return benchmark.run_scenario(benchmark.Scenario('fair', keepalive), NGINX, self.template,
+                                      self.backends, list(benchmark.DEFAULT_WORKLOAD),
+                                      CONCURRENCY, REQUESTS)
+
+    def testKeepalive(self):
+        closing = self.run_keepalive(0)
+        keeping = self.run_keepalive(8)
+        self.assertEqual(closing.errors, 0)
+        self.assertEqual(keeping.errors, 0)
+        # Without keepalive every request opens a connection to a Zope
+        self.assertEqual(closing.backend_connections, closing.backend_requests)
+        # With it, a worker opens no more connections to a Zope than it
+        # has requests in progress at once
+        self.assertTrue(keeping.backend_connections <= CONCURRENCY * len(self.backends),
+                        (keeping.backend_connections, keeping.backend_requests))
+
+
+@unittest.skipUnless(os.access(NGINX, os.X_OK), "no nginx binary at %s" % NGINX)
+class TestHerd(unittest.TestCase):
+
+    def setUp(self):
+        self.template = readTemplate(os.path.join(benchmark._HERE, 'nginx.conf.template'))
+        self.backends = [benchmark.StandInBackend() for i in range(2)]
+        for backend in self.backends:
+            backend.start()
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.stop()
+
+    def herd(self, protected):
+        phases = benchmark.run_herd(benchmark.HerdScenario(protected), NGINX, self.template,
+                                    self.backends, HERD_CLIENTS, HERD_DELAY)
+        return dict((phase, (upstream, ok, errors)) for phase, upstream, ok, errors in phases)
+
+    def testLockAndStale(self):
+        phases = self.herd(True)
+        # A miss is fetched once while the other clients wait for it
+        self.assertEqual(phases['cold'][0], 1)
+        # The expired file is served while one request refreshes it
+        self.assertTrue(phases['expired'][0] <= 1)
+        # and while the Zopes fail
+        self.assertEqual(phases['failing'][2], 0)
+        self.assertEqual(phases['failing'][1], HERD_CLIENTS)
+
+    def testUnprotected(self):
+        phases = self.herd(False)
+        # Every client of the herd reaches the Zopes
+        self.assertTrue(phases['cold'][0] >= HERD_CLIENTS * 0.9, phases)
+        self.assertTrue(phases['expired'][0] >= HERD_CLIENTS * 0.9, phases)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestKeepalive))
+    suite.addTest(makeSuite(TestHerd))
+    return suite
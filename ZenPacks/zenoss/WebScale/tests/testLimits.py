@@ -0,0 +1,113 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Tests of the admission limits rendered into nginx.conf.
+"""
+
+import re
+import unittest
+
+from ZenPacks.zenoss.WebScale.webserverconf import Settings
+from ZenPacks.zenoss.WebScale.zenwebserverconfig import LIMITS_EXEMPT, limitClasses, limitsConfig
+
+
+def config(**values):
+    values.setdefault('limits', 'True')
+    return Settings(values).as_dict()
+
+
+class TestClasses(unittest.TestCase):
+
+    def testClasses(self):
+        notes = []
+        classes = limitClasses(config(limit_class_api='rate=10r/s burst=20 conn=4 _router$',
+                                      limit_class_export=r'conn=1 \.csv$ /exportDevices$'), notes)
+        self.assertEqual(classes, [('api', '10r/s', 20, 4, ['_router$']),
+                                   ('export', None, 0, 1, [r'\.csv$', '/exportDevices$']),
+                                   ('zope', '20r/s', 40, 16, [])])
+        self.assertEqual(notes, [])
+
+    def testInvalidNames(self):
+        notes = []
+        classes = limitClasses(config(**{'limit_class_zope': 'rate=1r/s x$',
+                                         'limit_class_Api': 'rate=1r/s x$',
+                                         'limit_class_a-b': 'rate=1r/s x$'}), notes)
+        self.assertEqual([name for name, rate, burst, conn, patterns in classes], ['zope'])
+        self.assertEqual(len(notes), 3)
+
+    def testNoPatterns(self):
+        notes = []
+        classes = limitClasses(config(limit_class_api='rate=1r/s burst=2'), notes)
+        self.assertEqual([name for name, rate, burst, conn, patterns in classes], ['zope'])
+        self.assertTrue('lists no URI patterns' in notes[0])
+
+    def testInvalidRate(self):
+        notes = []
+        classes = limitClasses(config(limit_class_api='rate=10/s conn=2 _router$', limit_rate='fast'), notes)
+        self.assertEqual(classes, [('api', None, 0, 2, ['_router$']), ('zope', None, 40, 16, [])])
+        self.assertEqual(len(notes), 2)
+        self.assertTrue('Invalid rate' in notes[0])
+
+    def testInvalidBurstOrConn(self):
+        notes = []
+        classes = limitClasses(config(limit_class_api='rate=1r/s burst=many _router$',
+                                      limit_class_export=r'rate=1r/m conn=-1 \.csv$'), notes)
+        # A negative count is no limit
+        self.assertEqual(classes, [('export', '1r/m', 0, 0, [r'\.csv$']), ('zope', '20r/s', 40, 16, [])])
+        self.assertTrue('Invalid burst or conn of limit class api' in notes[0])
+
+
+class TestConfig(unittest.TestCase):
+
+    def testExempt(self):
+        http, server = limitsConfig(config(limit_class_api='rate=1r/s _router$'), '/opt/zenoss', [])
+        entries = re.findall(r'^        "~(.*)" (\S+);$', http, re.M)
+        # The exempt patterns come first, as the first matching regex wins
+        self.assertEqual(entries, [(pattern, '""') for pattern in LIMITS_EXEMPT] + [('_router$', 'api')])
+        self.assertTrue('    map $zenoss_limit_class $zenoss_limit_api {\n        default "";\n' in http)
+
+    def testKey(self):
+        http, server = limitsConfig(config(limit_key='ip'), '/opt/zenoss', [])
+        self.assertTrue('zope $binary_remote_addr;' in http)
+        notes = []
+        http, server = limitsConfig(config(limit_key='cookie'), '/opt/zenoss', notes)
+        self.assertTrue('zope $zenoss_limit_session;' in http)
+        self.assertEqual(notes, ["Invalid limit_key 'cookie'; limiting by session"])
+
+    def testStatus(self):
+        http, server = limitsConfig(config(limit_status='503'), '/opt/zenoss', [])
+        self.assertTrue('error_page 503 =503 @zenoss_limited;' in server)
+        notes = []
+        http, server = limitsConfig(config(limit_status='418'), '/opt/zenoss', notes)
+        self.assertTrue('error_page 503 =429 @zenoss_limited;' in server)
+        self.assertEqual(notes, ["Invalid limit_status 418; answering 429"])
+
+    def testNoLimits(self):
+        notes = []
+        self.assertEqual(limitsConfig(config(limit_rate='', limit_conn='0'), '/opt/zenoss', notes), ('', ''))
+        self.assertTrue('no limit class has a rate or conn' in notes[-1])
+
+    def testRejectedLocally(self):
+        http, server = limitsConfig(config(limit_retry_after='0'), '/opt/zenoss', [])
+        # Rejections are answered over a unix socket, never through the
+        # public listener with its TLS
+        self.assertTrue('listen unix:/opt/zenoss/var/nginx-limited.sock;' in http)
+        self.assertTrue('proxy_pass http://unix:/opt/zenoss/var/nginx-limited.sock:;' in server)
+        self.assertFalse('127.0.0.1' in server)
+        self.assertTrue('add_header Retry-After 1;' in http)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestClasses))
+    suite.addTest(makeSuite(TestConfig))
+    return suite
@@ -0,0 +1,197 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Tests of the nginx-zope.conf model that every change of the pool goes
+through.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from ZenPacks.zenoss.WebScale import upstream
+from ZenPacks.zenoss.WebScale.upstream import UpstreamConf, UpstreamError, edit
+
+CONF = """# Zope servers
+upstream zopectls {
+    fair;
+    # the big one
+    server 127.0.0.1:9081 weight=2 max_fails=3 fail_timeout=10s;
+    server 127.0.0.1:9082 down;
+    keepalive 8;
+}
+
+upstream zopectls_reports {
+    fair;
+    server 127.0.0.1:9083;
+    keepalive 8;
+}
+"""
+
+
+def parse(text):
+    conf = UpstreamConf('nginx-zope.conf')
+    conf.parse(text)
+    return conf
+
+
+class TestUpstreamConf(unittest.TestCase):
+
+    def testRoundTrip(self):
+        conf = parse(CONF)
+        self.assertEqual(conf.render(), CONF)
+        self.assertFalse(conf.changed)
+
+    def testParams(self):
+        conf = parse(CONF)
+        block, server = conf.find('127.0.0.1:9081')
+        self.assertEqual(block.name, 'zopectls')
+        self.assertEqual(server.weight, 2)
+        self.assertEqual(server.get('max_fails'), '3')
+        self.assertEqual(server.get('fail_timeout'), '10s')
+        self.assertEqual(conf.find('127.0.0.1:9082')[1].get('down'), True)
+        self.assertEqual(block.balancer, 'fair')
+        self.assertEqual(block.keepalive, 8)
+
+    def testChangeKeepsComments(self):
+        conf = parse(CONF)
+        conf.set_server('127.0.0.1:9082', down=False, weight=3)
+        text = conf.render()
+        self.assertTrue('# Zope servers\n' in text)
+        self.assertTrue('    # the big one\n' in text)
+        self.assertTrue('    server 127.0.0.1:9082 weight=3;\n' in text)
+        # Unchanged lines are rendered as read
+        self.assertTrue('    server 127.0.0.1:9081 weight=2 max_fails=3 fail_timeout=10s;\n' in text)
+        self.assertTrue(conf.changed)
+
+    def testKeepaliveAfterBalancer(self):
+        conf = parse("upstream zopectls {\n    server 127.0.0.1:9081;\n}\n")
+        block = conf.upstream('zopectls')
+        block.set_keepalive(4)
+        block.set_balancer('fair')
+        names = [line.name for line in block.lines]
+        self.assertEqual(names, ['fair', 'server', 'keepalive'])
+        conf.add_server('127.0.0.1:9082')
+        names = [line.name for line in block.lines]
+        self.assertEqual(names, ['fair', 'server', 'server', 'keepalive'])
+        self.assertTrue(conf.set_keepalive(0))
+        self.assertEqual(block.keepalive, 0)
+        self.assertFalse('keepalive' in conf.render())
+
+    def testAddUpstream(self):
+        conf = parse(CONF)
+        conf.add_server('127.0.0.1:9084', 'zopectls_exports', weight=2)
+        block = conf.upstream('zopectls_exports')
+        self.assertEqual([line.name for line in block.lines], ['fair', 'server', 'keepalive'])
+        self.assertEqual(block.keepalive, 8)
+        self.assertTrue(conf.render().endswith(
+            '\nupstream zopectls_exports {\n    fair;\n    server 127.0.0.1:9084 weight=2;\n'
+            '    keepalive 8;\n}\n'))
+
+    def testMoveServer(self):
+        conf = parse(CONF)
+        conf.add_server('127.0.0.1:9082', 'zopectls_reports')
+        self.assertEqual(conf.find('127.0.0.1:9082')[0].name, 'zopectls_reports')
+        self.assertEqual(len(conf.upstream('zopectls').servers), 1)
+
+    def testDropEmpty(self):
+        conf = parse(CONF)
+        self.assertTrue(conf.remove_server('127.0.0.1:9083'))
+        self.assertEqual(conf.upstream('zopectls_reports'), None)
+        self.assertFalse('\n\n\n' in conf.render())
+        self.assertFalse(conf.remove_server('127.0.0.1:9083'))
+
+    def testKeepEmpty(self):
+        conf = parse(CONF)
+        conf.remove_server('127.0.0.1:9083', drop_empty=False)
+        self.assertEqual(conf.upstream('zopectls_reports').servers, [])
+        # The default upstream is never dropped
+        conf.remove_server('127.0.0.1:9081')
+        conf.remove_server('127.0.0.1:9082')
+        self.assertNotEqual(conf.upstream('zopectls'), None)
+        self.assertEqual(conf.active_upstreams(), set())
+
+    def testSetUnknownServer(self):
+        self.assertRaises(UpstreamError, parse(CONF).set_server, '127.0.0.1:9999', weight=2)
+
+    def testParseErrors(self):
+        self.assertRaises(UpstreamError, parse, "upstream zopectls {\n    server 127.0.0.1:9081;\n")
+        self.assertRaises(UpstreamError, parse, "upstream zopectls {\n    what is this\n}\n")
+        self.assertRaises(UpstreamError, parse, "upstream zopectls {\n    server ;\n}\n")
+
+
+class TestEdit(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'nginx-zope.conf')
+        with open(self.path, 'w') as f:
+            f.write(CONF)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def run_main(self, *args, **kwargs):
+        saved = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin, sys.stdout, sys.stderr = StringIO(kwargs.get('input', '')), StringIO(), StringIO()
+        try:
+            return upstream.main(['--conf', self.path] + list(args))
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+
+    def testWritesChanges(self):
+        with edit(self.path) as conf:
+            conf.set_server('127.0.0.1:9081', weight=5)
+        self.assertTrue('server 127.0.0.1:9081 weight=5 max_fails=3 fail_timeout=10s;' in self.read())
+
+    def testRestoreOnFailure(self):
+        try:
+            with edit(self.path) as conf:
+                conf.remove_server('127.0.0.1:9081')
+                conf.add_server('127.0.0.1:9085')
+                raise RuntimeError("failed")
+        except RuntimeError:
+            pass
+        self.assertEqual(self.read(), CONF)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['nginx-zope.conf', 'nginx-zope.conf.lock'])
+
+    def testBatchExitCodes(self):
+        # Changing servers of active upstreams only
+        self.assertEqual(self.run_main('batch', input="add 9084 weight=2\nremove 9082\n"), 0)
+        self.assertEqual(UpstreamConf.load(self.path).find('127.0.0.1:9084')[1].weight, 2)
+        # A pool gaining its first server
+        self.assertEqual(self.run_main('batch', input="add 9085 zopectls_exports\n"), 2)
+        # A pool losing its last one
+        self.assertEqual(self.run_main('remove', '9083'), 2)
+        self.assertEqual(UpstreamConf.load(self.path).upstream('zopectls_reports'), None)
+
+    def testBatchIsAtomic(self):
+        self.assertEqual(self.run_main('batch', input="add 9084\nbogus command\n"), 1)
+        self.assertEqual(self.read(), CONF)
+
+    def testHas(self):
+        self.assertEqual(self.run_main('has', '9081'), 0)
+        self.assertEqual(self.run_main('has', '9099'), 1)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestUpstreamConf))
+    suite.addTest(makeSuite(TestEdit))
+    return suite
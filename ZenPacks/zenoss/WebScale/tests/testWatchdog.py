@@ -0,0 +1,139 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Tests of the watchdog's sampling and of its choice of the instance to
+recycle.
+"""
+
+import unittest
+
+from ZenPacks.zenoss.WebScale import watchdog
+from ZenPacks.zenoss.WebScale.watchdog import HOUR, InstanceUsage, RecyclePolicy, UsageSampler
+
+MB = 1024
+
+
+class Instance(object):
+
+    def __init__(self, num, pid):
+        self.num = num
+        self.pid = pid
+
+
+def usage(num, pid, rss_mb, cpu=None):
+    return InstanceUsage(Instance(num, pid), pid, rss_mb * MB, cpu)
+
+
+class TestPolicy(unittest.TestCase):
+
+    def testConsecutiveSamples(self):
+        policy = RecyclePolicy(max_rss_kb=500 * MB, samples=3)
+        self.assertEqual(policy.decide([usage(1, 100, 600)], 0), (None, None))
+        self.assertEqual(policy.decide([usage(1, 100, 600)], 60), (None, None))
+        chosen, reason = policy.decide([usage(1, 100, 600)], 120)
+        self.assertEqual(chosen.instance.num, 1)
+        self.assertEqual(reason, "rss 600MB above 500MB for 3 samples")
+
+    def testCountStartsOverUnderLimits(self):
+        policy = RecyclePolicy(max_rss_kb=500 * MB, samples=2)
+        policy.decide([usage(1, 100, 600)], 0)
+        policy.decide([usage(1, 100, 400)], 60)
+        self.assertEqual(policy.decide([usage(1, 100, 600)], 120), (None, None))
+        self.assertEqual(policy.decide([usage(1, 100, 600)], 180)[0].pid, 100)
+
+    def testCountStartsOverForNewPid(self):
+        policy = RecyclePolicy(max_rss_kb=500 * MB, samples=2)
+        policy.decide([usage(1, 100, 600)], 0)
+        # The instance was restarted by someone else: its new process is
+        # counted from its own first sample
+        self.assertEqual(policy.decide([usage(1, 200, 600)], 60), (None, None))
+        self.assertEqual(policy.decide([usage(1, 200, 600)], 120)[0].pid, 200)
+
+    def testLargestFirst(self):
+        policy = RecyclePolicy(max_rss_kb=500 * MB, max_cpu=90, samples=1)
+        usages = [usage(1, 100, 600), usage(2, 200, 800), usage(3, 300, 700), usage(4, 400, 900, cpu=50)]
+        self.assertEqual(policy.decide(usages, 0)[0].instance.num, 4)
+        # Instances over the CPU limit are also chosen by their size
+        usages[3] = usage(4, 400, 100, cpu=95)
+        usages.append(usage(5, 500, 450, cpu=99))
+        chosen, reason = policy.decide(usages, 60)
+        self.assertEqual(chosen.instance.num, 2)
+        self.assertEqual(reason, "rss 800MB above 500MB for 2 samples")
+
+    def testCpu(self):
+        policy = RecyclePolicy(max_cpu=90, samples=1)
+        # The first sample of a process has no CPU use
+        self.assertEqual(policy.decide([usage(1, 100, 600)], 0), (None, None))
+        chosen, reason = policy.decide([usage(1, 100, 600, cpu=95)], 60)
+        self.assertEqual(reason, "cpu 95% above 90% for 1 samples")
+
+    def testHourlyCap(self):
+        policy = RecyclePolicy(max_rss_kb=500 * MB, samples=1, max_per_hour=2)
+        policy.recycled(0)
+        policy.recycled(600)
+        self.assertEqual(policy.recycles_last_hour(1200), 2)
+        chosen, reason = policy.decide([usage(1, 100, 600)], 1200)
+        self.assertEqual(chosen, None)
+        self.assertEqual(reason, "server 1 is over its limits (rss 600MB above 500MB), "
+                                 "but 2 recycles were made in the past hour")
+        # The first recycle leaves the window an hour after it was made
+        self.assertEqual(policy.recycles_last_hour(HOUR), 1)
+        self.assertEqual(policy.decide([usage(1, 100, 600)], HOUR)[0].pid, 100)
+
+    def testNoCap(self):
+        policy = RecyclePolicy(max_rss_kb=500 * MB, samples=1, max_per_hour=0)
+        for now in range(10):
+            policy.recycled(now)
+        self.assertEqual(policy.decide([usage(1, 100, 600)], 10)[0].pid, 100)
+
+
+class TestSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = watchdog.instances, watchdog.pid_rss_kb, watchdog.pid_cpu_seconds
+        self.procs = {}
+        self.running = []
+        watchdog.instances = lambda: self.running
+        watchdog.pid_rss_kb = lambda pid: self.procs.get(pid, (None, None))[0]
+        watchdog.pid_cpu_seconds = lambda pid: self.procs.get(pid, (None, None))[1]
+
+    def tearDown(self):
+        watchdog.instances, watchdog.pid_rss_kb, watchdog.pid_cpu_seconds = self.saved
+
+    def testCpu(self):
+        sampler = UsageSampler()
+        self.running = [Instance(1, 100), Instance(2, None)]
+        self.procs = {100: (600 * MB, 10.0)}
+        usages = sampler.sample(0)
+        self.assertEqual([(u.instance.num, u.rss_kb, u.cpu) for u in usages], [(1, 600 * MB, None)])
+        self.procs = {100: (650 * MB, 40.0)}
+        self.assertEqual(sampler.sample(60)[0].cpu, 50.0)
+
+    def testNewPid(self):
+        sampler = UsageSampler()
+        self.running = [Instance(1, 100)]
+        self.procs = {100: (600 * MB, 10.0)}
+        sampler.sample(0)
+        self.running = [Instance(1, 200)]
+        self.procs = {200: (100 * MB, 1.0)}
+        self.assertEqual(sampler.sample(60)[0].cpu, None)
+        # A process that is gone is forgotten
+        self.running = [Instance(1, 100)]
+        self.procs = {100: (600 * MB, 20.0)}
+        self.assertEqual(sampler.sample(120)[0].cpu, None)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestPolicy))
+    suite.addTest(makeSuite(TestSampler))
+    return suite
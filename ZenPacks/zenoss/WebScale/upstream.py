@@ -0,0 +1,562 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Model of the upstream blocks of $ZENHOME/etc/nginx-zope.conf.
+
+UpstreamConf parses the file into upstream blocks holding the balancing
+directive, keepalive and servers with their parameters (weight, max_fails,
+fail_timeout, backup, down and any other). Rendering an unmodified model
+reproduces the file exactly: only the lines of servers and directives that
+were changed are rewritten, and comments and unknown directives are kept.
+
+edit() is a transaction: it locks the file, yields its model for any number
+of changes and writes the result once, atomically, if anything changed.
+
+    with edit() as conf:
+        conf.add_server('127.0.0.1:9081', weight=2)
+        conf.remove_server('127.0.0.1:9082')
+
+Note that the fair balancer does not support the backup parameter.
+
+Usage: zenwebserver upstream {list|has|add|remove|set|batch} ...
+"""
+
+import os
+import re
+import sys
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+zenhome = os.getenv('ZENHOME', '')
+
+NGINX_ZOPE_CONF = os.path.join(zenhome, 'etc', 'nginx-zope.conf')
+
+DEFAULT_UPSTREAM = 'zopectls'
+DEFAULT_BALANCER = 'fair'
+
+# Directives that select the balancing method of an upstream
+BALANCERS = ('fair', 'least_conn', 'ip_hash', 'hash', 'sticky')
+
+# Known server parameters, in the order they are written
+SERVER_PARAMS = ('weight', 'max_fails', 'fail_timeout', 'backup', 'down')
+
+_UPSTREAM_PATTERN = re.compile(r'^\s*upstream\s+(\S+)\s*\{\s*$')
+_END_PATTERN = re.compile(r'^\s*\}\s*$')
+_DIRECTIVE_PATTERN = re.compile(r'^\s*(\w+)((?:\s+[^;#]*?)?)\s*;\s*(#.*)?$')
+
+_INDENT = '    '
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class Directive(object):
+    """
+    A line of an upstream block: a directive, comment or blank line. Lines
+    are rendered as read until they are changed.
+    """
+
+    def __init__(self, text, name=None, args=''):
+        self.text = text
+        self.name = name
+        self.args = args
+
+    @classmethod
+    def create(cls, name, args=''):
+        directive = cls(None, name, args)
+        directive.modified()
+        return directive
+
+    def modified(self):
+        self.text = None
+
+    def render(self):
+        if self.text is not None:
+            return self.text
+        return '%s%s%s;\n' % (_INDENT, self.name, ' ' + self.args if self.args else '')
+
+
+class Server(Directive):
+    """
+    A server line; params is a list of (name, value) pairs, value None for
+    flags such as "down".
+    """
+
+    def __init__(self, text, address, params=()):
+        Directive.__init__(self, text, 'server')
+        self.address = address
+        self.params = list(params)
+
+    @classmethod
+    def parse_args(cls, text, args):
+        parts = args.split()
+        params = []
+        for part in parts[1:]:
+            name, sep, value = part.partition('=')
+            params.append((name, value if sep else None))
+        return cls(text, parts[0], params)
+
+    def get(self, name, default=None):
+        for key, value in self.params:
+            if key == name:
+                return True if value is None else value
+        return default
+
+    def set(self, name, value):
+        """
+        Sets a parameter; None or False removes it, True sets a flag.
+        """
+        params = [(k, v) for k, v in self.params if k != name]
+        if value is not None and value is not False:
+            params.append((name, None if value is True else str(value)))
+        order = dict((k, i) for i, k in enumerate(SERVER_PARAMS))
+        params.sort(key=lambda p: order.get(p[0], len(SERVER_PARAMS)))
+        if params != self.params:
+            self.params = params
+            self.modified()
+            return True
+        return False
+
+    @property
+    def weight(self):
+        try:
+            return int(self.get('weight', 1))
+        except ValueError:
+            return 1
+
+    @property
+    def port(self):
+        try:
+            return int(self.address.rsplit(':', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def describe(self):
+        return self.address + ''.join(' %s' % k if v is None else ' %s=%s' % (k, v) for k, v in self.params)
+
+    def render(self):
+        if self.text is not None:
+            return self.text
+        return '%sserver %s;\n' % (_INDENT, self.describe())
+
+    def __repr__(self):
+        return "Server<%s>" % self.describe()
+
+
+class Upstream(object):
+    """
+    An upstream block.
+    """
+
+    def __init__(self, name, header=None, footer=None):
+        self.name = name
+        self.header = header or 'upstream %s {\n' % name
+        self.footer = footer or '}\n'
+        self.lines = []
+
+    @property
+    def servers(self):
+        return [line for line in self.lines if isinstance(line, Server)]
+
+    def _directive(self, names):
+        for line in self.lines:
+            if line.name in names and not isinstance(line, Server):
+                return line
+        return None
+
+    @property
+    def balancer(self):
+        """
+        The balancing directive, e.g. 'fair' or 'hash $cookie_x', or '' for
+        round robin.
+        """
+        directive = self._directive(BALANCERS)
+        if directive is None:
+            return ''
+        return ('%s %s' % (directive.name, directive.args)).strip()
+
+    def set_balancer(self, balancer):
+        directive = self._directive(BALANCERS)
+        if (directive and self.balancer == balancer) or (not directive and not balancer):
+            return False
+        if directive:
+            self.lines.remove(directive)
+        if balancer:
+            name, _, args = balancer.partition(' ')
+            # The balancer has to precede keepalive and servers
+            self.lines.insert(0, Directive.create(name, args.strip()))
+        return True
+
+    @property
+    def keepalive(self):
+        directive = self._directive(('keepalive',))
+        try:
+            return int(directive.args) if directive else 0
+        except ValueError:
+            return 0
+
+    def set_keepalive(self, keepalive):
+        directive = self._directive(('keepalive',))
+        if directive and keepalive > 0 and directive.args == str(keepalive):
+            return False
+        if not directive and keepalive <= 0:
+            return False
+        if directive:
+            self.lines.remove(directive)
+        if keepalive > 0:
+            # keepalive has to follow the balancer; it is kept last
+            self.lines.append(Directive.create('keepalive', str(keepalive)))
+        return True
+
+    def server(self, address):
+        for server in self.servers:
+            if server.address == address:
+                return server
+        return None
+
+    def add_server(self, address, **params):
+        server = Server(None, address)
+        for name, value in params.items():
+            server.set(name, value)
+        server.modified()
+        # Servers go after the other servers, before keepalive
+        index = len(self.lines)
+        for i, line in enumerate(self.lines):
+            if isinstance(line, Server):
+                index = i + 1
+        if not self.servers:
+            balancer = self._directive(BALANCERS)
+            index = self.lines.index(balancer) + 1 if balancer else 0
+        self.lines.insert(index, server)
+        return server
+
+    def remove_server(self, address):
+        server = self.server(address)
+        if server is None:
+            return False
+        self.lines.remove(server)
+        return True
+
+    def render(self):
+        return self.header + ''.join(line.render() for line in self.lines) + self.footer
+
+
+class UpstreamConf(object):
+    """
+    The upstream blocks of an nginx-zope.conf and the text around them.
+    """
+
+    def __init__(self, path=NGINX_ZOPE_CONF):
+        self.path = path
+        # Strings (text outside of blocks) and Upstream objects, in order
+        self.parts = []
+        self._original = ''
+
+    @classmethod
+    def load(cls, path=NGINX_ZOPE_CONF):
+        conf = cls(path)
+        try:
+            with open(path, 'r') as f:
+                conf.parse(f.read())
+        except IOError:
+            pass
+        return conf
+
+    def parse(self, text):
+        self._original = text
+        self.parts = []
+        upstream = None
+        for number, line in enumerate(text.splitlines(True), 1):
+            if upstream is None:
+                m = _UPSTREAM_PATTERN.match(line)
+                if m:
+                    upstream = Upstream(m.group(1), header=line)
+                    self.parts.append(upstream)
+                else:
+                    self.parts.append(line)
+                continue
+            if _END_PATTERN.match(line):
+                upstream.footer = line if line.endswith('\n') else line + '\n'
+                upstream = None
+                continue
+            m = _DIRECTIVE_PATTERN.match(line)
+            if m and m.group(1) == 'server':
+                if not m.group(2).strip():
+                    raise UpstreamError("%s:%d: server without address" % (self.path, number))
+                upstream.lines.append(Server.parse_args(line, m.group(2)))
+            elif m:
+                upstream.lines.append(Directive(line, m.group(1), m.group(2).strip()))
+            elif line.strip() and not line.strip().startswith('#'):
+                raise UpstreamError("%s:%d: cannot parse %r" % (self.path, number, line.strip()))
+            else:
+                upstream.lines.append(Directive(line))
+        if upstream is not None:
+            raise UpstreamError("%s: upstream %s is not closed" % (self.path, upstream.name))
+
+    def render(self):
+        return ''.join(part if isinstance(part, basestring) else part.render() for part in self.parts)
+
+    @property
+    def changed(self):
+        return self.render() != self._original
+
+    @property
+    def upstreams(self):
+        return [part for part in self.parts if isinstance(part, Upstream)]
+
+    def upstream(self, name):
+        for upstream in self.upstreams:
+            if upstream.name == name:
+                return upstream
+        return None
+
+    def add_upstream(self, name, balancer=DEFAULT_BALANCER):
+        """
+        Appends an upstream, with the keepalive setting of the default one.
+        """
+        upstream = Upstream(name)
+        upstream.set_balancer(balancer)
+        default = self.upstream(DEFAULT_UPSTREAM)
+        if default is not None:
+            upstream.set_keepalive(default.keepalive)
+        if self.parts:
+            if isinstance(self.parts[-1], basestring) and not self.parts[-1].endswith('\n'):
+                self.parts[-1] += '\n'
+            self.parts.append('\n')
+        self.parts.append(upstream)
+        return upstream
+
+    def remove_upstream(self, name):
+        upstream = self.upstream(name)
+        if upstream is None:
+            return
+        index = self.parts.index(upstream)
+        del self.parts[index]
+        # Along with the blank line that separated it from the previous block
+        if index > 0 and self.parts[index - 1] == '\n':
+            del self.parts[index - 1]
+
+    def servers(self):
+        """
+        Returns (upstream name, Server) for every server.
+        """
+        return [(upstream.name, server) for upstream in self.upstreams for server in upstream.servers]
+
+    def find(self, address):
+        """
+        Returns (upstream, server) of the first server with address, or
+        (None, None).
+        """
+        for upstream in self.upstreams:
+            server = upstream.server(address)
+            if server is not None:
+                return upstream, server
+        return None, None
+
+    def active_upstreams(self):
+        return set(upstream.name for upstream in self.upstreams if upstream.servers)
+
+    def add_server(self, address, upstream=DEFAULT_UPSTREAM, **params):
+        """
+        Adds a server to an upstream, creating the upstream if needed, or
+        updates its parameters if it is already there. Returns the Server.
+        """
+        current, server = self.find(address)
+        if server is not None and current.name != upstream:
+            current.remove_server(address)
+            server = None
+        if server is None:
+            block = self.upstream(upstream) or self.add_upstream(upstream)
+            return block.add_server(address, **params)
+        for name, value in params.items():
+            server.set(name, value)
+        return server
+
+    def remove_server(self, address, drop_empty=True):
+        """
+        Removes a server from every upstream. Upstreams left without servers
+        fail "nginx -t", so they are dropped, except the default one.
+        """
+        removed = False
+        for upstream in self.upstreams:
+            if upstream.remove_server(address):
+                removed = True
+                if drop_empty and not upstream.servers and upstream.name != DEFAULT_UPSTREAM:
+                    self.remove_upstream(upstream.name)
+        return removed
+
+    def set_server(self, address, **params):
+        upstream, server = self.find(address)
+        if server is None:
+            raise UpstreamError("No server %s in %s" % (address, self.path))
+        changed = False
+        for name, value in params.items():
+            changed |= server.set(name, value)
+        return changed
+
+    def set_keepalive(self, keepalive):
+        changed = False
+        for upstream in self.upstreams:
+            changed |= upstream.set_keepalive(keepalive)
+        return changed
+
+    def write(self):
+        """
+        Replaces the file with the rendered model in one rename.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.nginx-zope.conf.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            if os.path.exists(self.path):
+                os.chmod(tmp_path, os.stat(self.path).st_mode & 0777)
+            else:
+                os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._original = self.render()
+
+
+@contextmanager
+def edit(path=NGINX_ZOPE_CONF):
+    """
+    Yields the UpstreamConf of path for changes, holding a lock on it so
+    concurrent edits do not overwrite each other, and writes it once when
+    the block completes without an exception and something changed.
+    """
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            conf = UpstreamConf.load(path)
+            yield conf
+            if conf.changed:
+                conf.write()
+                # Home Zopes of the session buckets follow the pool
+                from affinity import sync_affinity_conf
+                sync_affinity_conf(conf)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def parse_params(args):
+    """
+    Parses "name=value" and flag arguments into keyword arguments. "name="
+    removes a parameter, "-flag" clears a flag.
+    """
+    params = {}
+    for arg in args:
+        name, sep, value = arg.partition('=')
+        if sep:
+            params[name] = value or None
+        elif name.startswith('-'):
+            params[name[1:]] = False
+        else:
+            params[name] = True
+    return params
+
+
+def _address(value):
+    # A bare port is a local Zope
+    return '127.0.0.1:%s' % value if value.isdigit() else value
+
+
+def apply_command(conf, words):
+    """
+    Applies one command to conf. Returns an exit status.
+    """
+    command, args = words[0], words[1:]
+    if command == 'add' and args:
+        upstream = DEFAULT_UPSTREAM
+        if len(args) > 1 and '=' not in args[1] and not args[1].startswith('-'):
+            upstream = args[1]
+            params = parse_params(args[2:])
+        else:
+            params = parse_params(args[1:])
+        conf.add_server(_address(args[0]), upstream, **params)
+    elif command == 'remove' and args:
+        for address in args:
+            conf.remove_server(_address(address))
+    elif command == 'set' and len(args) > 1:
+        conf.set_server(_address(args[0]), **parse_params(args[1:]))
+    elif command == 'keepalive' and len(args) == 1:
+        conf.set_keepalive(int(args[0]))
+    else:
+        raise UpstreamError("Invalid command: %s" % ' '.join(words))
+    return 0
+
+
+USAGE = """Usage: upstream.py [--conf PATH] COMMAND
+  list                           Show the upstreams and their servers
+  has ADDRESS                    Exit 0 if ADDRESS is a server of any upstream
+  count UPSTREAM                 Show the number of servers of UPSTREAM
+  add ADDRESS [UPSTREAM] [PARAM ...]
+                                 Add a server or update its parameters
+  remove ADDRESS ...             Remove servers; emptied pools are dropped
+  set ADDRESS PARAM ...          Change the parameters of a server
+  keepalive N                    Set keepalive in every upstream
+  batch                          Apply the commands on standard input, one
+                                 per line, in a single write
+ADDRESS is host:port, or a port of this host. PARAM is name=value to set,
+name= to remove, flag to set and -flag to clear a flag (backup, down).
+Commands that change which upstreams have servers exit with 2."""
+
+
+def main(argv=None):
+    args = list(sys.argv[1:] if argv is None else argv)
+    path = NGINX_ZOPE_CONF
+    if len(args) > 1 and args[0] == '--conf':
+        path = args[1]
+        args = args[2:]
+    if not args or args[0] in ('-h', '--help'):
+        print USAGE
+        return 0 if args else 1
+
+    try:
+        if args[0] == 'list':
+            for upstream in UpstreamConf.load(path).upstreams:
+                print "%s (%s)%s" % (upstream.name, upstream.balancer or 'round robin',
+                                     ' keepalive %d' % upstream.keepalive if upstream.keepalive else '')
+                for server in upstream.servers:
+                    print "    %s" % server.describe()
+            return 0
+        if args[0] == 'has' and len(args) == 2:
+            upstream, server = UpstreamConf.load(path).find(_address(args[1]))
+            return 0 if server is not None else 1
+        if args[0] == 'count' and len(args) == 2:
+            upstream = UpstreamConf.load(path).upstream(args[1])
+            print len(upstream.servers) if upstream else 0
+            return 0
+
+        if args[0] == 'batch':
+            commands = [line.split() for line in sys.stdin if line.strip()]
+        else:
+            commands = [args]
+        with edit(path) as conf:
+            before = conf.active_upstreams()
+            for words in commands:
+                apply_command(conf, words)
+            after = conf.active_upstreams()
+        return 2 if before != after else 0
+    except (UpstreamError, ValueError) as e:
+        print >> sys.stderr, e
+        return 1
+    except (IOError, OSError) as e:
+        print >> sys.stderr, "Unable to update %s: %s" % (path, e)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Memory and CPU watchdog recycling the Zope instances of the pool.
+
+Zopes grow in resident size over time. Every interval, the resident size
+and CPU use of each instance are read from /proc for the pid in its
+var/zope<N>/Z2.pid. An instance over watchdog_max_rss, or over
+watchdog_max_cpu, for watchdog_samples samples in a row is recycled with a
+rolling restart: detached from nginx-zope.conf, drained, restarted, probed
+for readiness and attached again. At most one instance is recycled per
+interval, the largest first, and no more than watchdog_max_recycles per
+hour, so a leak affecting every instance does not keep the pool cycling.
+
+Usage: zenwebserver watchdog {run|start|stop|status} [options]
+"""
+
+import sys
+import time
+import signal
+import logging
+from collections import deque
+from optparse import OptionParser
+
+from pool import instances, rolling_restart_from_config
+from procutil import pid_rss_kb, pid_cpu_seconds
+from webserverconf import load_settings
+
+log = logging.getLogger('zen.webscale.watchdog')
+
+HOUR = 3600
+
+
+class InstanceUsage(object):
+    """
+    Resident size and CPU use of one instance over the last interval.
+    """
+
+    def __init__(self, instance, pid, rss_kb, cpu):
+        self.instance = instance
+        self.pid = pid
+        self.rss_kb = rss_kb
+        # Percent of one CPU, or None for the first sample of a process
+        self.cpu = cpu
+
+    def __str__(self):
+        cpu = '-' if self.cpu is None else '%.0f%%' % self.cpu
+        return "server %d pid=%d rss=%dMB cpu=%s" % (self.instance.num, self.pid, self.rss_kb / 1024, cpu)
+
+
+class UsageSampler(object):
+    """
+    Reads the usage of the running instances, keeping the CPU time of every
+    process to measure its CPU use between samples.
+    """
+
+    def __init__(self):
+        self._cpu = {}
+
+    def sample(self, now=None):
+        now = time.time() if now is None else now
+        usages = []
+        cpu_times = {}
+        for instance in instances():
+            pid = instance.pid
+            rss = pid_rss_kb(pid) if pid else None
+            seconds = pid_cpu_seconds(pid) if pid else None
+            if rss is None or seconds is None:
+                continue
+            cpu = None
+            previous = self._cpu.get(pid)
+            if previous and now > previous[0]:
+                cpu = 100.0 * (seconds - previous[1]) / (now - previous[0])
+            cpu_times[pid] = (now, seconds)
+            usages.append(InstanceUsage(instance, pid, rss, cpu))
+        # Forget the processes that are gone
+        self._cpu = cpu_times
+        return usages
+
+
+class RecyclePolicy(object):
+    """
+    Decides which instance to recycle. An instance is over its limits when
+    its resident size is above max_rss_kb or its CPU use above max_cpu (0
+    disables either); it is recycled once it has been over them for samples
+    consecutive samples, unless max_per_hour recycles were made in the past
+    hour.
+    """
+
+    def __init__(self, max_rss_kb=0, max_cpu=0.0, samples=3, max_per_hour=4):
+        self.max_rss_kb = max_rss_kb
+        self.max_cpu = max_cpu
+        self.samples = max(samples, 1)
+        self.max_per_hour = max_per_hour
+        self._over = {}
+        self._recycles = deque()
+
+    def _reasons(self, usage):
+        reasons = []
+        if self.max_rss_kb and usage.rss_kb > self.max_rss_kb:
+            reasons.append("rss %dMB above %dMB" % (usage.rss_kb / 1024, self.max_rss_kb / 1024))
+        if self.max_cpu and usage.cpu is not None and usage.cpu > self.max_cpu:
+            reasons.append("cpu %.0f%% above %.0f%%" % (usage.cpu, self.max_cpu))
+        return reasons
+
+    def recycles_last_hour(self, now):
+        while self._recycles and now - self._recycles[0] >= HOUR:
+            self._recycles.popleft()
+        return len(self._recycles)
+
+    def recycled(self, now):
+        self._recycles.append(now)
+
+    def decide(self, usages, now):
+        """
+        Returns (usage, reason) of the instance to recycle, or (None, reason)
+        if there is none; reason is None if no instance is over its limits.
+        """
+        over = {}
+        candidates = []
+        for usage in usages:
+            reasons = self._reasons(usage)
+            if not reasons:
+                continue
+            count = self._over.get(usage.pid, 0) + 1
+            over[usage.pid] = count
+            if count >= self.samples:
+                candidates.append((usage.rss_kb, usage, ', '.join(reasons)))
+        # Counts of processes under their limits or gone start over
+        self._over = over
+        if not candidates:
+            return None, None
+        rss, usage, reason = max(candidates)
+        if self.max_per_hour and self.recycles_last_hour(now) >= self.max_per_hour:
+            return None, "server %d is over its limits (%s), but %d recycles were made in the past hour" % (
+                usage.instance.num, reason, self.max_per_hour)
+        return usage, "%s for %d samples" % (reason, self._over[usage.pid])
+
+
+def policy_from_config(config):
+    return RecyclePolicy(max_rss_kb=max(config['watchdog_max_rss'], 0) * 1024,
+                         max_cpu=max(config['watchdog_max_cpu'], 0.0),
+                         samples=config['watchdog_samples'],
+                         max_per_hour=max(config['watchdog_max_recycles'], 0))
+
+
+class _LogOutput(object):
+    """
+    File-like object logging the progress lines of a rolling restart.
+    """
+
+    def write(self, text):
+        if text.strip():
+            log.info(text.strip())
+
+    def flush(self):
+        pass
+
+
+class Watchdog(object):
+    """
+    Samples the instances every interval seconds and recycles the one the
+    policy picks.
+    """
+
+    def __init__(self, policy, restarter, interval=60, dry_run=False):
+        self.policy = policy
+        self.restarter = restarter
+        self.interval = interval
+        self.dry_run = dry_run
+        self._sampler = UsageSampler()
+        self._running = False
+
+    def recycle(self, usage):
+        if self.dry_run:
+            log.info("Dry run: would recycle server %d", usage.instance.num)
+            return True
+        result = self.restarter.run([usage.instance])[0]
+        if result.failed:
+            log.error("Recycling server %d failed after %.0fs: %s",
+                      usage.instance.num, result.elapsed, result.output)
+        else:
+            log.info("Recycled server %d in %.0fs", usage.instance.num, result.elapsed)
+        return not result.failed
+
+    def step(self):
+        now = time.time()
+        usages = self._sampler.sample(now)
+        for usage in usages:
+            log.debug("Sample: %s", usage)
+        usage, reason = self.policy.decide(usages, now)
+        if usage is not None:
+            log.info("Recycling server %d: %s (%s)", usage.instance.num, reason, usage)
+            # A failed recycle counts too, rather than retrying every interval
+            self.recycle(usage)
+            self.policy.recycled(now)
+        elif reason:
+            log.warning(reason)
+
+    def stop(self, *args):
+        self._running = False
+
+    def run(self):
+        self._running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        policy = self.policy
+        log.info("Watching the Zope servers every %ds: rss limit %s, cpu limit %s, "
+                 "%d samples, at most %s recycles per hour", self.interval,
+                 '%dMB' % (policy.max_rss_kb / 1024) if policy.max_rss_kb else 'off',
+                 '%.0f%%' % policy.max_cpu if policy.max_cpu else 'off',
+                 policy.samples, policy.max_per_hour or 'unlimited')
+        while self._running:
+            try:
+                self.step()
+            except Exception:
+                log.exception("Watchdog step failed")
+            deadline = time.time() + self.interval
+            while self._running and time.time() < deadline:
+                time.sleep(min(1, deadline - time.time()))
+        log.info("Watchdog stopped")
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Recycles Zope servers whose memory or CPU use stays above "
+                                      "the limits set by the watchdog_* options in zenwebserver.conf.")
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help="Log recycling decisions without restarting servers")
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help="Log every sample")
+    options, args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    config = load_settings()
+    policy = policy_from_config(config)
+    if not policy.max_rss_kb and not policy.max_cpu:
+        log.warning("Neither watchdog_max_rss nor watchdog_max_cpu is set; no server will be recycled")
+    restarter = rolling_restart_from_config(config)
+    restarter.out = _LogOutput()
+    watchdog = Watchdog(policy, restarter, interval=max(config['watchdog_interval'], 1),
+                        dry_run=options.dry_run)
+    watchdog.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
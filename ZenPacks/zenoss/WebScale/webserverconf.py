@@ -0,0 +1,262 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2013, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+
+"""
+Settings of $ZENHOME/etc/zenwebserver.conf.
+
+load_settings() returns the parsed file as a Settings object, typed
+according to SCHEMA, which lists every setting with its default: those of
+nginx.conf and those of the helper scripts alike. The result is cached per
+process and file; the file is only parsed again when its inode,
+modification time or size changes, and checked for that at most once every
+CHECK_INTERVAL seconds, so code reading settings many times per request
+does no repeated file I/O.
+"""
+
+import os
+import time
+import threading
+import urllib2
+
+zenhome = os.getenv('ZENHOME', '')
+
+WEBSERVER_CONF = os.path.join(zenhome, 'etc', 'zenwebserver.conf')
+
+# Seconds during which a cached file is used without checking it for changes
+CHECK_INTERVAL = 1.0
+
+
+def parse_bool(value):
+    return value.lower() == 'true'
+
+
+class Setting(object):
+    """
+    A zenwebserver.conf key with its type and default. Values that cannot be
+    converted to the type yield the default.
+    """
+
+    def __init__(self, name, type, default):
+        self.name = name
+        self.type = type
+        self.default = default
+
+    def parse(self, value):
+        try:
+            if self.type is bool:
+                return parse_bool(value)
+            return self.type(value)
+        except ValueError:
+            return self.default
+
+
+_nginx_var = os.path.join(zenhome, 'var', 'nginx')
+_etc = os.path.join(zenhome, 'etc')
+
+SCHEMA = dict((setting.name, setting) for setting in (
+    Setting('useSSL', bool, False),
+    Setting('httpPort', int, 8080),
+    Setting('sslPort', int, 443),
+    Setting('sslCert', str, os.path.join(_etc, 'ssl', 'zenoss.crt')),
+    Setting('sslKey', str, os.path.join(_etc, 'ssl', 'zenoss.key')),
+    Setting('worker_processes', str, 'auto'),
+    Setting('worker_connections', str, 'auto'),
+    Setting('worker_rlimit_nofile', str, 'auto'),
+    Setting('worker_cpu_affinity', str, 'off'),
+    Setting('proxy_cache_path', str, os.path.join(_nginx_var, 'cache')),
+    Setting('proxy_temp_path', str, os.path.join(_nginx_var, 'tmp', 'proxy')),
+    Setting('client_body_temp_path', str, os.path.join(_nginx_var, 'tmp', 'client_body')),
+    Setting('customServerInclude', str, os.path.join(_etc, 'nginx-custom-server-*.conf')),
+    Setting('customHttpInclude', str, os.path.join(_etc, 'nginx-custom-http-*.conf')),
+    Setting('error_log_level', str, 'warn'),
+    Setting('zope_keepalive', int, 8),
+    Setting('zope_max_fails', int, None),
+    Setting('zope_fail_timeout', str, None),
+    Setting('static_cache_valid', str, '60m'),
+    Setting('static_cache_lock', bool, True),
+    Setting('static_cache_lock_timeout', int, 30),
+    Setting('static_cache_use_stale', str, 'error timeout updating http_500 http_502 http_503 http_504'),
+    Setting('microcache', bool, False),
+    Setting('microcache_ttl', int, 2),
+    Setting('microcache_path', str, os.path.join(_nginx_var, 'cache-micro')),
+    Setting('microcache_methods', str, 'DeviceRouter.getTree DeviceRouter.getComponentTree '
+                                       'DeviceRouter.getDevices DeviceRouter.getInfo '
+                                       'DeviceRouter.getComponents EventsRouter.query'),
+    Setting('dc_render_cache_collector', int, 0),
+    Setting('dc_render_cache_hub', int, 0),
+    Setting('dc_render_cache_stale', int, 600),
+    Setting('dc_render_cache_lock_timeout', int, 30),
+    Setting('dc_render_cache_path', str, os.path.join(_nginx_var, 'cache-render')),
+    Setting('affinity', bool, False),
+    Setting('affinity_cookie', str, '_ZopeId'),
+    Setting('affinity_threads', int, 4),
+    Setting('limits', bool, False),
+    Setting('limit_key', str, 'session'),
+    Setting('limit_rate', str, '20r/s'),
+    Setting('limit_burst', int, 40),
+    Setting('limit_conn', int, 16),
+    Setting('limit_status', int, 429),
+    Setting('limit_retry_after', int, 5),
+    Setting('limit_zone_size', str, '10m'),
+    # Helper scripts
+    Setting('readiness_path', str, '/zport/dmd'),
+    Setting('readiness_budget', float, 2.0),
+    Setting('readiness_successes', int, 2),
+    Setting('readiness_timeout', int, 300),
+    Setting('readiness_warmup_file', str, None),
+    Setting('readiness_warmup_auth', str, None),
+    Setting('readiness_statuses', str, '2xx 3xx'),
+    Setting('rolling_min_live', int, 1),
+    Setting('rolling_drain_timeout', int, 60),
+    Setting('autoscale_min_servers', int, 2),
+    Setting('autoscale_max_servers', int, 8),
+    Setting('autoscale_interval', int, 15),
+    Setting('autoscale_cooldown', int, 300),
+    Setting('autoscale_up_latency', float, 2.0),
+    Setting('autoscale_down_latency', float, 0.5),
+    Setting('autoscale_up_busy', float, 2.0),
+    Setting('autoscale_down_busy', float, 0.25),
+    Setting('autoscale_up_samples', int, 2),
+    Setting('autoscale_down_samples', int, 10),
+    Setting('autoscale_max_cpu', float, 85.0),
+    Setting('autoscale_mem_reserve', int, 512),
+    Setting('watchdog_interval', int, 60),
+    Setting('watchdog_max_rss', int, 2048),
+    Setting('watchdog_max_cpu', float, 0.0),
+    Setting('watchdog_samples', int, 3),
+    Setting('watchdog_max_recycles', int, 4),
+    Setting('exporter_address', str, '127.0.0.1'),
+    Setting('exporter_port', int, 9180),
+    Setting('exporter_interval', int, 15),
+    Setting('cache_warm', bool, True),
+    Setting('cache_warm_manifest', str, None),
+    Setting('cache_warm_top', int, 500),
+    Setting('cache_warm_concurrency', int, 4),
+    Setting('cache_warm_budget', float, 60.0),
+    Setting('cache_version', str, None),
+    Setting('dc_reload_window', float, 5.0),
+    Setting('dc_keepalive', int, 8),
+    # Read by the zenwebserver script
+    Setting('lifecycle_concurrency', int, 1),
+    Setting('nginx_stop_timeout', int, 60),
+    Setting('nginx_upgrade_timeout', int, 10),
+))
+
+
+def parse_conf(path):
+    """
+    Returns the "key value" lines of a zenwebserver.conf as a dict of
+    strings. Raises IOError if the file cannot be read.
+    """
+    config = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                parts = line.split(None, 1)
+                config[parts[0]] = parts[1].strip() if len(parts) > 1 else ''
+    return config
+
+
+class Settings(object):
+    """
+    Parsed zenwebserver.conf. Keys in SCHEMA are returned typed, with their
+    default when unset; other keys as the strings in the file.
+    """
+
+    def __init__(self, raw=None, exists=True):
+        self.raw = dict(raw or {})
+        self.exists = exists
+
+    def __contains__(self, name):
+        return name in self.raw or name in SCHEMA
+
+    def __getitem__(self, name):
+        setting = SCHEMA.get(name)
+        if name in self.raw:
+            return setting.parse(self.raw[name]) if setting else self.raw[name]
+        if setting:
+            return setting.default
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return sorted(set(self.raw) | set(SCHEMA))
+
+    def as_dict(self):
+        """
+        Returns all settings, the SCHEMA ones typed and with defaults.
+        """
+        return dict((name, self[name]) for name in self.keys())
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime, st.st_size
+
+
+def load_settings(path=WEBSERVER_CONF, check_interval=CHECK_INTERVAL):
+    """
+    Returns the Settings of path, parsing the file only if it changed since
+    it was last parsed in this process. A missing file yields defaults.
+    """
+    now = time.time()
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached and now - cached[1] < check_interval:
+            return cached[2]
+        stamp = _file_stamp(path)
+        if cached and stamp == cached[0]:
+            _cache[path] = (stamp, now, cached[2])
+            return cached[2]
+        try:
+            settings = Settings(parse_conf(path))
+        except IOError:
+            settings = Settings(exists=False)
+        _cache[path] = (stamp, now, settings)
+        return settings
+
+
+def local_url(config, path):
+    """
+    Returns the URL of path on the local load balancer for the Settings
+    config.
+    """
+    if config['useSSL']:
+        return 'https://127.0.0.1:%d%s' % (config['sslPort'], path)
+    return 'http://127.0.0.1:%d%s' % (config['httpPort'], path)
+
+
+def open_local_url(url, timeout=10, data=None):
+    """
+    urllib2.urlopen for the local load balancer. Certificate checks (done by
+    Python 2.7.9 and later) are skipped, as zenwebserver commonly runs with a
+    self-signed certificate.
+    """
+    kwargs = {}
+    if url.startswith('https:'):
+        try:
+            import ssl
+            kwargs['context'] = ssl._create_unverified_context()
+        except AttributeError:
+            pass
+    return urllib2.urlopen(url, data, timeout, **kwargs)
@@ -1,48 +1,48 @@
 ##############################################################################
-# 
+#
 # Copyright (C) Zenoss, Inc. 2012, all rights reserved.
-# 
+#
 # This content is made available according to terms specified in
 # License.zenoss under the directory where your Zenoss product is installed.
-# 
+#
 ##############################################################################
 
 
+"""
+Generates $ZENHOME/etc/nginx.conf from nginx.conf.template and
+zenwebserver.conf.
+
+renderConfig() builds the configuration in memory without touching any
+file. configure() installs it only if its content differs from the live
+nginx.conf: the candidate is checked with "nginx -t" under a temporary
+name, renamed over nginx.conf, and a running nginx is reloaded gracefully.
+
+Usage: zenwebserverconfig.py [--no-reload] [--no-validate]
+"""
+
 import os
+import re
 import sys
 import shutil
+import hashlib
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+from cache import cache_version, write_version_conf, VERSION_CONF
+from webserverconf import load_settings
+from upstream import UpstreamConf, UpstreamError, DEFAULT_UPSTREAM, edit as editUpstreams
+from affinity import write_affinity_conf, affinity_conf_path, affinity_settings, home_keepalive
 
-zenhome = os.getenv('ZENHOME')
-if not zenhome:
-    raise Exception("$ZENHOME must be set")
-
-#valid keys
-# httpPort
-# useSSL
-# sslCert
-# sslKey
-defaultCert = '{INSTANCE_HOME}/etc/ssl/zenoss.crt'.format(INSTANCE_HOME=zenhome)
-defaultKey = '{INSTANCE_HOME}/etc/ssl/zenoss.key'.format(INSTANCE_HOME=zenhome)
-
-nginxCache = '{INSTANCE_HOME}/var/nginx/cache'.format(INSTANCE_HOME=zenhome)
-nginxTmp = '{INSTANCE_HOME}/var/nginx/tmp'.format(INSTANCE_HOME=zenhome)
-customHttpInclude = '{INSTANCE_HOME}/etc/nginx-custom-http-*.conf'.format(INSTANCE_HOME=zenhome)
-customServerInclude = '{INSTANCE_HOME}/etc/nginx-custom-server-*.conf'.format(INSTANCE_HOME=zenhome)
-
-config = {'useSSL': 'False',
-          'httpPort': '8080',
-          'sslPort': '443',
-          'sslCert': defaultCert,
-          'sslKey': defaultKey,
-          'worker_processes': '4',
-          'proxy_cache_path': nginxCache,
-          'proxy_temp_path': nginxTmp + '/proxy',
-          'client_body_temp_path': nginxTmp + '/client_body',
-          'customServerInclude':customServerInclude,
-          'customHttpInclude':customHttpInclude,
-          'error_log_level': 'warn',
-
-}
+zenhome = os.getenv('ZENHOME', '')
+
+templatePath = '{INSTANCE_HOME}/etc/nginx.conf.template'.format(INSTANCE_HOME=zenhome)
+webserverConf = '{INSTANCE_HOME}/etc/zenwebserver.conf'.format(INSTANCE_HOME=zenhome)
+nginxConf = '{INSTANCE_HOME}/etc/nginx.conf'.format(INSTANCE_HOME=zenhome)
+nginxConfBackup = '{INSTANCE_HOME}/etc/nginx.conf.prev'.format(INSTANCE_HOME=zenhome)
+nginxZopeConf = '{INSTANCE_HOME}/etc/nginx-zope.conf'.format(INSTANCE_HOME=zenhome)
+nginxBin = '{INSTANCE_HOME}/bin/nginx'.format(INSTANCE_HOME=zenhome)
+nginxPidFile = '{INSTANCE_HOME}/var/nginx.pid'.format(INSTANCE_HOME=zenhome)
 
 #mapping of conf file values to substitutions
 MAPPING2 = {'HTTP_PORT': 'httpPort',
@@ -57,55 +57,19 @@ substitutionDefaults = {'INSTANCE_HOME':zenhome,
                         'FILE_BEGIN':'',
                         'PRE_SERVERBLOCK':'',
                         'SSL_CONFIG': '',
+                        'POOL_LOCATIONS': '',
+                        'MICROCACHE_HTTP': '',
+                        'MICROCACHE_LOCATION': '',
+                        'LIMITS_HTTP': '',
+                        'LIMITS_SERVER': '',
+                        'AFFINITY_HTTP': '',
+                        'ZOPE_UPSTREAM': 'zopectls',
+                        'WORKER_CPU_AFFINITY': '',
+                        'STATIC_CACHE_LOCK': '',
+                        'STATIC_CACHE_USE_STALE': 'off',
                         }
 
-print "Generating new config"
-
-CONF_FILE_TEMPLATE = None
-templatePath = '{INSTANCE_HOME}/etc/nginx.conf.template'.format(INSTANCE_HOME=zenhome)
-try:
-    lines = []
-    with open(templatePath, 'r') as f:
-        lines = f.readlines()
-    #remove first comment
-    if lines[0].startswith('#'):
-        lines[0] = ''
-    CONF_FILE_TEMPLATE = ''.join(lines)
-except IOError:
-    print "Could not find template at %s" % templatePath
-    sys.exit(1)
-
-
-webserverConf = '%s/etc/zenwebserver.conf' % zenhome
-try:
-    with open(webserverConf, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and  not line.startswith('#'):
-                key, val = line.split(' ',1)
-                config[key] = val.strip()
-except IOError:
-    print "%s not found; using default values" % webserverConf
-
-substitutions = dict(substitutionDefaults)
-
-#map conf file values to substitutions
-for key, val in MAPPING2.items():
-    if val in config:
-        substitutions[key] = config.get(val)
-
-#add all other values from conf file into substitutions
-for key, val in config.items():
-    #don't overwrite special config values
-    if key not in substitutions:
-        substitutions[key]=val
-
-useSSL = config['useSSL'].lower() == 'true'
-if useSSL:
-    substitutions['PROTOCOL']='https'
-    substitutions['PORT'] = config['sslPort']
-
-    substitutions['FILE_BEGIN'] = """
+SSL_FILE_BEGIN = """
 #####################################################################################
 #  SSL Configuration for zenwebserver
 #
@@ -127,7 +91,8 @@ if useSSL:
 #####################################################################################
 user zenoss zenoss;
 """
-    substitutions['PRE_SERVERBLOCK']="""
+
+SSL_PRE_SERVERBLOCK = """
     server {{
         listen 80;
         rewrite ^(.*)$ https://$host:{SSL_PORT}$1 break;
@@ -137,9 +102,9 @@ user zenoss zenoss;
         listen {HTTP_PORT};
         rewrite ^(.*)$ https://$host:{SSL_PORT}$1 break;
     }}
-""".format(**substitutions)
+"""
 
-    substitutions['SSL_CONFIG'] = """
+SSL_CONFIG = """
         ssl on;
         # The names/paths of your certificate files
         ssl_certificate {SSL_CERT};
@@ -148,39 +113,881 @@ user zenoss zenoss;
         ssl_protocols SSLv3 TLSv1.2 TLSv1.1;
         ssl_ciphers RC4:HIGH:!aNULL:!MD5;
         ssl_prefer_server_ciphers on;
-""".format(**substitutions)
+"""
+
+# Named Zope pools: "zope_pool_<name> <regex> [<regex> ...]" sends requests
+# matching any of the regexes to upstream zopectls_<name>. Pools without
+# servers in nginx-zope.conf are skipped, so their requests go to the
+# default pool until servers are deployed to them. The pool locations come
+# after the static file location and before the micro-cache one, and nginx
+# uses the first regex location that matches.
+POOL_PREFIX = 'zope_pool_'
+
+# Router URIs of the micro-cached calls, to tell when a pool pattern takes
+# them away from the micro-cache
+POOL_ROUTER_PROBES = ('/zport/dmd/device_router',
+                      '/zport/dmd/Devices/Server/device_router',
+                      '/zport/dmd/evconsole_router',
+                      '/zport/dmd/Events/evconsole_router')
+
+POOL_LOCATION = """
+        location ~ "{PATTERN}" {{
+            rewrite ^(.*)$ /VirtualHostBase/{PROTOCOL}/$host:{PORT}$1 break;
+            proxy_pass http://{UPSTREAM};
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_set_header Host $http_host;
+            proxy_set_header X-Real-IP $remote_addr ;
+            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for ;
+            proxy_set_header  X-Url-Scheme $scheme;
+            proxy_read_timeout 600s;
+            client_max_body_size 500m;
+        }}
+"""
+
+def upstreamsWithServers(path):
+    """
+    Returns the names of the upstream blocks in path that contain servers.
+    """
+    return UpstreamConf.load(path).active_upstreams()
+
+def upstreamServerCounts(path):
+    """
+    Returns the number of servers of every upstream block in path.
+    """
+    return dict((upstream.name, len(upstream.servers)) for upstream in UpstreamConf.load(path).upstreams)
+
+# Idle connections to the Zopes kept open by each nginx worker, and how
+# fast failing Zopes are taken out of rotation, applied to all upstreams
+# and servers of nginx-zope.conf. Parameters of single servers, such as
+# their weight, are left as they are.
+def setUpstreamParams(path, keepalive, maxFails=None, failTimeout=None):
+    """
+    Sets keepalive in every upstream block of path (removing it for 0), and
+    max_fails and fail_timeout on every server if given. Returns True if
+    the file changed.
+    """
+    if not os.path.isfile(path):
+        return False
+    with editUpstreams(path) as conf:
+        conf.set_keepalive(keepalive)
+        for name, server in conf.servers():
+            if maxFails is not None:
+                server.set('max_fails', maxFails)
+            if failTimeout:
+                server.set('fail_timeout', failTimeout)
+        changed = conf.changed
+    return changed
+
+def setAffinity(path, config):
+    """
+    Writes the nginx-affinity.conf next to path if affinity is enabled and
+    removes it otherwise, so later changes of path no longer rewrite it.
+    Returns True if it changed.
+    """
+    affinityPath = affinity_conf_path(path)
+    if not config['affinity']:
+        if os.path.exists(affinityPath):
+            os.remove(affinityPath)
+            return True
+        return False
+    cookie, threads = affinity_settings(config)
+    with editUpstreams(path) as conf:
+        return write_affinity_conf(conf, cookie, threads, affinityPath)
+
+
+# Worker sizing. nginx runs one worker per core; every worker can hold
+# worker_connections connections, and a proxied request takes two of them
+# (client and Zope) plus a file descriptor each, so worker_connections is
+# derived from the file descriptor limit left after the idle keepalive
+# connections to the upstreams and a reserve for logs, cache files and
+# listening sockets.
+MAX_NOFILE = 65536
+MAX_WORKER_CONNECTIONS = 16384
+MIN_WORKER_CONNECTIONS = 1024
+FD_RESERVE = 64
+
+def detectCpus():
+    try:
+        return max(int(os.sysconf('SC_NPROCESSORS_ONLN')), 1)
+    except (ValueError, OSError):
+        return 1
+
+def nofileLimit():
+    """
+    Returns the hard limit of open files, up to which workers may raise
+    their own limit.
+    """
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        return MAX_NOFILE
+    return hard
+
+def _autoInt(config, key, notes):
+    """
+    Returns the value of a setting that is a number or 'auto', or None for
+    'auto'.
+    """
+    value = str(config.get(key, 'auto')).strip()
+    if value.lower() == 'auto':
+        return None
+    try:
+        return max(int(value), 1)
+    except ValueError:
+        notes.append("Invalid %s %r; using auto" % (key, value))
+        return None
+
+def cpuAffinityMasks(workers, cpus):
+    """
+    Returns the worker_cpu_affinity masks binding worker i to CPU i modulo
+    the number of CPUs.
+    """
+    return ' '.join(format(1 << (i % cpus), '0%db' % cpus) for i in range(workers))
+
+
+class WorkerSizing(object):
+    """
+    nginx worker settings derived from the host and zenwebserver.conf, and
+    the capacity they give.
+    """
+
+    def __init__(self, config, cpus=None, nofile=None, upstreamServers=None):
+        self.notes = []
+        self.cpus = cpus or detectCpus()
+        self.nofile = nofile or nofileLimit()
+        # Zope pool size per upstream, if known. Only reported, and counted
+        # for the idle connections of affinity; it limits no clients, as
+        # requests beyond the Zopes' threads are meant to wait in nginx.
+        self.upstreamServers = upstreamServers or {}
+        self.keepalive = max(config.get('zope_keepalive', 0), 0)
+        # Affinity adds a home upstream per server of the default pool
+        self.affinityHomes = self.upstreamServers.get(DEFAULT_UPSTREAM, 0) if config.get('affinity') else 0
+
+        self.workers = _autoInt(config, 'worker_processes', self.notes) or self.cpus
+        self.rlimitNofile = _autoInt(config, 'worker_rlimit_nofile', self.notes) or min(self.nofile, MAX_NOFILE)
+        self.connections = _autoInt(config, 'worker_connections', self.notes)
+        if self.connections is None:
+            available = self.rlimitNofile - FD_RESERVE - self.idleUpstreamConnections
+            self.connections = min(max(available, MIN_WORKER_CONNECTIONS), MAX_WORKER_CONNECTIONS)
+        if self.connections > self.rlimitNofile:
+            self.notes.append("worker_connections %d exceeds the open file limit %d of the workers"
+                              % (self.connections, self.rlimitNofile))
+
+        affinity = str(config.get('worker_cpu_affinity', 'off')).strip()
+        if affinity.lower() in ('off', 'false', ''):
+            self.affinity = ''
+        elif affinity.lower() in ('auto', 'on', 'true'):
+            self.affinity = cpuAffinityMasks(self.workers, self.cpus)
+        else:
+            self.affinity = affinity
+
+    @property
+    def idleUpstreamConnections(self):
+        # Every worker keeps its own idle connections for each upstream
+        return (self.keepalive * max(len(self.upstreamServers), 1)
+                + self.affinityHomes * home_keepalive(self.keepalive, self.affinityHomes))
+
+    @property
+    def clientsPerWorker(self):
+        # Clients of proxied requests also hold a connection to a Zope
+        return max(self.connections - self.idleUpstreamConnections, 0) // 2
+
+    @property
+    def zopeServers(self):
+        return sum(self.upstreamServers.values())
+
+    def substitutions(self):
+        return {'worker_processes': self.workers,
+                'worker_connections': self.connections,
+                'worker_rlimit_nofile': self.rlimitNofile,
+                'WORKER_CPU_AFFINITY': 'worker_cpu_affinity %s;' % self.affinity if self.affinity else ''}
+
+    def describe(self):
+        """
+        Returns the capacity model as lines of text.
+        """
+        lines = ["Capacity model:",
+                 "  %d CPUs, open file limit %d" % (self.cpus, self.nofile),
+                 "  %d workers x %d connections, %d open files each%s"
+                 % (self.workers, self.connections, self.rlimitNofile,
+                    ", pinned to CPUs" if self.affinity else ""),
+                 "  %d idle Zope connections kept per worker" % self.idleUpstreamConnections,
+                 "  %d concurrent proxied clients (%d per worker), up to %d static or cached"
+                 % (self.workers * self.clientsPerWorker, self.clientsPerWorker,
+                    self.workers * max(self.connections - self.idleUpstreamConnections, 0))]
+        if self.zopeServers:
+            lines.append("  %d Zope servers; requests beyond the Zopes' threads wait in nginx"
+                         % self.zopeServers)
+        return lines
+
+
+# Thundering herd protection of the static file cache. With the lock, only
+# the first of the concurrent misses of a file is sent to Zope and the
+# others wait for it to be cached, up to the lock timeout. proxy_cache_use_stale
+# answers from an expired entry while one request refreshes it (updating)
+# and while the Zopes fail (error, timeout, http_5xx).
+STATIC_CACHE_USE_STALE = ('error', 'timeout', 'invalid_header', 'updating',
+                          'http_500', 'http_502', 'http_503', 'http_504', 'http_404')
+STATIC_CACHE_VALID_RE = re.compile(r'^\d+[smhd]?$')
+
+def staticCacheProtection(config, notes):
+    """
+    Returns the substitutions of the lock and stale settings of the static
+    file cache.
+    """
+    substitutions = {}
+    if not STATIC_CACHE_VALID_RE.match(config['static_cache_valid']):
+        notes.append("Invalid static_cache_valid %r; using 60m" % config['static_cache_valid'])
+        substitutions['static_cache_valid'] = '60m'
+    if config['static_cache_lock']:
+        substitutions['STATIC_CACHE_LOCK'] = 'proxy_cache_lock on;\n            proxy_cache_lock_timeout %ds;' % (
+            max(config['static_cache_lock_timeout'], 1))
+    conditions = config['static_cache_use_stale'].split()
+    unknown = [c for c in conditions if c not in STATIC_CACHE_USE_STALE + ('off',)]
+    if unknown or 'off' in conditions or not conditions:
+        if unknown:
+            notes.append("Unknown static_cache_use_stale conditions %s; not serving stale files"
+                         % ' '.join(unknown))
+        substitutions['STATIC_CACHE_USE_STALE'] = 'off'
+    else:
+        substitutions['STATIC_CACHE_USE_STALE'] = ' '.join(conditions)
+    return substitutions
+
+
+# Micro-cache for read-only JSON router calls. Only single (not batched)
+# Ext.Direct calls of the allowlisted Router.method names are cached; the
+# key is made of the session cookies and the request body without its
+# per-request transaction id, so only identical calls within one session
+# share an entry. proxy_cache_lock makes concurrent identical calls wait
+# for the first one instead of all reaching Zope.
+MICROCACHE_HTTP = r"""
+    proxy_cache_path {PATH} levels=1:2 keys_zone=zenoss-microcache:8m max_size=100m inactive=1m;
+
+    map $request_body $zenoss_microcache_call {{
+        default "";
+        "~^(?<zenoss_microcache_body>\{{(?:{CALLS}),.*),\s*\"tid\":\s*\d+\s*\}}$" $zenoss_microcache_body;
+    }}
+
+    map $zenoss_microcache_call $zenoss_microcache_skip {{
+        default 0;
+        "" 1;
+    }}
+
+    map $http_cookie $zenoss_microcache_anonymous {{
+        default 0;
+        "" 1;
+    }}
+"""
+
+MICROCACHE_LOCATION = """
+        location ~ _router$ {{
+            rewrite ^(.*)$ /VirtualHostBase/{PROTOCOL}/$host:{PORT}$1 break;
+            proxy_pass http://{UPSTREAM};
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_set_header Host $http_host;
+            proxy_set_header X-Real-IP $remote_addr ;
+            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for ;
+            proxy_set_header  X-Url-Scheme $scheme;
+            proxy_read_timeout 600s;
+            client_max_body_size 500m;
+
+            # $request_body is only set for bodies read into a single buffer
+            client_body_buffer_size 128k;
+            client_body_in_single_buffer on;
+
+            proxy_cache zenoss-microcache;
+            proxy_cache_methods POST;
+            proxy_cache_key "$cookie___ac|$cookie__ZopeId|$http_authorization|$uri|$zenoss_microcache_call";
+            proxy_cache_valid 200 {TTL}s;
+            proxy_cache_bypass $zenoss_microcache_skip $zenoss_microcache_anonymous;
+            proxy_no_cache $zenoss_microcache_skip $zenoss_microcache_anonymous;
+            proxy_ignore_headers Cache-Control Expires;
+            proxy_cache_lock on;
+            add_header X-Zenoss-Microcache $upstream_cache_status;
+        }}
+"""
+
+def microcacheCalls(methods):
+    """
+    Returns a regex matching the start of an Ext.Direct call of one of the
+    given "Router.method" names.
+    """
+    byAction = {}
+    for name in methods.split():
+        action, _, method = name.partition('.')
+        if action and method:
+            byAction.setdefault(action, []).append(re.escape(method))
+    calls = []
+    for action in sorted(byAction):
+        calls.append(r'\"action\":\s*\"%s\",\s*\"method\":\s*\"(?:%s)\"' % (
+            re.escape(action), '|'.join(byAction[action])))
+    return '|'.join(calls)
+
+
+# Admission control. Every request to Zope is counted against the client
+# that made it, identified by its Zope session cookie or its address, and
+# against the class of its URI: "limit_class_<name> [rate=Nr/s] [burst=N]
+# [conn=N] <regex> [<regex> ...]" defines a class, and requests of no class
+# fall under limit_rate, limit_burst and limit_conn. A client going over the
+# rate has up to burst requests queued in nginx; beyond that, or beyond conn
+# requests in progress, it is answered at once with limit_status and a
+# Retry-After header. Static files, remote collector routes and the pages
+# of nginx itself are not limited.
+LIMIT_CLASS_PREFIX = 'limit_class_'
+
+LIMITS_EXEMPT = (r'(?i)\.(jpg|png|gif|jpeg|css|js|mp3|wav|swf|mov|doc|pdf|xls|ppt|docx|pptx|xlsx|ico)$',
+                 r'^/remote-(collector|hub)/',
+                 r'^/nginx_status$',
+                 r'^/zenwebserver_')
+
+LIMITS_HTTP = r"""
+    map $cookie__ZopeId $zenoss_limit_session {{
+        default $cookie__ZopeId;
+        "" $binary_remote_addr;
+    }}
+
+    map $zenoss_limit_uri $zenoss_limit_class {{
+        default zope;
+{CLASS_MAP}    }}
+{ZONES}
+    server {{
+        listen unix:{SOCKET};
+        access_log off;
+        location = /zenwebserver_limited {{
+            default_type text/plain;
+            add_header Retry-After {RETRY_AFTER};
+            return 200 "Too many requests, retry in {RETRY_AFTER} seconds\n";
+        }}
+    }}
+"""
 
-headerline = """
+# Plain-HTTP listener of the rejection page, so a rejected request costs no
+# new TCP or TLS connection into the server that rejected it
+LIMITS_SOCKET = 'var/nginx-limited.sock'
+
+# The key of a class is the client for requests of that class and empty,
+# which is not counted, for all others
+LIMITS_CLASS_KEY = """
+    map $zenoss_limit_class $zenoss_limit_{NAME} {{
+        default "";
+        {NAME} {CLIENT};
+    }}
+"""
+
+# limit_req and limit_conn answer 503 in this nginx version, and add_header
+# does not apply to error responses, so rejected requests are answered by
+# the listener on LIMITS_SOCKET, whose Retry-After header is passed through
+# with the status replaced. This error_page comes before the one of the
+# template and takes precedence for 503.
+LIMITS_SERVER = """
+        set $zenoss_limit_uri $uri;
+{LIMITS}
+        error_page 503 ={STATUS} @zenoss_limited;
+        location @zenoss_limited {{
+            # proxy_pass takes no URI in a named location
+            rewrite ^ /zenwebserver_limited break;
+            proxy_pass http://unix:{SOCKET}:;
+        }}
+"""
+
+LIMIT_RATE_RE = re.compile(r'^\d+r/[sm]$')
+
+def limitClasses(config, notes):
+    """
+    Returns the admission classes of config as a list of (name, rate, burst,
+    conn, patterns), the default class 'zope' last. Classes and values that
+    are not valid are left out with a note.
+    """
+    classes = []
+    for key in sorted(config):
+        if not key.startswith(LIMIT_CLASS_PREFIX):
+            continue
+        name = key[len(LIMIT_CLASS_PREFIX):]
+        if not re.match(r'^[a-z0-9_]+$', name) or name == 'zope':
+            notes.append("Invalid limit class name %r; not limiting it" % name)
+            continue
+        values = {'rate': None, 'burst': 0, 'conn': 0}
+        patterns = []
+        for token in str(config[key]).split():
+            option, sep, value = token.partition('=')
+            if sep and option in values:
+                values[option] = value
+            else:
+                patterns.append(token)
+        if not patterns:
+            notes.append("Limit class %s lists no URI patterns; not limiting it" % name)
+            continue
+        classes.append((name, values['rate'], values['burst'], values['conn'], patterns))
+    classes.append(('zope', config.get('limit_rate'), config.get('limit_burst'),
+                    config.get('limit_conn'), []))
+
+    valid = []
+    for name, rate, burst, conn, patterns in classes:
+        if rate is not None and not LIMIT_RATE_RE.match(str(rate)):
+            notes.append("Invalid rate %r of limit class %s; not limiting its rate" % (rate, name))
+            rate = None
+        try:
+            burst = max(int(burst or 0), 0)
+            conn = max(int(conn or 0), 0)
+        except ValueError:
+            notes.append("Invalid burst or conn of limit class %s; not limiting it" % name)
+            continue
+        valid.append((name, rate, burst, conn, patterns))
+    return valid
+
+def limitsConfig(config, instanceHome, notes):
+    """
+    Returns the http and server level directives of the admission limits.
+    """
+    client = {'session': '$zenoss_limit_session',
+              'ip': '$binary_remote_addr'}.get(config['limit_key'])
+    if client is None:
+        notes.append("Invalid limit_key %r; limiting by session" % config['limit_key'])
+        client = '$zenoss_limit_session'
+    status = config['limit_status']
+    if status not in (429, 503):
+        notes.append("Invalid limit_status %r; answering 429" % status)
+        status = 429
+
+    classMap = []
+    for pattern in LIMITS_EXEMPT:
+        classMap.append('        "~%s" "";\n' % pattern.replace('"', '\\"'))
+    zones = []
+    limits = []
+    for name, rate, burst, conn, patterns in limitClasses(config, notes):
+        for pattern in patterns:
+            classMap.append('        "~%s" %s;\n' % (pattern.replace('"', '\\"'), name))
+        if not rate and not conn:
+            continue
+        zones.append(LIMITS_CLASS_KEY.format(NAME=name, CLIENT=client))
+        if rate:
+            zones.append('    limit_req_zone $zenoss_limit_%s zone=zenoss-req-%s:%s rate=%s;\n'
+                         % (name, name, config['limit_zone_size'], rate))
+            limits.append('        limit_req zone=zenoss-req-%s%s;' % (name, ' burst=%d' % burst if burst else ''))
+        if conn:
+            zones.append('    limit_conn_zone $zenoss_limit_%s zone=zenoss-conn-%s:%s;\n'
+                         % (name, name, config['limit_zone_size']))
+            limits.append('        limit_conn zenoss-conn-%s %d;' % (name, conn))
+    if not limits:
+        notes.append("limits is enabled but no limit class has a rate or conn")
+        return '', ''
+    socket = os.path.join(instanceHome, LIMITS_SOCKET)
+    http = LIMITS_HTTP.format(CLASS_MAP=''.join(classMap), ZONES=''.join(zones), SOCKET=socket,
+                              RETRY_AFTER=max(config['limit_retry_after'], 1))
+    server = LIMITS_SERVER.format(LIMITS='\n'.join(limits), STATUS=status, SOCKET=socket)
+    return http, server
+
+
+# Render cache of the remote collector and hub routes, which include the
+# file of their type. Renders are cached for dc_render_cache_<type> seconds
+# under the full request URI with its query string. proxy_cache_lock merges
+# concurrent misses of one render into a single request over the WAN, and
+# a stale render is served while it is being refreshed or while its
+# collector cannot be reached, until it went unused for
+# dc_render_cache_stale seconds (the inactive time of the cache zone).
+RENDER_CACHE_TYPES = ('collector', 'hub')
+
+RENDER_CACHE_GENERATED = """# GENERATED FILE, DO NOT MODIFY. USE {INSTANCE_HOME}/etc/zenwebserver.conf to set options
+"""
+
+RENDER_CACHE_LOCATION = RENDER_CACHE_GENERATED + """proxy_cache zenoss-render-cache;
+proxy_cache_key $request_uri;
+proxy_cache_valid 200 {TTL}s;
+proxy_ignore_headers Cache-Control Expires;
+proxy_cache_lock on;
+proxy_cache_lock_timeout {LOCK_TIMEOUT}s;
+proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;
+add_header X-Zenoss-Render-Cache $upstream_cache_status;
+"""
+
+RENDER_CACHE_OFF = RENDER_CACHE_GENERATED + """# Renders of the remote {TYPE}s are not cached
+"""
+
+def renderCacheConfPath(dctype, instanceHome=zenhome):
+    return os.path.join(instanceHome, 'etc', 'nginx-render-cache-%s.conf' % dctype)
+
+def renderCacheConf(config, dctype, instanceHome=zenhome):
+    """
+    Returns the render cache directives for the routes of one type.
+    """
+    ttl = config['dc_render_cache_%s' % dctype]
+    if ttl <= 0:
+        return RENDER_CACHE_OFF.format(INSTANCE_HOME=instanceHome, TYPE=dctype)
+    return RENDER_CACHE_LOCATION.format(INSTANCE_HOME=instanceHome, TTL=ttl,
+                                        LOCK_TIMEOUT=max(config['dc_render_cache_lock_timeout'], 1))
+
+def writeRenderCacheConfs(config, instanceHome=zenhome):
+    """
+    Writes the render cache file of every type. Returns True if one changed.
+    """
+    changed = False
+    for dctype in RENDER_CACHE_TYPES:
+        content = renderCacheConf(config, dctype, instanceHome)
+        path = renderCacheConfPath(dctype, instanceHome)
+        if contentHash(content) == fileHash(path):
+            continue
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.nginx-render-cache')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        changed = True
+    return changed
+
+
+HEADERLINE = """
 #########################################################################################
 # GENERATED FILE, DO NOT MODIFY. USE {INSTANCE_HOME}/etc/zenwebserver.conf to set options
 #########################################################################################
-""".format(**substitutions)
+"""
+
+def readTemplate(path=templatePath):
+    """
+    Returns the nginx.conf template without its leading comment line.
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    #remove first comment
+    if lines and lines[0].startswith('#'):
+        lines[0] = ''
+    return ''.join(lines)
+
+def readConfig(path=webserverConf):
+    """
+    Returns the settings of zenwebserver.conf with defaults, typed as
+    described by webserverconf.SCHEMA.
+    """
+    return load_settings(path).as_dict()
+
+def renderConfig(config, template, activeUpstreams=(), instanceHome=None, sizing=None):
+    """
+    Returns (content, notes): the text of nginx.conf for the given settings
+    and template, and remarks about settings that were not applied.
+    activeUpstreams names the upstreams of nginx-zope.conf with servers;
+    instanceHome replaces $ZENHOME in the paths of the template. sizing is
+    the WorkerSizing to apply, by default derived from this host.
+    """
+    notes = []
+    substitutions = dict(substitutionDefaults)
+    if instanceHome:
+        substitutions['INSTANCE_HOME'] = instanceHome
+
+    #map conf file values to substitutions
+    for key, val in MAPPING2.items():
+        if val in config:
+            substitutions[key] = config.get(val)
+
+    #add all other values from conf file into substitutions
+    for key, val in config.items():
+        #don't overwrite special config values
+        if key not in substitutions:
+            substitutions[key]=val
+
+    if sizing is None:
+        sizing = WorkerSizing(config)
+    substitutions.update(sizing.substitutions())
+    notes.extend(sizing.notes)
+    substitutions.update(staticCacheProtection(config, notes))
+
+    if config['useSSL']:
+        substitutions['PROTOCOL']='https'
+        substitutions['PORT'] = config['sslPort']
+        substitutions['FILE_BEGIN'] = SSL_FILE_BEGIN
+        substitutions['PRE_SERVERBLOCK'] = SSL_PRE_SERVERBLOCK.format(**substitutions)
+        substitutions['SSL_CONFIG'] = SSL_CONFIG.format(**substitutions)
+
+    if config['affinity']:
+        # nginx-affinity.conf defines the upstream of every request
+        substitutions['AFFINITY_HTTP'] = 'include %s;' % os.path.join(
+            substitutions['INSTANCE_HOME'], 'etc', 'nginx-affinity.conf')
+        substitutions['ZOPE_UPSTREAM'] = '$zenoss_zope_upstream'
+
+    poolLocations = []
+    for key in sorted(config):
+        if not key.startswith(POOL_PREFIX):
+            continue
+        pool = key[len(POOL_PREFIX):]
+        upstream = 'zopectls_%s' % pool
+        if upstream not in activeUpstreams:
+            notes.append("Pool %s has no servers; its requests go to the default pool" % pool)
+            continue
+        for pattern in config[key].split():
+            if config['microcache'] and any(re.search(pattern, uri) for uri in POOL_ROUTER_PROBES):
+                notes.append("Pool %s pattern %r matches router requests, which it sends to its servers "
+                             "without the micro-cache" % (pool, pattern))
+            poolLocations.append(POOL_LOCATION.format(PATTERN=pattern.replace('"', '\\"'),
+                                                      UPSTREAM=upstream,
+                                                      PROTOCOL=substitutions['PROTOCOL'],
+                                                      PORT=substitutions['PORT']))
+    substitutions['POOL_LOCATIONS'] = ''.join(poolLocations)
 
+    if config['microcache']:
+        calls = microcacheCalls(config['microcache_methods'])
+        # Entries live for 1 to 5 seconds
+        ttl = min(max(config['microcache_ttl'], 1), 5)
+        if calls:
+            substitutions['MICROCACHE_HTTP'] = MICROCACHE_HTTP.format(PATH=config['microcache_path'],
+                                                                      CALLS=calls)
+            substitutions['MICROCACHE_LOCATION'] = MICROCACHE_LOCATION.format(TTL=ttl,
+                                                                              UPSTREAM=substitutions['ZOPE_UPSTREAM'],
+                                                                              PROTOCOL=substitutions['PROTOCOL'],
+                                                                              PORT=substitutions['PORT'])
+        else:
+            notes.append("microcache_methods lists no Router.method names; not enabling the micro-cache")
 
-conf_file = CONF_FILE_TEMPLATE.format(**substitutions)
+    if config['limits']:
+        substitutions['LIMITS_HTTP'], substitutions['LIMITS_SERVER'] = limitsConfig(
+            config, substitutions['INSTANCE_HOME'], notes)
 
-path = '%s/etc/nginx.conf' % zenhome
-path_bak = '%s/etc/nginx.conf.prev' % zenhome
+    content = HEADERLINE.format(**substitutions) + template.format(**substitutions)
+    return content, notes
 
-hasPreviousConf = False
+def contentHash(content):
+    return hashlib.md5(content).hexdigest()
 
-if os.path.isfile(path):
+def fileHash(path):
+    """
+    Returns the content hash of path, or None if it cannot be read.
+    """
     try:
-        print "Saving copy of previous config to %s" % path_bak
-        shutil.copy(path, path_bak)
-        hasPreviousConf = True
+        with open(path, 'r') as f:
+            return contentHash(f.read())
     except IOError:
-        print "Could not create back up of config"
-
-try:
-    print "Writing new config"
-    with open(path, 'w') as f:
-        f.write(headerline)
-        f.write(conf_file)
-except IOError as e:
-    print "Error writing new config: %s" % e
-    if hasPreviousConf and os.path.isfile(path_bak):
-        print "Attempting to restore previous config"
-        shutil.copy(path_bak, path)
-        print "Previous config restored"
-    sys.exit(1)
+        return None
+
+def stageConfig(content, path=nginxConf):
+    """
+    Writes content to a temporary file next to path and returns its name.
+    """
+    fd, stagedPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.nginx.conf.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(stagedPath, 0644)
+    return stagedPath
+
+def validateConfig(stagedPath, nginx=nginxBin):
+    """
+    Checks a staged configuration with "nginx -t". Returns (ok, output);
+    ok is None if there is no nginx binary to check with.
+    """
+    if not os.access(nginx, os.X_OK):
+        return None, "%s not found; not checking the new config" % nginx
+    process = subprocess.Popen([nginx, '-t', '-c', stagedPath],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode == 0, output
+
+def installConfig(stagedPath, path=nginxConf, backupPath=nginxConfBackup):
+    """
+    Replaces path with the staged configuration in one rename, keeping a copy
+    of the previous one at backupPath.
+    """
+    if os.path.isfile(path):
+        shutil.copy(path, backupPath)
+    os.rename(stagedPath, path)
+
+def readFile(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except IOError:
+        return None
+
+class GeneratedConfs(object):
+    """
+    The files included by nginx.conf that configure writes, saved before it
+    writes them so that they can be put back as a set if the configuration
+    they make up fails the nginx check.
+    """
+
+    def __init__(self, instanceHome=zenhome):
+        self.paths = [nginxZopeConf, affinity_conf_path(nginxZopeConf), VERSION_CONF]
+        self.paths.extend(renderCacheConfPath(dctype, instanceHome) for dctype in RENDER_CACHE_TYPES)
+        self.saved = dict((path, readFile(path)) for path in self.paths)
+        self.written = {}
+
+    def mark(self):
+        """
+        Records the contents written, to tell them from later changes.
+        """
+        self.written = dict((path, readFile(path)) for path in self.paths)
+
+    def restore(self):
+        """
+        Puts back the saved contents of the files written since, except
+        those changed again since mark(). Returns the paths left as they are.
+        """
+        kept = []
+        # Holding the lock of nginx-zope.conf keeps pool edits out meanwhile
+        with editUpstreams(nginxZopeConf):
+            for path in self.paths:
+                current = readFile(path)
+                if current == self.saved[path]:
+                    continue
+                if self.written and current != self.written.get(path):
+                    kept.append(path)
+                elif self.saved[path] is None:
+                    os.remove(path)
+                else:
+                    os.rename(stageConfig(self.saved[path], path), path)
+        return kept
+
+def nginxRunning(pidFile=nginxPidFile):
+    try:
+        with open(pidFile, 'r') as f:
+            os.kill(int(f.read().strip()), 0)
+        return True
+    except (IOError, OSError, ValueError):
+        return False
+
+def reloadNginx(nginx=nginxBin, path=nginxConf):
+    """
+    Makes a running nginx load path; workers finish their requests first.
+    Returns (ok, output).
+    """
+    process = subprocess.Popen([nginx, '-c', path, '-s', 'reload'],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode == 0, output
+
+
+class ConfigureResult(object):
+
+    def __init__(self):
+        self.changed = False
+        self.reloaded = False
+        self.errors = []
+        self.notes = []
+        self.capacity = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def configure(reload=True, validate=True):
+    """
+    Brings nginx.conf, the keepalive settings of nginx-zope.conf and the
+    cache version up to date with zenwebserver.conf, and reloads a running
+    nginx if any of them changed. The files are checked with nginx -t as a
+    set; if they fail, or cannot all be written, the ones already written
+    are put back.
+    """
+    result = ConfigureResult()
+    try:
+        template = readTemplate()
+    except IOError:
+        result.errors.append("Could not find template at %s" % templatePath)
+        return result
+    if not load_settings(webserverConf).exists:
+        result.notes.append("%s not found; using default values" % webserverConf)
+    config = readConfig()
+
+    generated = GeneratedConfs()
+
+    def fail(message):
+        result.errors.append(message)
+        try:
+            for path in generated.restore():
+                result.notes.append("%s was changed meanwhile; not restoring it" % path)
+            result.changed = False
+        except (IOError, OSError, UpstreamError) as e:
+            result.errors.append("Could not restore the previous config: %s" % e)
+        return result
+
+    try:
+        result.changed |= setUpstreamParams(nginxZopeConf, max(config['zope_keepalive'], 0),
+                                            config['zope_max_fails'], config['zope_fail_timeout'])
+    except (IOError, OSError, UpstreamError) as e:
+        result.notes.append("Could not update %s: %s" % (nginxZopeConf, e))
+    try:
+        result.changed |= setAffinity(nginxZopeConf, config)
+    except (IOError, OSError, ValueError) as e:
+        return fail("Error writing %s: %s" % (affinity_conf_path(nginxZopeConf), e))
+    try:
+        result.changed |= writeRenderCacheConfs(config)
+    except (IOError, OSError) as e:
+        return fail("Error writing the render cache config: %s" % e)
+    try:
+        result.changed |= write_version_conf(cache_version(config))
+    except (IOError, OSError) as e:
+        return fail("Error writing %s: %s" % (VERSION_CONF, e))
+    generated.mark()
+
+    servers = upstreamServerCounts(nginxZopeConf)
+    sizing = WorkerSizing(config, upstreamServers=servers)
+    result.capacity = sizing.describe()
+    content, notes = renderConfig(config, template, upstreamsWithServers(nginxZopeConf), sizing=sizing)
+    result.notes.extend(notes)
+    newConf = contentHash(content) != fileHash(nginxConf)
+    if newConf or result.changed:
+        stagedPath = None
+        try:
+            if newConf:
+                stagedPath = stageConfig(content)
+            if validate:
+                # The staged nginx.conf includes the files written above
+                ok, output = validateConfig(stagedPath or nginxConf)
+                if ok is None:
+                    result.notes.append(output)
+                elif not ok:
+                    return fail("New config failed the nginx check; keeping the current one:\n%s"
+                                % output.strip())
+            if stagedPath:
+                installConfig(stagedPath)
+                result.changed = True
+        except (IOError, OSError) as e:
+            return fail("Error writing new config: %s" % e)
+        finally:
+            if stagedPath and os.path.exists(stagedPath):
+                os.remove(stagedPath)
+
+    if result.changed and reload and nginxRunning():
+        ok, output = reloadNginx()
+        if ok:
+            result.reloaded = True
+        else:
+            result.errors.append("Could not reload nginx:\n%s" % output.strip())
+    return result
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Generates nginx.conf from zenwebserver.conf and reloads "
+                                      "nginx if the result changed.")
+    parser.add_option('--no-reload', dest='reload', action='store_false', default=True,
+                      help="Do not reload a running nginx")
+    parser.add_option('--no-validate', dest='validate', action='store_false', default=True,
+                      help="Do not check the new config with nginx -t")
+    options, args = parser.parse_args(argv)
+    if not zenhome:
+        print "$ZENHOME must be set"
+        return 1
+
+    print "Generating new config"
+    result = configure(reload=options.reload, validate=options.validate)
+    for note in result.notes:
+        print note
+    for error in result.errors:
+        print error
+    for line in result.capacity:
+        print line
+    if not result.ok:
+        return 1
+    if not result.changed:
+        print "Config is unchanged"
+    elif result.reloaded:
+        print "New config written to %s and loaded" % nginxConf
+    else:
+        print "New config written to %s" % nginxConf
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())